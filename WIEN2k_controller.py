@@ -1,9 +1,13 @@
-from datetime import datetime
-from igorwriter import IgorWave
-import numpy as np
 import os
-import re
-import subprocess
+
+from w2k_band_cache import BandCache
+from w2k_fermi import InspFile, get_ef
+from w2k_fileops import FileOps
+from w2k_klist import write_klist_band
+from w2k_machines import MachinesBuilder, count_kpoints, load_tuned_parallel
+from w2k_scf_monitor import ScfMonitor
+from w2k_steps import Step, StepEngine
+from w2k_trace import CommandRunner
 
 class BaseController:
     """
@@ -16,37 +20,92 @@ class BaseController:
         """
         self.case = case#.split("/")[-1]
 
-        self.case_path = f"/Users/hb_wien2k/WIEN2k/{case}"
-        self.temp_path = "/usr/local/WIEN2k_19.1/SRC_templates/"  # template file path
+        # 環境変数W2K_CASESとWIENROOTで変えられる (ベンチマークなど)
+        self.case_path = f"{os.environ.get('W2K_CASES', '/Users/hb_wien2k/WIEN2k')}/{case}"
+        self.temp_path = f"{os.environ.get('WIENROOT', '/usr/local/WIEN2k_19.1')}/SRC_templates/"  # template file path
 
         self.parallel = 4  # numbar of parallels (on : > 1, off : = 1)
+        self.omp = 1  # OpenMPのスレッド数 (1 : k並列のみ, 0 : k並列との組み合わせを自動で決める)
+        self._untouched_parallel = (self.parallel, self.omp)  # 利用者が変えていない(parallel, omp)
+        self.use_tuned_parallel("scf")  # w2k_others.OtherOperations.tune_parallelで調整した値があれば使う
+        self.machines_builder = None  # MachinesBuilderを入れると複数ホストやlapw0のMPIを設定できる
+        self.core_budget = os.cpu_count() or 1  # 独立したステップを同時に実行するときに使ってよいコア数
+        self.runner = CommandRunner()  # 全てのコマンドを実行する。trace()で記録を始める
+        self.band_cache = None  # use_band_cache()で、同じ入力のバンド計算の結果を使い回す
+        self.insp = InspFile(f"{self.temp_path}/case.insp", self._filepath("insp"))  # EFか重みが変わったときだけ書き直す
 
         # 計算の設定
         self.spin_pol = 0  # スピン偏極計算
         self.SOC = 0  # スピン軌道相互作用
         self.U = 0  # オンサイトクーロン相互作用
         self.ni = 1  # does NOT remove case.broyd*
+        self.scf_abort = 1  # :DISが発散・振動したらSCFを止める
+        self.scf_monitor = None  # 最後のSCFのScfMonitor。サイクルごとの:ENE, :DIS, :FER, :MMTが入っている
 
         os.chdir(self.case_path)
 
-    def set_parallel(self):
+    def set_parallel(self, machines_path=None, klist_path=None):
         """
         並列計算のための関数。
-        .machinesファイルをテンプレートからコピーして編集
+        k点の数とparallelのジョブ数から、各ジョブのk点数が均等になるように.machinesファイルを作る。
+        ompが1以上のときは、parallel個のジョブがそれぞれompスレッドを使う (parallel * ompコア)。
+        parallel = 1でomp > 1のときは、.machinesの代わりにOMP_NUM_THREADSを設定する。
+        :param machines_path: 書き出す.machinesのパス。Noneのときはcaseフォルダ
+        :param klist_path: k点を数えるファイル。Noneのときはcase.klist_band、なければcase.klist
         :return:
         """
-        machines_path = f"{self.case_path}/.machines"
-        if self.parallel > 1:
-            subprocess.call(["cp", f"{self.temp_path}/.machines", machines_path])
-
-            if self.parallel > 2:
-                with open(machines_path, "r") as f:
-                    ms = f.read()
+        if machines_path is None:
+            machines_path = f"{self.case_path}/.machines"
 
-                ms = ms.replace("1:localhost\n" * 2, "1:localhost\n" * self.parallel)
-
-                with open(machines_path, "w") as f:
-                    f.write(ms)
+        if self.parallel > 1:
+            if klist_path is None:
+                klist_path = self._filepath("klist_band")
+                if not os.path.exists(klist_path):
+                    klist_path = self._filepath("klist")
+            numofk = count_kpoints(klist_path)
+
+            builder = self.machines_builder
+            if builder is None:
+                # MachinesBuilderのホストのコア数は全体のコア数なので、ジョブ数 × スレッド数にする
+                builder = MachinesBuilder({"localhost": self.parallel * max(self.omp, 1)})
+
+            if self.omp == 1:
+                text = builder.k_parallel(numofk)
+            else:
+                text = builder.hybrid(numofk, omp=self.omp)
+            builder.write(machines_path, text)
+        elif self.omp > 1:
+            # .machinesを使わないので、OpenMPのスレッド数は環境変数で渡す
+            os.environ["OMP_NUM_THREADS"] = str(self.omp)
+
+    def use_tuned_parallel(self, task):
+        """
+        w2k_others.OtherOperations.tune_parallelで調整した並列数とスレッド数を使う。
+        調整していないときは何もしない。
+        :param task: "scf", "band", "dos"
+        :return: 調整済みの値があったかどうか
+        """
+        tuned = load_tuned_parallel(self.case_path, task)
+        if tuned is None:
+            return False
+
+        self.parallel = tuned["parallel"]
+        self.omp = tuned["omp"]
+        self._untouched_parallel = (self.parallel, self.omp)
+        return True
+
+    def _use_task_parallel(self, task):
+        """
+        parallelとompを利用者が変えていなければ、taskの調整済みの値に切り替える。
+        :param task: "scf", "band", "dos"
+        :return: 値が変わったかどうか。変わったときは.machinesを作り直す必要がある
+        """
+        if (self.parallel, self.omp) != self._untouched_parallel:
+            return False
+
+        before = (self.parallel, self.omp)
+        self.use_tuned_parallel(task)
+        return (self.parallel, self.omp) != before
 
     def initialization(self, rkmax=7, lmax=10, gmax=12, kmesh=1000):
         """
@@ -76,8 +135,7 @@ class BaseController:
         if self.spin_pol:
             com_list.insert(2, "-sp")
 
-        print("run " + " ".join(com_list))
-        subprocess.run(com_list)
+        self._run(com_list)
 
     def scf(self, econv=0.0001, cconv=0.001, numofiteration=40):
         """
@@ -85,8 +143,11 @@ class BaseController:
         :param econv:エネルギーの収束条件
         :param cconv:電荷の収束条件。なしの時は０を入れる
         :param numofiteration:最大SCFサイクル数
-        :return:
+        :return: ScfMonitor。発散・振動で止めたときはstoppedに理由が入っている
         """
+        if self._use_task_parallel("scf"):
+            self.set_parallel(klist_path=self._filepath("klist"))
+
         if self.spin_pol:
             f_com = "runsp_lapw"
         else:
@@ -114,8 +175,10 @@ class BaseController:
         if self.ni:
             com_list.append("-NI")
 
-        print("Run " + " ".join(com_list))
-        subprocess.run(com_list)
+        self.scf_monitor = ScfMonitor(self._filepath("scf"), abort=self.scf_abort)
+        self._run(com_list, numofk=count_kpoints(self._filepath("klist")), watcher=self.scf_monitor.watch)
+
+        return self.scf_monitor
 
     def save_lapw(self, dir_name):
         """
@@ -123,7 +186,7 @@ class BaseController:
         :return:
         """
         com_list = ["save_lapw", "-d", dir_name]
-        subprocess.run(com_list)
+        self._run(com_list)
         print(f"Save lapw in {dir_name}")
 
     def make_klist_band(self, kpath: list, denominator: int):
@@ -135,25 +198,7 @@ class BaseController:
         :return:
         """
 
-        out_ls = []
-        tail = "-8.00 8.00"
-
-        # print(f"OUTPUT ----> {self.case}.klist_band")
-
-        for kpi in range(len(kpath)):
-            kx = int(round(kpath[kpi][0] * denominator))
-            ky = int(round(kpath[kpi][1] * denominator))
-            kz = int(round(kpath[kpi][2] * denominator))
-            line = ["{:10}".format(""), "{:5}".format(kx), "{:5}".format(ky), "{:5}".format(kz), "{:5}".format(denominator),
-                    "  2.0", tail]
-            head = ""
-            tail = ""
-            out_ls.append(line)
-
-        with open(f"{self.case}.klist_band", "w") as f:
-            for lines in out_ls:
-                print("".join(lines), file=f)
-            print("END", file=f)
+        write_klist_band(f"{self.case}.klist_band", kpath, denominator)
 
     def calculate_band_normal(self):
         """
@@ -163,8 +208,12 @@ class BaseController:
         :return:
         """
 
+        if self._use_task_parallel("band"):
+            self.set_parallel(klist_path=self._filepath("klist_band"))
         self._make_insp()
+        self._run_band_steps(self._band_steps_normal())
 
+    def _band_steps_normal(self, work_dir=None):
         run_lapw1 = ["x_lapw", "lapw1", "-band"]
         run_spag = ["x_lapw", "spaghetti"]
 
@@ -172,20 +221,25 @@ class BaseController:
             run_lapw1.append("-p")
             run_spag.append("-p")
 
-        self._print_command(run_lapw1)
-        subprocess.run(run_lapw1)
-        self._print_command(run_spag)
-        subprocess.run(run_spag)
+        return [self._step("lapw1", run_lapw1, work_dir=work_dir),
+                self._step("spaghetti", run_spag, deps=["lapw1"], work_dir=work_dir)]
 
     def calculate_band_with_spin(self, only_spin=""):
         """
         スピン偏極を入れたバンド計算
         x_lapw lapw1 [-p] -band [-up or -dn]
         x_lapw spaghetti [-p] [-up or -dn]
+        upとdnは互いに依存しないので、parallel = 1のときは同時に実行される。
+        parallel > 1のとき (-p) は、lapw1paraなどがcaseフォルダの.machines, .processes, 分けたklistを共有するので、
+        upとdnは順に実行され、時間は短くならない。
         :return:
         """
+        if self._use_task_parallel("band"):
+            self.set_parallel(klist_path=self._filepath("klist_band"))
         self._make_insp()
+        self._run_band_steps(self._band_steps_with_spin(only_spin), only_spin=only_spin)
 
+    def _band_steps_with_spin(self, only_spin="", work_dir=None):
         run_lapw1 = ["x_lapw", "lapw1", "-band"]
         run_spag = ["x_lapw", "spaghetti"]
 
@@ -194,30 +248,20 @@ class BaseController:
             run_spag.append("-p")
 
         if only_spin == "":
-            for spin in ["-up", "-dn"]:
-                run_lapw1s = run_lapw1 + [spin]
-
-                if self.U:
-                    run_lapw1s = run_lapw1s + ["-orb"]
-
-                self._print_command(run_lapw1s)
-                subprocess.run(run_lapw1s)
-
-                run_spags = run_spag + [spin]
-                self._print_command(run_spags)
-                subprocess.run(run_spags)
-
+            spin_list = ["-up", "-dn"]
         else:
-            spin = f"-{only_spin}"
+            spin_list = [f"-{only_spin}"]
+
+        steps = []
+        for spin in spin_list:
             run_lapw1s = run_lapw1 + [spin]
             if self.U:
                 run_lapw1s = run_lapw1s + ["-orb"]
-            self._print_command(run_lapw1s)
-            subprocess.run(run_lapw1s)
 
-            run_spags = run_spag + [spin]
-            self._print_command(run_spags)
-            subprocess.run(run_spags)
+            steps.append(self._step(f"lapw1{spin}", run_lapw1s, work_dir=work_dir))
+            steps.append(self._step(f"spaghetti{spin}", run_spag + [spin], deps=[f"lapw1{spin}"], work_dir=work_dir))
+
+        return steps
 
     def calculate_band_with_soc(self):
         """
@@ -228,8 +272,12 @@ class BaseController:
         :return:
         """
 
+        if self._use_task_parallel("band"):
+            self.set_parallel(klist_path=self._filepath("klist_band"))
         self._make_insp()
+        self._run_band_steps(self._band_steps_with_soc())
 
+    def _band_steps_with_soc(self, work_dir=None):
         run_lapw1 = ["x_lapw", "lapw1", "-band"]
         run_lapwso = ["x_lapw", "lapwso"]
         run_spag = ["x_lapw", "spaghetti", "-so"]
@@ -240,34 +288,88 @@ class BaseController:
             run_spag.insert(2, "-p")
 
         if self.spin_pol:
-            run_lapw1s = run_lapw1 + ["-up"]
-            if self.U:
-                run_lapw1s = run_lapw1s + ["-orb"]
-            self._print_command(run_lapw1s)
-            subprocess.run(run_lapw1s)
+            steps = []
+            for spin in ["-up", "-dn"]:
+                run_lapw1s = run_lapw1 + [spin]
+                if self.U:
+                    run_lapw1s = run_lapw1s + ["-orb"]
+                steps.append(self._step(f"lapw1{spin}", run_lapw1s, work_dir=work_dir))
 
-            run_lapw1s = run_lapw1 + ["-dn"]
-            if self.U:
-                run_lapw1s = run_lapw1s + ["-orb"]
-            self._print_command(run_lapw1s)
-            subprocess.run(run_lapw1s)
+            steps.append(self._step("lapwso", run_lapwso + ["-up"], deps=["lapw1-up", "lapw1-dn"], work_dir=work_dir))
+            steps.append(self._step("spaghetti", run_spag + ["-up"], deps=["lapwso"], work_dir=work_dir))
 
-            run_lapwso.append("-up")
-            self._print_command(run_lapwso)
-            subprocess.run(run_lapwso)
+        else:
+            steps = [self._step("lapw1", run_lapw1, work_dir=work_dir),
+                     self._step("lapwso", run_lapwso, deps=["lapw1"], work_dir=work_dir),
+                     self._step("spaghetti", run_spag, deps=["lapwso"], work_dir=work_dir)]
 
-            run_spag.append("-up")
-            subprocess.run(run_spag)
+        return steps
 
-        else:
-            self._print_command(run_lapw1)
-            subprocess.run(run_lapw1)
+    def _band_steps(self, only_spin="", work_dir=None):
+        """
+        spin_polとSOCの設定に合わせてバンド計算のステップを返す。
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        :param work_dir: 計算するフォルダ。k点はそのフォルダのklist_bandで数える。Noneのときはcaseフォルダ
+        :return: Stepのリスト
+        """
+        if self.spin_pol:
+            if self.SOC:
+                return self._band_steps_with_soc(work_dir=work_dir)
+            return self._band_steps_with_spin(only_spin=only_spin, work_dir=work_dir)
+        elif self.SOC:
+            return self._band_steps_with_soc(work_dir=work_dir)
+        return self._band_steps_normal(work_dir=work_dir)
+
+    def _band_outputs(self, only_spin=""):
+        """
+        _band_stepsで書き出される.bands.agrの拡張子のリスト
+        """
+        if self.spin_pol:
+            if self.SOC:
+                return ["bandsup.agr"]
+            if only_spin == "":
+                return ["bandsup.agr", "bandsdn.agr"]
+            return [f"bands{only_spin}.agr"]
+        return ["bands.agr"]
+
+    def use_band_cache(self, cache_dir=None, max_gb=2.0):
+        """
+        バンド計算の結果を保存し、同じklist_bandを同じSCFの結果で計算するときは保存したものを使う。
+        計算を途中からやり直すときや、重なったklistのフォルダを計算するときに使う。
+        :param cache_dir: 保存するフォルダ。Noneのときはcaseフォルダのband_cache
+        :param max_gb: 保存する.bands.agrの合計の上限 (GB)
+        :return:
+        """
+        if cache_dir is None:
+            cache_dir = f"{self.case_path}/band_cache"
+        self.band_cache = BandCache(cache_dir, max_bytes=int(max_gb * 1024 ** 3))
+
+    def _run_band_steps(self, steps, only_spin="", work_dir=None, core_budget=None):
+        """
+        バンド計算のステップを実行する。band_cacheに同じ入力の結果があれば実行せずにそれを使う。
+        :param steps: _band_stepsのステップ
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        :param work_dir: 計算するフォルダ。Noneのときはcaseフォルダ
+        :param core_budget: 同時に使ってよいコア数。Noneのときはself.core_budget
+        :return: {ステップ名: 終了コード}
+        """
+        case_dir = work_dir or self.case_path
+        outputs = self._band_outputs(only_spin)
+
+        key = None
+        if self.band_cache is not None:
+            flags = {"spin_pol": self.spin_pol, "SOC": self.SOC, "U": self.U, "only_spin": only_spin}
+            key = self.band_cache.key(case_dir, self.case, flags)
+            if self.band_cache.get(key, case_dir, self.case, outputs):
+                print(f"Band cache hit : {', '.join(outputs)}")
+                return {step.name: 0 for step in steps}
 
-            self._print_command(run_lapwso)
-            subprocess.run(run_lapwso)
+        results = StepEngine(core_budget or self.core_budget, cwd=work_dir, runner=self.runner).run(steps)
 
-            self._print_command(run_spag)
-            subprocess.run(run_spag)
+        if key is not None and all(r == 0 for r in results.values()):
+            self.band_cache.put(key, case_dir, self.case, outputs)
+
+        return results
 
     def calculate_band_with_orbit(self, outfol, atom_dict):
         """
@@ -313,6 +415,8 @@ class BaseController:
 
         if not outfol.startswith(self.case_path):
             outfol = f"{self.case_path}/{outfol}"
+        if self._use_task_parallel("dos"):
+            self.set_parallel(klist_path=self._filepath("klist"))
 
         run_lapw1 = ["x_lapw", "lapw1"]
         run_lapw2 = ["x_lapw", "lapw2", "-qtl"]
@@ -325,33 +429,21 @@ class BaseController:
             run_lapw1.append("-orb")
 
         if self.spin_pol:
-            for spin in ["-up", "-dn"]:
-                run_lapw1 = run_lapw1 + [spin]
-                self._print_command(run_lapw1)
-                subprocess.run(run_lapw1)
-
-                run_lapw2 = run_lapw2 + [spin]
-                self._print_command(run_lapw2)
-                subprocess.run(run_lapw2)
+            spin_list = ["-up", "-dn"]
         else:
-            self._print_command(run_lapw1)
-            subprocess.run(run_lapw1)
-            self._print_command(run_lapw2)
-            subprocess.run(run_lapw2)
+            spin_list = [""]
 
-        print("run " + " ".join(["configure_int_lapw", "-b"] + int_list))
-        subprocess.run(["configure_int_lapw", "-b"] + int_list)
+        # configure_int_lapwはlapw1, lapw2と独立なので同時に実行できる
+        steps = [self._step("configure_int", ["configure_int_lapw", "-b"] + int_list)]
+        for spin in spin_list:
+            _spin = [spin] if spin else []
+            steps.append(self._step(f"lapw1{spin}", run_lapw1 + _spin))
+            steps.append(self._step(f"lapw2{spin}", run_lapw2 + _spin, deps=[f"lapw1{spin}"]))
+            steps.append(self._step(f"tetra{spin}", run_tetra + _spin, deps=[f"lapw2{spin}", "configure_int"]))
 
-        if self.spin_pol:
-            for spin in ["-up", "-dn"]:
-                run_tetra = run_tetra + [spin]
-                self._print_command(run_tetra)
-                subprocess.run(run_tetra)
-        else:
-            print("run " + " ".join(run_tetra))
-            subprocess.run(run_tetra)
+        self._run_steps(steps)
 
-        subprocess.call(["mkdir", "-p", outfol])
+        ops = self._file_ops().makedirs(outfol)
 
         if self.spin_pol:
             spin_l = ["up", "dn"]
@@ -365,11 +457,13 @@ class BaseController:
                 path = self._filepath(f"dos{str(n)}eV{spin}")
                 savepath = f"{outfol}/{name}.dos{str(n)}eV{spin}"
                 if os.path.exists(path):
-                    subprocess.call(["cp", path, savepath])
+                    ops.copy(path, savepath)
                 else:
                     break
                 n += 1
 
+        ops.run()
+
     def force_stop(self):
         """
         stop.rtfファイルがcaseフォルダにあるとき、計算を強制終了する。
@@ -390,9 +484,7 @@ class BaseController:
         :param orbitnum: 
         :return: 
         """
-        self._make_insp()
-
-        self._mod_insp_weight(atomnum, orbitnum)
+        self._make_insp(weight=(atomnum, orbitnum))
 
         run_lapw1 = ["x_lapw", "lapw1", "-band"]
         run_lapw2 = ["x_lapw", "lapw2", "-band", "-qtl"]
@@ -405,53 +497,33 @@ class BaseController:
 
         # コマンドラインで実行
         if self.spin_pol:
-            for spin in ["-up", "-dn"]:
-                run_lapw1 = run_lapw1 + [spin]
-                run_lapw2 =  run_lapw2 + [spin]
-                run_spag = run_spag + [spin]
-
-                self._print_command(run_lapw1)
-                subprocess.run(run_lapw1)
-
-                self._print_command(run_lapw2)
-                subprocess.run(run_lapw2)
-
-                self._print_command(run_spag)
-                subprocess.run(run_spag)
+            spin_list = ["-up", "-dn"]
         else:
-            self._print_command(run_lapw1)
-            subprocess.run(run_lapw1)
+            spin_list = [""]
 
-            self._print_command(run_lapw1)
-            subprocess.run(run_lapw2)
+        steps = []
+        for spin in spin_list:
+            _spin = [spin] if spin else []
+            steps.append(self._step(f"lapw1{spin}", run_lapw1 + _spin))
+            steps.append(self._step(f"lapw2{spin}", run_lapw2 + _spin, deps=[f"lapw1{spin}"]))
+            steps.append(self._step(f"spaghetti{spin}", run_spag + _spin, deps=[f"lapw2{spin}"]))
 
-            self._print_command(run_lapw1)
-            subprocess.run(run_spag)
+        self._run_steps(steps)
 
     def _mod_insp_weight(self, atom, orb):  # modify insp file
-        path = self._filepath("insp")
-        print(path)
-        with open(path, "r") as f:
-            s = f.readlines()
-
-        for l in range(len(s)):
-            if "jatom, jcol, size" in s[l]:
-                out = s[l].split()
-                out[0] = str(atom)
-                out[1] = str(orb)
-                s[l] = " ".join(out)
-
-        s = "".join(s)
-
-        with open(path, "w") as f:
-            f.write(s)
+        """
+        .inspの重み付きプロットの原子と軌道を変える。
+        """
+        self._make_insp(weight=(atom, orb))
 
     def _save_orbit_band(self, outfol, atomname, orbitname):
+        ops = self._file_ops()
         if self.spin_pol:
-            subprocess.run(["mv", self._filepath(".bandsup.agr"), f"{outfol}/{atomname}_{orbitname}up.bands.agr"])
-            subprocess.run(["mv", self._filepath(".bandsdn.agr"), f"{outfol}/{atomname}_{orbitname}dn.bands.agr"])
+            ops.move(self._filepath(".bandsup.agr"), f"{outfol}/{atomname}_{orbitname}up.bands.agr")
+            ops.move(self._filepath(".bandsdn.agr"), f"{outfol}/{atomname}_{orbitname}dn.bands.agr")
         else:
-            subprocess.run(["mv", self._filepath(".bands.agr"), f"{outfol}/{atomname}_{orbitname}.bands.agr"])
+            ops.move(self._filepath(".bands.agr"), f"{outfol}/{atomname}_{orbitname}.bands.agr")
+        ops.run()
 
     def _filepath(self, ext):
         """
@@ -467,51 +539,98 @@ class BaseController:
         :param ext:
         :return:
         """
-        subprocess.run(["cp", f"{self.temp_path}/case.{ext}", f"{self.case_path}/{self.case}.{ext}"])
-
-    def _make_insp(self):
-        # make .insp file if not exists
-        # if not os.path.exists(self._filepath("insp")):
-        self._cp_from_temp("insp")
-        print(".insp file is copied.")
-
-        with open(f"{self.case}.insp", mode="r") as f:
-            l = f.read()
+        self._file_ops().copy(f"{self.temp_path}/case.{ext}", f"{self.case_path}/{self.case}.{ext}").run()
 
-        l = l.replace("0.xxxx", str(self._get_ef()))
-
-        with open(f"{self.case}.insp", mode="w") as f:
-            f.write(l)
+    def _make_insp(self, weight=None):
+        """
+        テンプレートにEFを入れて.inspを作る。
+        .scfのEFと重みが前に書いたときと同じなら書き直さない。
+        :param weight: 重み付きプロットの(原子の番号, 軌道の番号)。Noneのときはテンプレートのまま
+        :return:
+        """
+        if self.insp.update(self._get_ef(), weight=weight):
+            print(".insp file is made.")
 
-    #  NOT USED
     def _set_ef_insp(self):  # set ef parameter for x_lapw spaghetti
         """
         .inspファイルにEFを入力する。
         :return:
         """
-        self._cp_from_temp("insp")
-        with open(self._filepath("insp"), "r") as f:
-            s = f.read()
-
-        s = s.replace("0.xxxx", str(self._get_ef()))
-
-        with open(self._filepath(".insp"), "w") as f:
-            f.write(s)
+        self._make_insp()
 
     def _get_ef(self):
         """
         .scfファイルからEFを取り出す
         :return: フェルミエネルギー
         """
-        with open(f"{self.case}.scf", "r") as f:
-            line_list = f.readlines()
+        return get_ef(self._filepath("scf"))
+
+    def trace(self, trace_path):
+        """
+        実行する全てのコマンドの時間とリソースをJSONLファイルに記録する。
+        計算ごとにファイルを分け、w2k_trace.print_summaryで集計する。
+        :param trace_path: 記録するファイルのパス
+        :return:
+        """
+        self.runner.trace_path = os.path.abspath(trace_path)
+        print(f"Trace commands to {self.runner.trace_path}")
+
+    def _run(self, com_list, numofk=None, watcher=None):
+        """
+        コマンドをCommandRunnerで実行する。
+        cp, mv, rmなどのファイル操作は_file_opsで行う。
+        :param com_list: コマンドのリスト
+        :param numofk: k点の数。トレースに記録する
+        :param watcher: 実行中に定期的に呼ぶ関数。Trueを返すとコマンドを止める
+        :return: 終了コード
+        """
+        self._print_command(com_list)
+        return self.runner.run(com_list, numofk=numofk, watcher=watcher)
+
+    def _file_ops(self):
+        """
+        サブプロセスを使わずにファイル操作を行うFileOpsを作る。時間はトレースに"file"として記録する。
+        ops = self._file_ops()
+        ops.move(src, dst)
+        ops.run()
+        """
+        return FileOps(self.runner)
 
-        ef = 0
-        for l in line_list:
-            if ":FER" in l:
-                ef = re.findall(r"\d+\.\d+", l)[0]
+    def _numofk(self, command, work_dir=None):
+        """
+        コマンドが計算するk点の数を返す。バンド計算はcase.klist_band、それ以外はcase.klistを数える。
+        :param work_dir: コマンドを実行するフォルダ。Noneのときはcaseフォルダ
+        """
+        ext = "klist_band" if "-band" in command or "spaghetti" in command else "klist"
+        if work_dir is None:
+            return count_kpoints(self._filepath(ext))
+        return count_kpoints(f"{work_dir}/{self.case}.{ext}")
 
-        return ef
+    def _step(self, name, command, deps=(), work_dir=None):
+        """
+        コマンドからStepを作る。
+        -p付きのコマンドはparallel * ompのコアを使い、.machinesを共有するので同時には実行しない。
+        (WIEN2kの並列スクリプトはcaseフォルダに.processesや分けたklistを書くので、同じフォルダではスピンごとに分けられない。
+        upとdnを同時に-pで計算したいときは、WorkerPoolのように別の作業フォルダを使う)
+        :param name: ステップ名
+        :param command: コマンドのリスト
+        :param deps: 依存するステップ名のリスト
+        :param work_dir: コマンドを実行するフォルダ。k点を数えるのに使う
+        :return: Step
+        """
+        numofk = self._numofk(command, work_dir=work_dir)
+        if "-p" in command:
+            cores = self.parallel * max(self.omp, 1)
+            return Step(name, command, deps=deps, cores=cores, locks=["machines"], numofk=numofk)
+        return Step(name, command, deps=deps, numofk=numofk)
+
+    def _run_steps(self, steps):
+        """
+        ステップのグラフを実行する。依存しないステップはcore_budgetの範囲で同時に実行される。
+        :param steps: Stepのリスト
+        :return: {ステップ名: 終了コード}
+        """
+        return StepEngine(self.core_budget, runner=self.runner).run(steps)
 
     def _print_command(self, l):
         """
@@ -556,16 +675,18 @@ class W2kTemplates(BaseController):
         """
         if not os.path.exists(f"{save_dir}/klists"):
             os.makedirs(f"{save_dir}/klists", exist_ok=True)
-        subprocess.run(["mv", f"{self.case}.klist_band", f"{save_dir}/klists/{save_name}.klsit_band"])
+        ops = self._file_ops()
+        ops.move(f"{self.case}.klist_band", f"{save_dir}/klists/{save_name}.klsit_band")
 
         if not os.path.exists(f"{save_dir}/Bands"):
             os.makedirs(f"{save_dir}/Bands")
 
         if self.spin_pol:
             for spin in ["up", "dn"]:
-                subprocess.run(["mv", f"{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr"])
+                ops.move(f"{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr")
         else:
-            subprocess.run(["mv", f"{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr"])
+            ops.move(f"{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr")
+        ops.run()
 
 if __name__ == "__main__":
     case = "ohwada_Au"
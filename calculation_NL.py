@@ -2,20 +2,34 @@ import datetime
 import glob
 import numpy as np
 import os
-import re
-import subprocess
 
+from concurrent.futures import ProcessPoolExecutor
 from email import message
 from email.mime.text import MIMEText
+from itertools import repeat
 import smtplib
 
 from WIEN2k_controller import BaseController
+from w2k_agr import bands_agr_path, read_agr_blocks, read_bands_agr, write_bands_agr
+from w2k_box_union import BoxUnion, volume_points
+from w2k_fermi import InspFile, get_ef
+from w2k_fileops import FileOps
+from w2k_journal import Journal
+from w2k_kbatch import KPointBatches
+from w2k_klist import MAX_VALUE, read_klist_band, write_klist_band, write_klist_files
+from w2k_machines import count_kpoints
+from w2k_npy_stream import NpyAppender, iter_rows
+from w2k_trace import CommandRunner
+
+FIRSTCALCFOLDER = "NL_firstcalc"
+MAXKPOINTS = 900  # 一つの.klist_bandファイルに入れるk点の数。<1000
+CELL_CORNERS = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)])  # 立方体のセルの８つの角
 
 
 class NLFirstCalculation:
     """
     初めに指定さてた分割数で３D空間を荒く計算する.
-    FIRSTCALCFOLDERにstop.rtfを入れるとそのサイクルで終了する。
+    FIRSTCALCFOLDERにstop.rtfを入れると実行中のコマンドを止めて終了する。
     """
 
     def __init__(self, case):
@@ -24,9 +38,11 @@ class NLFirstCalculation:
         self.w2k_path = "/Users/hb_wien2k/WIEN2k/"
         self.case_path = self.w2k_path + self.case + "/"
         self.temp_path = '/usr/local/WIEN2k_19.1/SRC_templates/'  # template file path
+        self.insp = InspFile(self.temp_path + 'case.insp', self._filepath('.insp'))
 
         self.para = 1
         self.spol = 0  # spin偏極計算
+        self.runner = CommandRunner()  # コマンドの時間を記録する。runner.trace_pathを設定するとファイルに書く
 
         os.chdir(self.case_path)
 
@@ -42,25 +58,18 @@ class NLFirstCalculation:
         :return:
         """
 
-        output_name = f"{self.case}.klist_band"
+        write_klist_band(f"{self.case}.klist_band", kpath, d)
 
-        out_ls = []
-        tail = '-8.00 8.00'
-
-        for kpi in range(len(kpath)):
-            kx = int(round(kpath[kpi][0] * d))
-            ky = int(round(kpath[kpi][1] * d))
-            kz = int(round(kpath[kpi][2] * d))
-            line = ['{:10}'.format(''), '{:5}'.format(kx), '{:5}'.format(ky), '{:5}'.format(kz), '{:5}'.format(d),
-                    '  2.0', tail]
-            head = ''
-            tail = ''
-            out_ls.append(line)
-
-        with open(output_name, 'w') as f:
-            for lines in out_ls:
-                print(''.join(lines), file=f)
-            print('END', file=f)
+    @staticmethod
+    def _row_kpath(ky, kz, d):
+        """
+        :return: (ky, kz)の行のk点(<1)の配列 [[kx / d, ky / d, kz / d], ...] (kx = 0, ..., d)
+        """
+        kpath = np.empty((d + 1, 3))
+        kpath[:, 0] = np.arange(d + 1)
+        kpath[:, 1] = ky
+        kpath[:, 2] = kz
+        return kpath / d
 
     def _calculate_band(self, spin):  # calculate band dispersion
         """
@@ -87,85 +96,81 @@ class NLFirstCalculation:
                 run_lapw1s = run_lapw1 + [f"-{s}"]
                 run_spags = run_spag + [f"-{s}"]
 
-                print('run ' + ' '.join(run_lapw1s))
-                subprocess.run(run_lapw1s)
-
-                print('run ' + ' '.join(run_spags))
-                subprocess.run(run_spags)
+                self._run(run_lapw1s)
+                self._run(run_spags)
         else:
-            print('run ' + ' '.join(run_lapw1))
-            subprocess.run(run_lapw1)
+            self._run(run_lapw1)
+            self._run(run_spag)
+
+    def _run(self, com_list):
+        """
+        コマンドをCommandRunnerで実行する。FIRSTCALCFOLDERにstop.rtfが入ると実行中のコマンドを止める。
+        """
+        print('run ' + ' '.join(com_list))
+        return self.runner.run(com_list, numofk=count_kpoints(self._filepath(".klist_band")), watcher=self._stop_requested)
 
-            print('run ' + ' '.join(run_spag))
-            subprocess.run(run_spag)
+    def _stop_requested(self):
+        return os.path.exists(f"{self.case_path}{FIRSTCALCFOLDER}/stop.rtf")
 
-    def _save(self, ky, kz, spin):
+    def _save(self, rows, d, spin):
         """
-        .klist_bandと.bands.agrを/kxkykz_{kz}/ky_{ky}に保存する
+        まとめて計算した.bands.agrを行 (ky, kz) ごとに分け、.klist_bandと.bands.agrを/kxkykz_{kz}/ky_{ky}に保存する
+        :param rows: .klist_bandに入れた行のリスト [(ky, kz), ...]。各行はkx = 0, ..., dのd+1点
         """
+        agr_paths = {s: self._filepath(f".bands{s}.agr") for s in spin} if self.spol else {"dn": self._filepath(".bands.agr")}
+        agrs = {s: read_agr_blocks(path) for s, path in agr_paths.items()}
 
-        klistfol = f"{self.outout_folder_name}/kxkykz_{kz}/klists"
-        if not os.path.exists(klistfol):
-            os.makedirs(klistfol)
+        for n, (ky, kz) in enumerate(rows):
+            klistfol = f"{self.outout_folder_name}/kxkykz_{kz}/klists"
+            bandfol = f"{self.outout_folder_name}/kxkykz_{kz}/bands"
+            os.makedirs(klistfol, exist_ok=True)
+            os.makedirs(bandfol, exist_ok=True)
 
-        bandfol = f"{self.outout_folder_name}/kxkykz_{kz}/bands"
-        if not os.path.exists(bandfol):
-            os.makedirs(bandfol)
+            filename = f"ky_{ky}"
+            write_klist_band(f"{klistfol}/{filename}.klist_band", self._row_kpath(ky, kz, d), d)
 
-        filename = f"ky_{ky}"
+            row = slice(n * (d + 1), (n + 1) * (d + 1))
+            for s, (header, prefix, _, values) in agrs.items():
+                # k点の距離は行の最初の点を0にする
+                distance = values[0, row, 0] - values[0, row.start, 0]
+                write_bands_agr(f"{bandfol}/{filename}{s}.bands.agr", header, prefix, distance, values[:, row, 1:])
 
-        if self.spol:
-            subprocess.run(["mv", self._filepath(".klist_band"), f"{klistfol}/{filename}.klist_band"])
-            for s in spin:
-                subprocess.run(["mv", self._filepath(f".bands{s}.agr"), f"{bandfol}/{filename}{s}.bands.agr"])
-        else:
-            subprocess.run(["mv", self._filepath(".klist_band"), f"{klistfol}/{filename}.klist_band"])
-            subprocess.run(["mv", self._filepath(".bands.agr"), f"{bandfol}/{filename}dn.bands.agr"])
+        ops = FileOps().remove(self._filepath(".klist_band"))
+        for path in agr_paths.values():
+            ops.remove(path)
+        ops.run()
 
     def _filepath(self, ext):  # return full path of file with extention
         return self.case_path + self.case + ext
 
     def _cp_from_temp(self, ext):  # copy template file with extension
-        subprocess.call(['cp', self.temp_path + 'case' + ext, self.case_path + self.case + ext])
+        FileOps().copy(self.temp_path + 'case' + ext, self.case_path + self.case + ext).run()
 
     def _get_ef(self):
-        with open(self.case + ".scf2", "r") as f:
-            line_list = f.readlines()
-
-        for l in line_list:
-            l = l.split(" ")
-            if l[0] == ":FER":
-                ef = float(l[len(l) - 1])
-                break
-            else:
-                ef = "NaN"
-
-        return ef
+        return get_ef(self._filepath(".scf"))
 
     def _set_ef_insp(self):  # set ef parameter for x_lapw spaghetti
-        self._cp_from_temp('.insp')
-        with open(self._filepath('.insp'), 'r') as f:
-            s = f.read()
-
-        s = s.replace('0.xxxx', str(self._get_ef()))
-
-        with open(self._filepath('.insp'), 'w') as f:
-            f.write(s)
+        self.insp.update(self._get_ef())
 
     def first_calculation(self, d=200, spin = ["up", "dn"]):
-        stop_flag = 0
-        for kz in range(d+1):
-            for ky in range(d+1):
-                kpath = [[kx / d, ky / d, kz / d] for kx in range(d+1)]
-                self._make_klist_band(kpath=kpath, d=d)
-                self._calculate_band(spin)
-                self._save(ky, kz, spin)
-                if os.path.exists(f"{FIRSTCALCFOLDER}/stop.rtf"):
-                    stop_flag = 1
-                    break
+        """
+        (ky, kz)の行をMAXKPOINTS点までまとめて１つの.klist_bandにし、lapw1の回数を減らす。
+        結果は今までと同じく行ごとのファイルに分けて保存する。
+        """
+        rows = [(ky, kz) for kz in range(d + 1) for ky in range(d + 1)]
+        numofrows = max(1, MAXKPOINTS // (d + 1))
 
-            if stop_flag:
+        for i in range(0, len(rows), numofrows):
+            batch = rows[i:i + numofrows]
+            kpath = np.concatenate([self._row_kpath(ky, kz, d) for ky, kz in batch])
+            self._make_klist_band(kpath=kpath, d=d)
+            self._calculate_band(spin)
+            if self._stop_requested():
+                # 止めたコマンドの.bands.agrは途中までなので保存しない
+                print("Force stop!!!!")
                 break
+            self._save(batch, d, spin)
+            print(f"{i + len(batch)}/{len(rows)} rows are calculated.")
 
 
 class NLAnalysisFirstCalculation:
@@ -187,56 +192,27 @@ class NLAnalysisFirstCalculation:
 
     def _load_files(self, ky, kz, spin=""):
         """
-        .klist_bandと.band_agrを読みリストを返す
-        :return:
+        .klist_bandと.band_agrを読み配列を返す
+        :return: (k点 (nk, 3), エネルギー (nbands, nk))
         """
         klist_file_path = f"kxkykz_{kz}/klists/ky_{ky}.klist_band"
-        with open(klist_file_path, mode="r") as f:
-            klist_lines = f.readlines()
+        kpath = read_klist_band(klist_file_path)[:, :3].astype(np.int32)
 
-        band_file_path = f"kxkykz_{kz}/bands/ky_{ky}{spin}.bands.agr"
-        with open(band_file_path, mode="r") as f:
-            bands_lines = f.readlines()
+        _, energies = read_bands_agr(bands_agr_path(f"kxkykz_{kz}/bands", f"ky_{ky}", spin))
 
-        return klist_lines, bands_lines
+        return kpath, energies
 
-    def _make_bands_dict(self, klist_lines, band_lines):
+    def _make_bands_dict(self, kpath, energies):
         """
-        _load_files()で読んだファイルの中身から、kpathと
+        _load_files()で読んだ配列から、kpathと
         band_indexで指定されたバンド番号とひとつインデックスが大いバンドをarrayの形にして辞書型で返す。
         :return: {kpath: array([]), band{band_index}: array([]), band{band_index+1}: array([])}
         """
 
-        bands_dict = {}
-
-        klist_array = np.array([])
-
-        for line in klist_lines:
-            _line_nums = re.findall(r"\d+", line)
-            _line_array = np.array(_line_nums[:3], dtype=float)
-            klist_array = np.append(klist_array, _line_array)
-
-        klist_array = klist_array.reshape(len(klist_lines) - 1, 3)
-        bands_dict["kpath"] = klist_array
-
-        bandis = [self.band_index, self.band_index + 1]
-
-        for bandi in bandis:
-            for i, line in enumerate(band_lines):
-                if "bandindex:" in line:
-                    _band_num = float(re.findall(r"\d+", line)[0])
-                    if _band_num == bandi:
-                        linenum = i
-                        break
-
-            _band_array = np.array([])
-            for l in band_lines[linenum + 1:]:
-                if "&" in l:
-                    break
-                _eng = float(re.findall(r"[\-]*\d+\.\d+", l)[1])
-                _band_array = np.append(_band_array, _eng)
+        bands_dict = {"kpath": kpath}
 
-            bands_dict[f"band{bandi}"] = _band_array
+        for bandi in [self.band_index, self.band_index + 1]:
+            bands_dict[f"band{bandi}"] = energies[bandi - 1]
 
         return bands_dict
 
@@ -253,49 +229,67 @@ class NLAnalysisFirstCalculation:
         """
         エネルギー分裂がenergy_split_cut以下であるk点をarray型で出力
         """
-        degen_klist = np.array([])
-        for i, split in enumerate(bands_dict['engsplit']):
-            if split <= self.energy_split_cut:
-                degen_klist = np.append(degen_klist, bands_dict["kpath"][i])
-
-        degen_klist = degen_klist.reshape((int(degen_klist.shape[0] / 3), 3))
-
-        return degen_klist
+        return bands_dict["kpath"][bands_dict["engsplit"] <= self.energy_split_cut]
 
     def _save_as_npy(self, ky, kz, degen_klist, spin=""):
         """
         degen_klistsフォルダを作って、縮退しているk点を.npyファイルで保存
         """
-        if not os.path.exists(f"kxkykz_{kz}/degen_klists"):
-            os.makedirs(f"kxkykz_{kz}/degen_klists")
+        os.makedirs(f"kxkykz_{kz}/degen_klists", exist_ok=True)
 
         save_path = f"kxkykz_{kz}/degen_klists/ky_{ky}{spin}"
         np.save(save_path, degen_klist)
 
-    def do_analysis(self, d=100, spin=[""]):
+    def _analyse_slab(self, kz, d, spin, vol_path):
+        """
+        kxkykz_{kz}の全てのkyを解析し、縮退しているk点をメモリマップしたボリュームデータに書く。
+        kzごとに別のプロセスで実行できる。
+        :param vol_path: do_analysisで作ったdegen_klist_vol*.npy
+        :return: 縮退しているk点 (n, 3)。ky, .klist_bandの順
+        """
+        degen_klists = []
+        for ky in range(d + 1):
+            kpath, energies = self._load_files(ky, kz, spin=spin)
+            bands_dict = self._make_bands_dict(kpath, energies)
+            bands_dict = self._calc_energy_split(bands_dict)
+            degen_klist = self._make_degen_array(bands_dict)
+            self._save_as_npy(ky, kz, degen_klist, spin=spin)
+            degen_klists.append(degen_klist)
+        degen_klist = np.concatenate(degen_klists) if degen_klists else np.zeros((0, 3), dtype=np.int32)
+
+        # k点は(0, d)の整数なので、そのままボリュームのインデックスにする
+        # 各プロセスは自分のkzの面にだけ書くので、ロックはいらない
+        vol = np.load(vol_path, mmap_mode="r+")
+        index = degen_klist.astype(np.int64)
+        vol[index[:, 0], index[:, 1], index[:, 2]] = 1
+        vol.flush()
+        del vol
+
+        return degen_klist
+
+    def do_analysis(self, d=100, spin=[""], workers=1):
         """
         外で実行する関数。
         各関数の実行と、縮退している全てのk点が入った.npyファイル、縮退しているk点に１を入れた3Dk空間を見立てたボリュームデータを出力する。
+        :param workers: 1より大きいとき、kxkykz_{kz}をworkers個のプロセスに分けて解析する。結果はworkers=1と同じ
         """
         for s in spin:
-            degen_klist_all = np.array([])
-            for kz in range(d + 1):
-                for ky in range(d + 1):
-                    klist_lines, bands_lines = self._load_files(ky, kz, spin=s)
-                    bands_dict = self._make_bands_dict(klist_lines, bands_lines)
-                    bands_dict = self._calc_energy_split(bands_dict)
-                    degen_klist = self._make_degen_array(bands_dict)
-                    self._save_as_npy(ky, kz, degen_klist, spin=s)
-                    degen_klist_all = np.append(degen_klist_all, degen_klist)
-
-            degen_klist_all = degen_klist_all.reshape((int(degen_klist_all.shape[0] / 3), 3))
-            np.save(f"degen_klist_all{self.band_index}{s}", degen_klist_all)
-
-            degen_klist_vol = np.zeros((d + 1, d + 1, d + 1))
-            for k in degen_klist_all:
-                _kx, _ky, _kz = int(k[0]), int(k[1]), int(k[2])
-                degen_klist_vol[_kx, _ky, _kz] = 1
-            np.save(f"degen_klist_vol{self.band_index}{s}", degen_klist_vol)
+            vol_path = f"degen_klist_vol{self.band_index}{s}.npy"
+            np.lib.format.open_memmap(vol_path, mode="w+", dtype=np.uint8, shape=(d + 1, d + 1, d + 1)).flush()
+
+            args = (range(d + 1), repeat(d), repeat(s), repeat(vol_path))
+            # degen_klist_allはkzの板ごとに書き足し、全体をメモリに持たない
+            with NpyAppender(f"degen_klist_all{self.band_index}{s}.npy", np.int32, 3) as degen_klist_all:
+                if workers > 1:
+                    with ProcessPoolExecutor(max_workers=workers) as pool:
+                        # mapはkzの順に結果を返すので、つなげる順番はworkers=1と同じになる
+                        for degen_klist in pool.map(self._analyse_slab, *args):
+                            degen_klist_all.append(degen_klist)
+                else:
+                    for degen_klist in map(self._analyse_slab, *args):
+                        degen_klist_all.append(degen_klist)
+
+            print(f"{degen_klist_all.numofrows} degenerate k-points are found for spin '{s}'.")
 
 
 class NLMakeNLKlist:
@@ -322,96 +316,72 @@ class NLMakeNLKlist:
         """
         degen_klist_all{self.band_index}{spin}.npyを読み込む。
         degen_klist_vol{self.band_index}{spin}.npyを読み込む。
+        どちらもメモリマップで開くので、ここではメモリに読まない。
         :return:
         """
         path = f"{FIRSTCALCFOLDER}/degen_klist_all{self.band_index}{self.spin}.npy"
-        degen_klist_all = np.load(path)
+        degen_klist_all = np.load(path, mmap_mode="r")
 
         path = f"{FIRSTCALCFOLDER}/degen_klist_vol{self.band_index}{self.spin}.npy"
-        degen_klist_vol = np.load(path)
+        degen_klist_vol = np.load(path, mmap_mode="r")
 
         return degen_klist_all, degen_klist_vol
 
     def _make_NL_vol(self, degen_klist_all, degen_klist_vol):
         """
-        degen_klist_volと同様の位置に１が入ったボリュームデータを作る
-        """
-
-        large_vol = np.zeros((self.numofk + 1, self.numofk + 1, self.numofk + 1), dtype="uint8")
-
-        degen_klist_all_ratio = degen_klist_all / degen_klist_vol.shape[0]
-        large_klist_all = degen_klist_all_ratio * large_vol.shape[0]
-
-        large_klist_all = large_klist_all.astype(np.int64)
-
-        i = 1
-        for _l, _m, _n in zip(large_klist_all.T[0], large_klist_all.T[1], large_klist_all.T[2]):
-            print(f"{round(i/degen_klist_all.shape[0] * 100, 2)} %")
-            if self._pass_same_value([_l, _m, _n]):
-                large_vol = self._make_margin(large_vol, _l, _m, _n)
-            i += 1
+        degen_klist_volと同様の位置の点の周りにマージンをつけた領域を作る。
+        ボリュームデータは作らず、BoxUnionで立方体の端だけを持つ。
+        """
+        size = self.numofk + 1
+        # degen_klist_allは少しずつ読んで、重なった点を除きながら集める
+        seeds = []
+        for _, degen_klist in iter_rows(degen_klist_all):
+            large_klist = (degen_klist / degen_klist_vol.shape[0] * size).astype(np.int64).reshape(-1, 3)
+            # kx = ky = kzの点は使わない
+            large_klist = large_klist[~((large_klist[:, 0] == large_klist[:, 1])
+                                        & (large_klist[:, 1] == large_klist[:, 2]))]
+            seeds.append(np.unique(large_klist, axis=0))
+        seeds = np.unique(np.concatenate(seeds), axis=0) if seeds else np.zeros((0, 3), dtype=np.int64)
+        large_vol = BoxUnion(size, seeds, self.margin)
+        print(f"{len(large_vol)} seeds with margin {self.margin} : {large_vol.count()} k-points")
 
         if not os.path.exists(f"NL_main/klists{self.band_index}"):
             os.makedirs(f"NL_main/klists{self.band_index}")
 
-        np.save(f"{self.case_path}/NL_main/large_vol", large_vol)
+        large_vol.save(f"{self.case_path}/NL_main/large_vol")
 
         return large_vol
 
-    def _make_margin(self, large_vol, l, m, n):
-        """
-        設定したマージンの領域に1を付け足す。
-        """
-        mar = self.margin
-        l0, l1 = self._marge_bound(l, mar, self.numofk)
-        n0, n1 = self._marge_bound(n, mar, self.numofk)
-        m0, m1 = self._marge_bound(m, mar, self.numofk)
-
-        for _l in range(l0, l1 + 1):
-            for _m in range(m0, m1 + 1):
-                for _n in range(n0, n1 + 1):
-                    large_vol[_l, _m, _n] = 1
-
-        return large_vol
-
-    def _marge_bound(self, i, mar, max):
-        """
-        0以下やボリュームのサイズを超えるようなインデックスを避ける
-        """
-        if i - mar >= 0:
-            i0 = i - mar
-        else:
-            i0 = 0
-
-        if i + mar <= max:
-            i1 = i + mar
-        else:
-            i1 = max
-
-        return int(i0), int(i1)
-
     def _vol_to_klist_band(self, large_vol):
         """
-        ボリュームデータの１が入っているインデックスをk点として.klist_bandファイルを作る。
-        ひとつの.klist_bandファイルに900点のk点を入れる。
+        領域の点をk点として.klist_bandファイルを作る。
+        ひとつの.klist_bandファイルにMAXKPOINTS点のk点を入れ、最後の余りもファイルにする。
         対体格の点は削除
+        :param large_vol: BoxUnion、またはボリュームデータ (kx, ky, kz)
+        :return: 作ったファイルの数
         """
-
-        _kpath = []
-        _numofklist = 0
-        for _kz in range(large_vol.shape[2]):
-            for _ky in range(large_vol.shape[1]):
-                for _kx in range(large_vol.shape[0]):
-                    if large_vol[_kx, _ky, _kz] and self._pass_same_value([_kx, _ky, _kz]):
-                        _kpath.append([_kx, _ky, _kz])
-
-                        if len(_kpath) == MAXKPOINTS:
-                            self._make_klist_band(_kpath, _numofklist, d=int(self.numofk))
-                            _numofklist += 1
-                            _kpath = []
-
-    def _pass_same_value(self, l):
-        return len(list(set(l))) != 1
+        if isinstance(large_vol, BoxUnion):
+            chunks = large_vol.points(chunk=MAXKPOINTS * 1024)
+        else:
+            chunks = volume_points(large_vol, chunk=MAXKPOINTS * 1024)
+
+        path_format = f"NL_main/klists{self.band_index}/klist{{}}.klist_band"
+        d = int(self.numofk)
+        rest = np.zeros((0, 3), dtype=np.int64)
+        numofklist = 0
+        for points in chunks:
+            points = np.concatenate([rest, points])
+            full = len(points) // MAXKPOINTS * MAXKPOINTS
+            k = np.column_stack([points[:full], np.full(full, d)])
+            numofklist += write_klist_files(path_format, k, MAXKPOINTS, start=numofklist)
+            rest = points[full:]
+
+        if len(rest):
+            self._make_klist_band(rest, numofklist, d=d)
+            numofklist += 1
+
+        print(f"{numofklist} klist_band files are made in NL_main/klists{self.band_index}.")
+        return numofklist
 
     def _make_klist_band(self, kpath: list, numofklist, d: int):
         """
@@ -423,24 +393,9 @@ class NLMakeNLKlist:
         """
 
         output_name = f"NL_main/klists{self.band_index}/klist{numofklist}.klist_band"
-
-        out_ls = []
-        tail = '-8.00 8.00'
-
-        for kpi in range(len(kpath)):
-            kx = int(round(kpath[kpi][0]))
-            ky = int(round(kpath[kpi][1]))
-            kz = int(round(kpath[kpi][2]))
-            line = ['{:10}'.format(''), '{:5}'.format(kx), '{:5}'.format(ky), '{:5}'.format(kz), '{:5}'.format(d),
-                    '  2.0', tail]
-            head = ''
-            tail = ''
-            out_ls.append(line)
-
-        with open(output_name, 'w') as f:
-            for lines in out_ls:
-                print(''.join(lines), file=f)
-            print('END', file=f)
+        # kpathはボリュームのインデックス (×dの整数) なので、そのまま書く
+        k = np.rint(np.asarray(kpath, dtype=float).reshape(-1, 3)).astype(np.int64)
+        write_klist_band(output_name, np.column_stack([k, np.full(len(k), d)]))
 
     def make_NL_klists(self):
         degen_klist_all, degen_klist_vol = self._load_degen_klist()
@@ -459,12 +414,14 @@ class NLMainCalculation:
 
         self.para = 1
         self.spol = 0
+        self.runner = CommandRunner()  # コマンドの時間を記録する。runner.trace_pathを設定するとファイルに書く
 
         self.klists_dir = "NL_main"
 
         self.w2k_path = "/Users/hb_wien2k/WIEN2k/"
         self.case_path = self.w2k_path + self.case
         self.temp_path = '/usr/local/WIEN2k_19.1/SRC_templates/'  # template file path
+        self.insp = InspFile(self.temp_path + 'case.insp', self._filepath('.insp'))
 
         os.chdir(self.case_path)
 
@@ -474,7 +431,7 @@ class NLMainCalculation:
     def _copy_klist_to_case(self, i, spin):
         # klist_path = f"{self.case_path}/{self.klists_dir}/kxkykz_{kz}/ky_{ky}{spin}.klist_band"
         klist_path = f"{self.case_path}/{self.klists_dir}/klist_{i}.klist_band"
-        subprocess.run(["cp", f"{klist_path}", f"{self.case_path}/{self.case}.klist_band"])
+        FileOps().copy(klist_path, f"{self.case_path}/{self.case}.klist_band").run()
 
     def _calculate_band(self, spin):  # calculate band dispersion
         """
@@ -499,44 +456,32 @@ class NLMainCalculation:
             run_lapw1s = run_lapw1 + [f"-{spin}"]
             run_spags = run_spag + [f"-{spin}"]
 
-            print('run ' + ' '.join(run_lapw1s))
-            subprocess.run(run_lapw1s)
-
-            print('run ' + ' '.join(run_spags))
-            subprocess.run(run_spags)
+            self._run(run_lapw1s)
+            self._run(run_spags)
         else:
-            print('run ' + ' '.join(run_lapw1))
-            subprocess.run(run_lapw1)
+            self._run(run_lapw1)
+
+    def _run(self, com_list):
+        """
+        コマンドをCommandRunnerで実行する。FIRSTCALCFOLDERにstop.rtfが入ると実行中のコマンドを止める。
+        """
+        print('run ' + ' '.join(com_list))
+        return self.runner.run(com_list, numofk=count_kpoints(self._filepath(".klist_band")), watcher=self._stop_requested)
+
+    def _stop_requested(self):
+        return os.path.exists(f"{self.case_path}/{FIRSTCALCFOLDER}/stop.rtf")
 
     def _filepath(self, ext):  # return full path of file with extention
-        return self.case_path + self.case + ext
+        return f"{self.case_path}/{self.case}{ext}"
 
     def _cp_from_temp(self, ext):  # copy template file with extension
-        subprocess.call(['cp', self.temp_path + 'case' + ext, self.case_path + self.case + ext])
+        FileOps().copy(self.temp_path + 'case' + ext, self.case_path + self.case + ext).run()
 
     def _get_ef(self):
-        with open(self.case + ".scf", "r") as f:
-            line_list = f.readlines()
-
-        for l in line_list:
-            l = l.split(" ")
-            if l[0] == ":FER":
-                ef = float(l[len(l) - 1])
-                break
-            else:
-                ef = "NaN"
-
-        return ef
+        return get_ef(self._filepath(".scf"))
 
     def _set_ef_insp(self):  # set ef parameter for x_lapw spaghetti
-        self._cp_from_temp('.insp')
-        with open(self._filepath('.insp'), 'r') as f:
-            s = f.read()
-
-        s = s.replace('0.xxxx', str(self._get_ef()))
-
-        with open(self._filepath('.insp'), 'w') as f:
-            f.write(s)
+        self.insp.update(self._get_ef())
 
     def _save_band(self, i, spin):
         """
@@ -549,9 +494,9 @@ class NLMainCalculation:
         filename = f"band_{i}"
 
         if spin != "":
-            subprocess.run(["mv", f"{self.case_path}/{self.case}.bands{spin}.agr", f"{bandfol}/{filename}{spin}.bands.agr"])
+            FileOps().move(f"{self.case_path}/{self.case}.bands{spin}.agr", f"{bandfol}/{filename}{spin}.bands.agr").run()
         else:
-            subprocess.run(["mv", f"{self.case_path}/{self.case}.bands.agr", f"{bandfol}/{filename}.bands.agr"])
+            FileOps().move(f"{self.case_path}/{self.case}.bands.agr", f"{bandfol}/{filename}.bands.agr").run()
 
     def caluclate_NL(self):
         stop_flag = 0
@@ -563,10 +508,11 @@ class NLMainCalculation:
             for i in range(numofklists):
                 self._copy_klist_to_case(i+1, s)
                 self._calculate_band(s)
-                self._save_band(i+1, s)
-                if os.path.exists(f"{FIRSTCALCFOLDER}/stop.rtf"):
+                if self._stop_requested():
+                    # 止めたコマンドの.bands.agrは途中までなので保存しない
                     stop_flag = 1
                     break
+                self._save_band(i+1, s)
 
             if stop_flag:
                 break
@@ -596,20 +542,23 @@ class NLCalculation(BaseController):
         klist_folder = f"{data_folder}/klists"
         klists = os.listdir(klist_folder)  # get klist file names as list
         klists.sort(reverse=False)
-        for klist in klists:
-            if "klist_band" in klist:
-                # copy klist_band file from klist_folder
-                subprocess.run(["cp", f"{klist_folder}/{klist}", f"{self.case}.klist_band"])
-                base_name = klist.split(".")[0]
+        klists = [(klist.split(".")[0], f"{klist_folder}/{klist}") for klist in klists if "klist_band" in klist]
 
-                # out_folder = f"{data_folder}/Bands/{base_name}"
-                for spin in self.spin:
-                    if self.spin_pol:
-                        self._calculate_band_one_spin(spin)
-                    else:
-                        self.calculate_band_normal()
+        # 終わったklistは{data_folder}/journal.jsonlに記録し、やり直したときは飛ばす
+        journal = Journal(data_folder, total=len(klists))
+        for base_name, klist_path in journal.pending(klists, lambda name: self._result_paths(data_folder, name)):
+            # copy klist_band file from klist_folder
+            self._file_ops().copy(klist_path, f"{self.case}.klist_band").run()
 
-                self._save_result(data_folder, base_name)
+            # out_folder = f"{data_folder}/Bands/{base_name}"
+            for spin in self.spin:
+                if self.spin_pol:
+                    self._calculate_band_one_spin(spin)
+                else:
+                    self.calculate_band_normal()
+
+            self._save_result(data_folder, base_name)
+            journal.record(base_name, klist_path, self._result_paths(data_folder, base_name))
 
             self.force_stop()
 
@@ -629,19 +578,150 @@ class NLCalculation(BaseController):
             run_lapw1.append("-p")
             run_spag.append("-p")
 
-        self._print_command(run_lapw1)
-        subprocess.run(run_lapw1)
+        self._run(run_lapw1)
+
+        self._run(run_spag)
 
-        self._print_command(run_spag)
-        subprocess.run(run_spag)
+    def _result_paths(self, data_folder: str, base_name: str):
+        return [f"{data_folder}/Bands/{base_name}{spin}.bands.agr" for spin in self.spin]
 
     def _save_result(self, data_folder: str, base_name: str):
         save_dir = f"{data_folder}/Bands"
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
+        ops = self._file_ops()
         for spin in self.spin:
-            subprocess.run(["mv", f"{self.case}.bands{spin}.agr", f"{save_dir}/{base_name}{spin}.bands.agr"])
+            ops.move(f"{self.case}.bands{spin}.agr", f"{save_dir}/{base_name}{spin}.bands.agr")
+        ops.run()
+
+
+class NLAdaptiveCalculation(BaseController):
+    """
+    粗い格子から始めて、バンドband_indexとband_index+1の分裂が小さいセルだけを８つに分けて細かくしていく。
+    ノーダルラインは線なので、計算するk点の数は細かさの３乗ではなく、だいたい線の長さに比例する。
+
+    k点は一番細かい格子の整数 (分母 d = numofk0 * 2**levels) で表す。
+    セルの８つの角の分裂の最小値が、energy_split_cut + safety * (角の分裂の最大値 - 最小値) 以下ならセルを分ける。
+    （分裂がセルの中で角の値から線形に変わるとしたときに、energy_split_cut以下になりうるセル）
+
+    {data_folder}/level{l}に各レベルの新しいk点をKPointBatchesでまとめて計算し、
+    {data_folder}/gaps.npzに全てのk点の分裂を、{data_folder}/nodal_points.npyにenergy_split_cut以下のk点を保存する。
+    止まったときは、同じ設定でもう一度実行すると終わったklistを飛ばす。
+
+    nla = NLAdaptiveCalculation(case, band_index=25, spin="dn")
+    nla.search("NL_adaptive", numofk=50000)
+    """
+
+    def __init__(self, case, band_index, spin=""):
+        super().__init__(case)
+        self.band_index = band_index
+        self.spin = spin
+        self.spin_pol = 0 if spin == "" else 1
+
+        self.energy_split_cut = 0.01
+        self.safety = 1.0
+        self.numofk0 = 20  # 最初の格子の分割数
+        self.skip_diagonal = True  # kx = ky = kzの点は計算しない
+
+        os.chdir(self.case_path)
+
+    def search(self, data_folder: str, numofk=50000):
+        """
+        :param numofk: 一番細かい格子の分割数の目安。numofk0 * 2**levels >= numofkになるようにlevelsを決める
+        :return: (k点 (n, 3) のint配列, 分裂 (n,), 分母)
+        """
+        levels = max(0, int(np.ceil(np.log2(numofk / self.numofk0))))
+        d = self.numofk0 * 2 ** levels
+        if d > MAX_VALUE:
+            raise ValueError(f"d = {d} does not fit in the klist_band format. Use a smaller numofk.")
+
+        os.makedirs(data_folder, exist_ok=True)
+        self.d = d
+        self.points = np.zeros((0, 3), dtype=np.int64)
+        self.gaps = np.zeros(0)
+
+        step = 2 ** levels
+        axis = np.arange(self.numofk0) * step
+        cells = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        for level in range(levels + 1):
+            corners = (cells[:, None, :] + CELL_CORNERS * step).reshape(-1, 3)
+            numofnew = self._calculate_points(f"{data_folder}/level{level}", np.unique(corners, axis=0))
+
+            corner_gaps = self._lookup(corners).reshape(-1, 8)
+            # 計算していない角 (kx = ky = kz) は除く
+            low = np.where(np.isnan(corner_gaps), np.inf, corner_gaps).min(axis=1)
+            high = np.where(np.isnan(corner_gaps), -np.inf, corner_gaps).max(axis=1)
+            active = low <= self.energy_split_cut + self.safety * (high - low)
+            print(f"Level {level} : step {step}/{d}, {numofnew} new k-points, {active.sum()}/{len(cells)} cells refined")
+
+            np.savez(f"{data_folder}/gaps.npz", points=self.points, gaps=self.gaps, d=d)
+            if level == levels or not active.any():
+                break
+
+            step //= 2
+            cells = (cells[active][:, None, :] + CELL_CORNERS * step).reshape(-1, 3)
+
+        nodal = self.points[self.gaps <= self.energy_split_cut]
+        np.save(f"{data_folder}/nodal_points", nodal)
+        print(f"{len(self.points)} k-points are calculated. {len(nodal)} k-points have a split <= {self.energy_split_cut}.")
+
+        return self.points, self.gaps, d
+
+    def _keys(self, points):
+        n = self.d + 1
+        return (points[:, 0] * n + points[:, 1]) * n + points[:, 2]
+
+    def _find(self, points):
+        """
+        :return: (self.pointsの中の位置, 見つかったか)。見つからない点の位置は使わない
+        """
+        if len(self.points) == 0:
+            return np.zeros(len(points), dtype=np.int64), np.zeros(len(points), dtype=bool)
+
+        known = self._keys(self.points)
+        order = np.argsort(known)
+        keys = self._keys(points)
+        i = np.minimum(np.searchsorted(known[order], keys), len(order) - 1)
+        return order[i], known[order[i]] == keys
+
+    def _lookup(self, points):
+        """
+        :return: 計算した点の分裂。計算していない点と、計算に失敗した点はnan
+        """
+        out = np.full(len(points), np.nan)
+        index, found = self._find(points)
+        out[found] = self.gaps[index[found]]
+        return out
+
+    def _calculate_points(self, level_dir, points):
+        """
+        まだ計算していない点をklist_bandに分けて計算し、分裂をself.pointsとself.gapsに加える。
+        :return: 新しく計算した点の数
+        """
+        # 計算済みかどうかは点 (ID) で決める。分裂がnanの点 (失敗したklist) は計算し直して上書きする
+        index, found = self._find(points)
+        retry = found & np.isnan(self.gaps[index] if len(self.gaps) else np.zeros(len(points)))
+        new = points[~found]
+        if self.skip_diagonal:
+            new = new[~((new[:, 0] == new[:, 1]) & (new[:, 1] == new[:, 2]))]
+        new = np.concatenate([points[retry], new])
+        if len(new) == 0:
+            return 0
+
+        # 一番細かい格子の通し番号をk点のIDにする
+        ids = self._keys(new)
+        batches = KPointBatches(self, level_dir, only_spin=self.spin)
+        result = batches.calculate(ids, np.column_stack([new, np.full(len(new), self.d)]))
+        gaps = result.band(self.band_index + 1, ids) - result.band(self.band_index, ids)
+
+        numofretry = int(retry.sum())
+        self.gaps[index[retry]] = gaps[:numofretry]
+        self.points = np.concatenate([self.points, new[numofretry:]])
+        self.gaps = np.concatenate([self.gaps, gaps[numofretry:]])
+
+        return len(new)
 
 
 def set_email(add):
@@ -676,9 +756,6 @@ def set_email(add):
 
 
 if __name__ == "__main__":
-    FIRSTCALCFOLDER = "NL_firstcalc"
-    MAXKPOINTS = 900  # 一つの.klist_bandファイルに入れるk点の数。<1000
-
     case = "ohwada_FeGa_soc"
     spin = ["dn"]
     band_index = 25
@@ -695,8 +772,6 @@ if __name__ == "__main__":
     # nlanal1st.do_analysis(d=first_calc_d, spin=spin)
 
     # make klist_band files for main NL calculation
-    # This part takes very much time!
-    # I must modify this program.
     # numofk = 1000
     # nlmk = NLMakeNLKlist(case, numofk, band_index, spin="dn")
     # nlmk.margin_size = 5
@@ -707,6 +782,11 @@ if __name__ == "__main__":
     # nlmc.spol = 1
     # nlmc.caluclate_NL()
 
+    # 粗い格子から分裂の小さいセルだけを細かくしていく場合 (上の３つの代わり)
+    # nla = NLAdaptiveCalculation(case, band_index, spin="dn")
+    # nla.energy_split_cut = 0.0003
+    # nla.search("NL_adaptive", numofk=50000)
+
     nlc = NLCalculation(case, spin)
     data_folder = "NLs_d50000/NL_25"
     start = datetime.datetime.now()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from w2k_benchmark import OrchestrationBenchmark  # noqa: E402
+
+# OrchestrationBenchmark.setupが書き換える環境変数
+FAKE_ENV = ["PATH", "W2K_CASES", "WIENROOT", "W2K_FAKE_SLEEP", "W2K_FAKE_SLEEP_PER_K", "W2K_FAKE_NBANDS"]
+
+
+@pytest.fixture
+def fake_wien2k(tmp_path, monkeypatch):
+    """
+    w2k_fake_wien2k.pyをWIEN2kの代わりに使うOrchestrationBenchmark。
+    bench._make_case(name)でSCF済みのcaseフォルダを作る。環境変数とカレントディレクトリはテストの後で戻す。
+    """
+    for key in FAKE_ENV:
+        if key in os.environ:
+            monkeypatch.setenv(key, os.environ[key])
+        else:
+            monkeypatch.delenv(key, raising=False)
+    monkeypatch.chdir(tmp_path)
+
+    bench = OrchestrationBenchmark(str(tmp_path / "bench"))
+    bench.sleep = 0.0
+    bench.nbands = 8
+    bench.setup()
+    return bench
@@ -0,0 +1,37 @@
+import numpy as np
+
+from w2k_agr import read_agr_blocks, read_bands_agr, write_bands_agr
+
+HEADER = ["# Grace project file\n", "@    world xmax 1.00000\n"]
+PREFIX = ["@target G0.S0\n", "@type xy\n"]
+
+
+def test_write_and_read(tmp_path):
+    path = str(tmp_path / "case.bands.agr")
+    values = np.arange(24, dtype=float).reshape(3, 4, 2)  # (nbands, nk, [エネルギー, 重み])
+    write_bands_agr(path, HEADER, PREFIX, np.linspace(0, 2, 4), values)
+
+    header, prefix, index, blocks = read_agr_blocks(path)
+    assert header[0] == HEADER[0]
+    assert "world xmax 2.00000" in header[1]
+    assert prefix == ["@target G0.S1\n", "@type xy\n"]  # ２本目のバンドの前の行
+    np.testing.assert_array_equal(index, [1, 2, 3])
+    np.testing.assert_allclose(blocks[:, :, 1:], values)
+
+    distance, energies, weights = read_bands_agr(path, weight=True)
+    np.testing.assert_allclose(distance, np.linspace(0, 2, 4), atol=1e-5)  # 小数点以下5桁で書く
+    np.testing.assert_allclose(energies, values[:, :, 0])
+    np.testing.assert_allclose(weights, values[:, :, 1])
+
+
+def test_short_band_is_filled_with_nan(tmp_path):
+    path = tmp_path / "case.bands.agr"
+    path.write_text("# header\n"
+                    "# bandindex:  1\n   0.0   -1.0\n   0.5   -2.0\n   1.0   -3.0\n&\n"
+                    "# bandindex:  2\n   0.0    1.0\n&\n"
+                    "# bandindex:  3\n   0.0    5.0\n   0.5")  # 書き込み中のバンドは読まない
+
+    _, _, index, values = read_agr_blocks(str(path))
+    np.testing.assert_array_equal(index, [1, 2])
+    np.testing.assert_allclose(values[0, :, 1], [-1, -2, -3])
+    np.testing.assert_allclose(values[1, :, 1], [1, np.nan, np.nan])
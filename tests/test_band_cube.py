@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from w2k_agr import write_bands_agr
+from w2k_band_cube import BandCube
+from w2k_klist import write_klist_band
+
+
+def write_mapping(save_dir, numofklists, nk, nbands, spins):
+    """
+    {save_dir}/klistsと{save_dir}/Bandsを作る。エネルギーは 100 * klist + バンド番号 + k点 / 100
+    """
+    (save_dir / "klists").mkdir(parents=True)
+    (save_dir / "Bands").mkdir()
+    for i in range(numofklists):
+        write_klist_band(str(save_dir / "klists" / f"klist{i}.klist_band"), [[k, i, 0, 10] for k in range(nk)])
+        write_bands(save_dir, i, nk, nbands, spins)
+
+
+def write_bands(save_dir, i, nk, nbands, spins):
+    energies = 100.0 * i + np.arange(1, nbands + 1)[:, None] + np.arange(nk)[None, :] / 100
+    for spin in spins:
+        write_bands_agr(str(save_dir / "Bands" / f"bands{i}{spin}.bands.agr"), ["# test\n"], [],
+                        np.arange(nk, dtype=float), energies[:, :, None])
+
+
+def test_from_mapping_and_ingest(tmp_path):
+    save_dir = tmp_path / "map"
+    write_mapping(save_dir, 3, 5, 4, ["up", "dn"])
+
+    cube = BandCube.from_mapping(str(save_dir), ["up", "dn"], meta={"denominator": 10})
+    assert cube.ingest(str(save_dir)) == 3
+    assert cube.filled.all()
+
+    cube = BandCube(str(save_dir / "cube"))
+    assert cube.bands.shape == (3, 5, 4, 2)
+    assert cube.meta["denominator"] == 10
+    np.testing.assert_allclose(cube.band(2, "dn")[1], 102 + np.arange(5) / 100, atol=1e-4)
+    np.testing.assert_allclose(cube.kpoints[2, :, 1], 0.2)
+
+
+def test_ingest_skips_packed_klists(tmp_path):
+    save_dir = tmp_path / "map"
+    write_mapping(save_dir, 2, 5, 4, [""])
+    cube = BandCube.from_mapping(str(save_dir), [""])
+
+    assert cube.ingest(str(save_dir)) == 2
+    assert cube.ingest(str(save_dir)) == 0
+
+
+def test_no_bands_yet(tmp_path):
+    save_dir = tmp_path / "map"
+    write_mapping(save_dir, 0, 5, 4, [""])
+    write_klist_band(str(save_dir / "klists" / "klist0.klist_band"), [[0, 0, 0, 10]])
+
+    assert BandCube.from_mapping(str(save_dir), [""]) is None
+
+
+def test_more_bands_grow_the_cube(tmp_path):
+    save_dir = tmp_path / "map"
+    write_mapping(save_dir, 2, 5, 4, [""])
+    cube = BandCube.from_mapping(str(save_dir), [""])
+    cube.add_klist(str(save_dir), 0)
+
+    write_bands(save_dir, 1, 5, 6, [""])
+    cube.add_klist(str(save_dir), 1)
+
+    assert cube.bands.shape == (2, 5, 6, 1)
+    assert np.isnan(cube.band(6)[0]).all()  # 前に入れたklistにはないバンド
+    np.testing.assert_allclose(cube.band(6)[1], 106 + np.arange(5) / 100, atol=1e-4)
+    np.testing.assert_allclose(cube.band(1)[0], 1 + np.arange(5) / 100, atol=1e-4)
+    assert BandCube(str(save_dir / "cube")).meta["shape"] == [2, 5, 6, 1]
+
+
+def test_spins_must_match(tmp_path):
+    save_dir = tmp_path / "map"
+    write_mapping(save_dir, 1, 5, 4, [""])
+    BandCube.from_mapping(str(save_dir), [""])
+
+    with pytest.raises(ValueError):
+        BandCube.from_mapping(str(save_dir), ["up", "dn"])
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from w2k_box_union import BoxUnion, merge_intervals, volume_points
+
+
+@pytest.fixture
+def union():
+    rng = np.random.default_rng(0)
+    # 端にかかる立方体と重なる立方体を混ぜる
+    centers = np.concatenate([rng.integers(0, 21, size=(12, 3)), [[0, 0, 0], [20, 20, 20], [10, 10, 10]]])
+    return BoxUnion(21, centers, margin=3)
+
+
+def test_count_matches_dense_volume(union):
+    assert union.count() == int(union.to_dense().sum())
+
+
+def test_points_match_dense_volume(union):
+    for skip_diagonal in (True, False):
+        points = np.concatenate(list(union.points(chunk=100, skip_diagonal=skip_diagonal)))
+        dense = np.concatenate(list(volume_points(union.to_dense(), chunk=100, skip_diagonal=skip_diagonal)))
+        np.testing.assert_array_equal(points, dense)
+
+
+def test_rows_cover_dense_volume(union):
+    vol = np.zeros_like(union.to_dense())
+    for kz, ky, xs in union.rows():
+        assert vol[xs, ky, kz].sum() == 0  # 同じ点を２回返さない
+        vol[xs, ky, kz] = 1
+    np.testing.assert_array_equal(vol, union.to_dense())
+
+
+def test_save_and_load(union, tmp_path):
+    union.save(tmp_path / "union.npz")
+    loaded = BoxUnion.load(tmp_path / "union.npz")
+    assert loaded.count() == union.count()
+
+
+def test_merge_intervals_joins_overlapping_and_adjacent():
+    merged = merge_intervals(np.array([5, 0, 3, 10]), np.array([6, 2, 4, 12]))
+    np.testing.assert_array_equal(merged, [[0, 6], [10, 12]])
@@ -0,0 +1,75 @@
+import numpy as np
+
+from w2k_band_cube import BandCube
+from w2k_contour import chain_segments, extract_contours, marching_squares, polylines, read_contours, write_contours
+
+
+def cone(n=21):
+    i, j = np.mgrid[0:n, 0:n]
+    return np.hypot(i - n // 2, j - n // 2)
+
+
+def test_points_lie_on_the_level_of_a_linear_field():
+    i, j = np.mgrid[0:10, 0:12]
+    segments, levels, _ = marching_squares(i + 2.0 * j, [5.5, 13.25])
+
+    assert len(segments) > 0
+    values = segments[..., 0] + 2.0 * segments[..., 1]
+    np.testing.assert_allclose(values, np.repeat(np.array([5.5, 13.25])[levels][:, None], 2, axis=1))
+
+
+def test_circle_is_one_closed_line():
+    segments, _, seg_edges = marching_squares(cone(), [6.3])
+    lines = chain_segments(seg_edges)
+
+    assert len(lines) == 1
+    order, forward, closed = lines[0]
+    assert closed
+    assert sorted(order) == list(range(len(segments)))
+    # 円の上の点は中心から半径くらい離れている
+    radius = np.hypot(segments[..., 0] - 10, segments[..., 1] - 10)
+    assert np.abs(radius - 6.3).max() < 0.2
+
+
+def test_nan_cells_are_skipped():
+    field = cone()
+    field[:, :11] = np.nan
+    segments, _, seg_edges = marching_squares(field, [6.3])
+
+    assert (segments[..., 1] >= 11).all()
+    assert not any(closed for _, _, closed in chain_segments(seg_edges))
+
+
+def make_cube(tmp_path, meta):
+    cube = BandCube.create(str(tmp_path / "cube"), 21, 21, 2, ["up", "dn"], meta=meta)
+    for i in range(21):
+        energies = np.stack([cone()[i], cone()[i] + 100.0])  # ２本目のバンドはE = 6.3を通らない
+        cube.put(i, "up", np.arange(21.0), energies)
+    return BandCube(str(tmp_path / "cube"))
+
+
+def test_extract_contours(tmp_path):
+    contours = extract_contours(make_cube(tmp_path, {}), energies=[6.3])
+
+    assert len(contours["band"]) == 1
+    assert contours["band"][0] == 1
+    assert contours["spins"][contours["spin"][0]] == "up"
+    assert contours["closed"][0]
+    assert "k" not in contours
+
+
+def test_contour_k_includes_the_origin(tmp_path):
+    meta = {"denominator": 20, "wave_basis": [[1, 1, 0], [-1, 1, 0]], "origin": [0.0, 0.0, 0.5]}
+    contours = extract_contours(make_cube(tmp_path, meta), energies=[6.3])
+
+    points = contours["points"]
+    expected = np.array([0.0, 0.0, 0.5]) + (points[:, 1:2] * [1, 1, 0] + points[:, 0:1] * [-1, 1, 0]) / 20
+    np.testing.assert_allclose(contours["k"], expected, atol=1e-6)
+
+
+def test_write_and_read(tmp_path):
+    contours = extract_contours(make_cube(tmp_path, {}), energies=[3.1, 6.3])
+    write_contours(str(tmp_path / "contours.npz"), contours)
+    loaded = read_contours(str(tmp_path / "contours.npz"))
+
+    assert len(list(polylines(loaded))) == len(contours["band"]) == 2
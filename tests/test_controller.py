@@ -0,0 +1,155 @@
+import json
+import os
+
+import pytest
+
+from WIEN2k_controller import BaseController
+from w2k_machines import save_tuned_parallel
+from w2k_mapping import W2kMapping
+from w2k_others import OtherOperations
+
+
+def commands(trace_path, name):
+    if not os.path.exists(trace_path):
+        return []
+    with open(trace_path) as f:
+        return [e for e in map(json.loads, f) if e["name"] == name]
+
+
+@pytest.mark.parametrize("spin_pol, SOC, names, outputs", [
+    (0, 0, ["lapw1", "spaghetti"], ["bands.agr"]),
+    (1, 0, ["lapw1-up", "spaghetti-up", "lapw1-dn", "spaghetti-dn"], ["bandsup.agr", "bandsdn.agr"]),
+    (0, 1, ["lapw1", "lapwso", "spaghetti"], ["bands.agr"]),
+    (1, 1, ["lapw1-up", "lapw1-dn", "lapwso", "spaghetti"], ["bandsup.agr"]),
+])
+def test_band_step_graph(fake_wien2k, spin_pol, SOC, names, outputs):
+    c = BaseController(fake_wien2k._make_case("steps"))
+    c.spin_pol, c.SOC = spin_pol, SOC
+
+    steps = c._band_steps()
+    assert [s.name for s in steps] == names
+    assert c._band_outputs() == outputs
+    assert all(set(s.deps) <= set(names[:n]) for n, s in enumerate(steps))
+
+
+def test_band_step_graph_for_one_spin(fake_wien2k):
+    c = BaseController(fake_wien2k._make_case("steps"))
+    c.spin_pol = 1
+
+    assert [s.name for s in c._band_steps(only_spin="dn")] == ["lapw1-dn", "spaghetti-dn"]
+    assert c._band_outputs(only_spin="dn") == ["bandsdn.agr"]
+
+
+def test_parallel_steps_share_the_machines_lock(fake_wien2k):
+    c = BaseController(fake_wien2k._make_case("steps"))
+    fake_wien2k._make_klist_band(c)
+    c.parallel, c.omp = 4, 2
+
+    for step in c._band_steps():
+        assert "-p" in step.command
+        assert step.cores == 8
+        assert step.locks == {"machines"}
+        assert step.numofk == fake_wien2k.numofk
+
+
+def test_band_calculation(fake_wien2k):
+    c = BaseController(fake_wien2k._make_case("band"))
+    c.parallel, c.spin_pol = 1, 1
+    fake_wien2k._make_klist_band(c)
+    c.trace("trace.jsonl")
+
+    c.calculate_band_with_spin()
+
+    for spin in ("up", "dn"):
+        assert os.path.exists(c._filepath(f"bands{spin}.agr"))
+    assert len(commands("trace.jsonl", "lapw1")) == 2
+
+
+@pytest.mark.parametrize("parallel, omp, jobs", [(4, 1, 4), (4, 2, 4), (2, 4, 2)])
+def test_machines_are_jobs_times_threads(fake_wien2k, parallel, omp, jobs):
+    c = BaseController(fake_wien2k._make_case("machines"))
+    fake_wien2k._make_klist_band(c)
+    c.parallel, c.omp = parallel, omp
+
+    c.set_parallel(klist_path=c._filepath("klist_band"))
+
+    with open(f"{c.case_path}/.machines") as f:
+        lines = f.read().splitlines()
+    assert lines.count("1:localhost") == jobs
+    assert f"omp_global:{omp}" in lines
+
+
+def test_tuned_values_are_used_per_task(fake_wien2k):
+    case = fake_wien2k._make_case("tuned")
+    case_path = f"{fake_wien2k.work_dir}/cases/{case}"
+    save_tuned_parallel(case_path, "scf", 4, 1, {})
+    save_tuned_parallel(case_path, "band", 2, 4, {})
+
+    c = BaseController(case)
+    assert (c.parallel, c.omp) == (4, 1)
+    assert c._use_task_parallel("band")
+    assert (c.parallel, c.omp) == (2, 4)
+
+    # 利用者が変えた値はそのまま使う
+    c = BaseController(case)
+    c.parallel = 3
+    assert not c._use_task_parallel("band")
+    assert c.parallel == 3
+
+
+def test_tuning_without_candidates(fake_wien2k):
+    c = OtherOperations(fake_wien2k._make_case("tuning"))
+    fake_wien2k._make_klist_band(c)
+
+    assert c.tune_parallel("band", candidates=[]) == (c.parallel, c.omp)
+
+
+def test_tuning_saves_the_best_setting(fake_wien2k):
+    c = OtherOperations(fake_wien2k._make_case("tuning"))
+    fake_wien2k._make_klist_band(c)
+
+    parallel, omp = c.tune_parallel("band", candidates=[(1, 1), (2, 1)], patience=5)
+    assert (parallel, omp) in [(1, 1), (2, 1)]
+
+    tuned = BaseController(c.case)
+    tuned._use_task_parallel("band")
+    assert (tuned.parallel, tuned.omp) == (parallel, omp)
+
+
+def make_mapping(fake_wien2k, name, numofklists=4):
+    wm = W2kMapping(fake_wien2k._make_case(name))
+    wm.parallel, wm.spin_pol = 1, 1
+    os.makedirs("map/klists")
+    for i in range(numofklists):
+        kpath = [[k / 10, i / 10, 0.0] for k in range(11)]
+        wm.make_klist_folder("map", kpath, 10)
+    wm.trace("trace.jsonl")
+    return wm
+
+
+def test_mapping_resumes_from_the_journal(fake_wien2k):
+    wm = make_mapping(fake_wien2k, "resume")
+
+    wm.calculate_bands_from_klistsdir("map", cube=True)
+    assert len(commands("trace.jsonl", "lapw1")) == 8  # 4 klists x up, dn
+    assert wm._cube.filled.all()
+
+    # 全て終わっていれば何も計算しない
+    wm.calculate_bands_from_klistsdir("map", cube=True)
+    assert len(commands("trace.jsonl", "lapw1")) == 8
+
+    # 消した出力のklistだけ計算し直す
+    os.remove("map/Bands/bands2dn.bands.agr")
+    wm.calculate_bands_from_klistsdir("map", cube=True)
+    assert len(commands("trace.jsonl", "lapw1")) == 10
+
+
+def test_mapping_with_workers(fake_wien2k):
+    wm = make_mapping(fake_wien2k, "workers")
+
+    wm.calculate_bands_from_klistsdir("map", workers=2, cube=True)
+
+    assert sorted(os.listdir("map/Bands")) == sorted(f"bands{i}{s}.bands.agr" for i in range(4) for s in ("up", "dn"))
+    assert wm._cube.filled.all()
+    assert not os.path.exists("map/workers")
+    assert {e["numofk"] for e in commands("trace.jsonl", "lapw1")} == {11}
@@ -0,0 +1,65 @@
+from w2k_journal import Journal
+
+
+def make_klist(tmp_path, name, text="klist\n"):
+    path = tmp_path / f"{name}.klist_band"
+    path.write_text(text)
+    return str(path)
+
+
+def make_output(tmp_path, name, text="bands\n"):
+    path = tmp_path / f"{name}.bands.agr"
+    path.write_text(text)
+    return str(path)
+
+
+def test_record_and_resume(tmp_path):
+    klists = [(f"bands{i}", make_klist(tmp_path, f"klist{i}", f"{i}\n")) for i in range(3)]
+    outputs_of = lambda name: [str(tmp_path / f"{name}.bands.agr")]  # noqa: E731
+
+    journal = Journal(str(tmp_path), total=3)
+    assert journal.pending(klists, outputs_of) == klists
+    make_output(tmp_path, "bands0")
+    assert journal.record("bands0", klists[0][1], outputs_of("bands0"))
+
+    # 新しいJournalは記録したファイルを読んで、終わったklistを飛ばす
+    assert Journal(str(tmp_path), total=3).pending(klists, outputs_of) == klists[1:]
+
+
+def test_missing_outputs_are_not_recorded(tmp_path):
+    klist = make_klist(tmp_path, "klist0")
+    journal = Journal(str(tmp_path))
+
+    assert not journal.record("bands0", klist, [str(tmp_path / "bands0.bands.agr")])
+    assert "bands0" not in Journal(str(tmp_path)).entries
+
+
+def test_changed_klist_or_output_is_not_done(tmp_path):
+    klist = make_klist(tmp_path, "klist0")
+    output = make_output(tmp_path, "bands0")
+    Journal(str(tmp_path)).record("bands0", klist, [output])
+    assert Journal(str(tmp_path)).is_done("bands0", klist, [output])
+
+    make_output(tmp_path, "bands0", "changed\n")
+    assert not Journal(str(tmp_path)).is_done("bands0", klist, [output])
+
+    make_output(tmp_path, "bands0")
+    make_klist(tmp_path, "klist0", "other k-points\n")
+    assert not Journal(str(tmp_path)).is_done("bands0", klist, [output])
+
+
+def test_broken_last_line_is_skipped(tmp_path):
+    klist = make_klist(tmp_path, "klist0")
+    output = make_output(tmp_path, "bands0")
+    Journal(str(tmp_path)).record("bands0", klist, [output])
+    with open(tmp_path / Journal.file_name, "a") as f:
+        f.write('{"name": "bands1", "kl')  # 書き込み中に止まった行
+
+    journal = Journal(str(tmp_path))
+    assert list(journal.entries) == ["bands0"]
+
+    # 次の記録は新しい行に書かれる
+    klist1 = make_klist(tmp_path, "klist1")
+    output1 = make_output(tmp_path, "bands1")
+    journal.record("bands1", klist1, [output1])
+    assert sorted(Journal(str(tmp_path)).entries) == ["bands0", "bands1"]
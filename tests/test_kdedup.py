@@ -0,0 +1,81 @@
+import numpy as np
+
+from w2k_agr import read_bands_agr, write_bands_agr
+from w2k_kdedup import KPointDedup
+from w2k_klist import write_klist_band
+
+C4 = np.array([[0, -1, 0], [1, 0, 0], [0, 0, 1]])
+ROTATIONS = [np.linalg.matrix_power(C4, n) for n in range(4)]  # z軸の4回回転の群
+
+
+def write_struct(path, lattice="P", params=(5.0, 5.0, 5.0, 90.0, 90.0, 90.0), rotations=ROTATIONS):
+    lines = ["test", f"{lattice:<4}LATTICE,NONEQUIV.ATOMS:  1", "MODE OF CALC=RELA",
+             "".join(f"{p:10.6f}" for p in params)]
+    lines.append(f"{len(rotations):4d}      NUMBER OF SYMMETRY OPERATIONS")
+    for n, r in enumerate(rotations):
+        lines += [f"{r[i, 0]:2d}{r[i, 1]:2d}{r[i, 2]:2d} 0.00000000" for i in range(3)]
+        lines.append(f"{n + 1:8d}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_klists(tmp_path, klists):
+    paths = []
+    for i, k in enumerate(klists):
+        paths.append(str(tmp_path / f"klist{i}.klist_band"))
+        write_klist_band(paths[-1], k)
+    return paths
+
+
+def test_duplicates_across_files(tmp_path):
+    paths = write_klists(tmp_path, [[[0, 0, 0, 10], [1, 0, 0, 10]], [[2, 0, 0, 20], [3, 0, 0, 10]]])
+    dedup = KPointDedup(paths)
+
+    # 2/20と1/10は同じ点
+    assert len(dedup.unique) == 3
+    allk = np.concatenate([dedup.klists[0], dedup.klists[1]])
+    k = allk[:, :3] / allk[:, 3:]
+    np.testing.assert_allclose(dedup.unique[dedup.inverse, :3] / dedup.unique[dedup.inverse, 3:], k)
+
+
+def test_symmetry_and_time_reversal(tmp_path):
+    struct = str(tmp_path / "case.struct")
+    write_struct(struct)
+    kpoints = [[1, 2, 0, 10], [-2, 1, 0, 10], [-1, -2, 0, 10], [11, 2, 0, 10], [1, 2, 3, 10], [-1, -2, -3, 10]]
+    paths = write_klists(tmp_path, [kpoints])
+
+    assert len(KPointDedup(paths, struct, symmetry=False).unique) == 6
+    # 回転、時間反転、逆格子ベクトルの分ずれた点は同じ点。z軸の回転ではkzの符号は変わらない
+    assert len(KPointDedup(paths, struct, symmetry=True).unique) == 2
+    assert len(KPointDedup(paths, struct, symmetry=True, time_reversal=False).unique) == 3
+
+
+def test_symmetry_is_not_used_for_hexagonal_lattices(tmp_path):
+    struct = str(tmp_path / "case.struct")
+    write_struct(struct, lattice="H", params=(5.0, 5.0, 8.0, 90.0, 90.0, 120.0))
+    paths = write_klists(tmp_path, [[[1, 2, 0, 10], [-2, 1, 0, 10]]])
+
+    dedup = KPointDedup(paths, struct, symmetry=True)
+    assert not dedup.symmetry
+    assert len(dedup.unique) == 2
+
+
+def test_expand_bands(tmp_path):
+    paths = write_klists(tmp_path, [[[0, 0, 0, 10], [1, 0, 0, 10], [2, 0, 0, 10]], [[2, 0, 0, 10], [0, 0, 0, 10]]])
+    dedup = KPointDedup(paths)
+    klists = dedup.write_unique_klists(str(tmp_path / "unique" / "klists"), chunk=2)
+    assert len(klists) == 2
+
+    # 代表点のバンドのエネルギーは代表点の番号にする
+    (tmp_path / "unique" / "Bands").mkdir()
+    for j in range(len(klists)):
+        n = np.arange(2 * j, min(2 * j + 2, len(dedup.unique)), dtype=float)
+        values = np.stack([n, n + 0.5])[:, :, None]  # (2本, nk, 1)
+        write_bands_agr(str(tmp_path / "unique" / "Bands" / f"bands{j}.bands.agr"), ["# test\n"], [],
+                        np.arange(len(n), dtype=float), values)
+
+    dedup.expand_bands(str(tmp_path / "unique" / "Bands"), str(tmp_path / "Bands"), [""])
+    for i in range(2):
+        _, energies = read_bands_agr(str(tmp_path / "Bands" / f"bands{i}.bands.agr"))
+        rep = dedup.inverse[dedup.offsets[i]:dedup.offsets[i + 1]]
+        np.testing.assert_allclose(energies, [rep, rep + 0.5])
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from w2k_klist import plane_grid, read_klist_band, to_klist_ints, write_klist_band, write_klist_files
+from w2k_machines import count_kpoints
+
+
+def test_write_and_read_round_trip(tmp_path):
+    kpoints = np.array([[0, 0, 0, 10], [-5, 3, 10, 10], [12345, -1234, 7, 99999]])
+    path = str(tmp_path / "case.klist_band")
+    write_klist_band(path, kpoints)
+
+    np.testing.assert_array_equal(read_klist_band(path), kpoints)
+    assert count_kpoints(path) == len(kpoints)
+
+
+def test_file_format(tmp_path):
+    path = str(tmp_path / "case.klist_band")
+    write_klist_band(path, [[1, 2, 3, 4]])
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    # 10X, 4I5。最初の行にはエネルギーの範囲が付く
+    assert lines[0][10:30] == "    1    2    3    4"
+    assert "-8.00 8.00" in lines[0]
+    assert lines[-1].startswith("END")
+
+
+def test_fractional_kpoints_with_denominator(tmp_path):
+    path = str(tmp_path / "case.klist_band")
+    write_klist_band(path, [[0.5, 0.25, 1.0]], denominator=4)
+
+    np.testing.assert_array_equal(read_klist_band(path), [[2, 1, 4, 4]])
+    np.testing.assert_array_equal(to_klist_ints([[0.5, 0.25, 1.0]], 4), [[2, 1, 4, 4]])
+
+
+def test_write_klist_files_splits(tmp_path):
+    kpoints = np.array([[i, 0, 0, 10] for i in range(7)])
+    path_format = str(tmp_path / "klist{}.klist_band")
+
+    assert write_klist_files(path_format, kpoints, 3) == 3
+    parts = [read_klist_band(path_format.format(i)) for i in range(3)]
+    assert [len(p) for p in parts] == [3, 3, 1]
+    np.testing.assert_array_equal(np.concatenate(parts), kpoints)
+
+
+def test_too_wide_kpoints_raise(tmp_path):
+    with pytest.raises(ValueError):
+        write_klist_band(str(tmp_path / "case.klist_band"), [[100000, 0, 0, 10]])
+
+
+def test_plane_grid():
+    grid = plane_grid(3, 2, 10, [[1, 0, 0], [0, 1, 0]], origin=(0.0, 0.0, 0.5))
+
+    assert grid.shape == (2, 3, 3)
+    np.testing.assert_allclose(grid[1, 2], [0.2, 0.1, 0.5])
@@ -0,0 +1,65 @@
+import math
+
+from w2k_machines import MachinesBuilder, load_tuned_parallel, save_tuned_parallel
+
+
+def job_lines(text):
+    return [line for line in text.splitlines() if line[:1].isdigit() and ":" in line]
+
+
+def omp_global(text):
+    return int(next(line for line in text.splitlines() if line.startswith("omp_global:")).split(":")[1])
+
+
+def test_k_parallel_uses_all_cores_for_many_kpoints():
+    text = MachinesBuilder({"localhost": 8}).k_parallel(100)
+    assert len(job_lines(text)) == 8
+    assert omp_global(text) == 1
+
+
+def test_k_parallel_drops_jobs_that_do_not_shorten_the_run():
+    # 20点を8ジョブに分けると最大3点なので、7ジョブで足りる
+    assert len(job_lines(MachinesBuilder({"localhost": 8}).k_parallel(20))) == 7
+    assert len(job_lines(MachinesBuilder({"localhost": 8}).k_parallel(3))) == 3
+
+
+def test_hybrid_splits_cores_into_jobs_and_threads():
+    for omp, jobs in [(2, 4), (4, 2), (8, 1)]:
+        text = MachinesBuilder({"localhost": 8}).hybrid(100, omp=omp)
+        assert len(job_lines(text)) == jobs
+        assert omp_global(text) == omp
+
+
+def test_hosts_get_kpoints_in_proportion_to_cores():
+    builder = MachinesBuilder({"node1": 4, "node2": 8})
+    hosts = [line.split(":")[1] for line in job_lines(builder.k_parallel(120))]
+    assert hosts.count("node1") == 4
+    assert hosts.count("node2") == 8
+
+
+def test_host_weights_are_written():
+    builder = MachinesBuilder({"node1": 2})
+    builder.host_weights = {"node1": 3}
+    assert job_lines(builder.k_parallel(10)) == ["3:node1", "3:node1"]
+
+
+def test_lapw0_mpi_line():
+    builder = MachinesBuilder({"node1": 4, "node2": 4})
+    builder.lapw0_mpi = 6
+    assert "lapw0:node1:4 node2:2" in builder.k_parallel(10).splitlines()
+
+
+def test_tuned_parallel_round_trip(tmp_path):
+    assert load_tuned_parallel(str(tmp_path), "band") is None
+
+    save_tuned_parallel(str(tmp_path), "band", 4, 2, {"4x2": 1.0})
+    tuned = load_tuned_parallel(str(tmp_path), "band")
+    assert (tuned["parallel"], tuned["omp"]) == (4, 2)
+    assert load_tuned_parallel(str(tmp_path), "scf") is None
+
+
+def test_jobs_never_exceed_kpoints_and_keep_the_largest_job():
+    for numofk in range(1, 40):
+        jobs = len(job_lines(MachinesBuilder({"localhost": 16}).k_parallel(numofk)))
+        assert jobs <= numofk
+        assert math.ceil(numofk / jobs) == math.ceil(numofk / min(numofk, 16))
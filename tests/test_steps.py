@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from w2k_steps import Step, StepEngine
+
+
+def sh(script):
+    return ["sh", "-c", script]
+
+
+def test_dependencies_run_in_order(tmp_path):
+    log = tmp_path / "log"
+    steps = [Step("c", sh(f"echo c >> {log}"), deps=["a", "b"]),
+             Step("a", sh(f"echo a >> {log}")),
+             Step("b", sh(f"echo b >> {log}"), deps=["a"])]
+
+    results = StepEngine(core_budget=4, cwd=str(tmp_path)).run(steps)
+
+    assert results == {"a": 0, "b": 0, "c": 0}
+    assert log.read_text().split() == ["a", "b", "c"]
+
+
+def test_steps_after_a_failure_are_skipped(tmp_path):
+    steps = [Step("a", sh("exit 3")),
+             Step("b", sh("true"), deps=["a"]),
+             Step("c", sh("true"), deps=["b"]),
+             Step("d", sh("true"))]
+
+    assert StepEngine(core_budget=2, cwd=str(tmp_path)).run(steps) == {"a": 3, "b": None, "c": None, "d": 0}
+
+
+def test_locked_steps_do_not_overlap(tmp_path):
+    # 同じロックのステップが重なると、後のステップが前のステップのファイルを見つける
+    script = "test ! -e busy && touch busy && sleep 0.2 && rm busy"
+    steps = [Step(f"s{n}", sh(script), locks=["machines"]) for n in range(3)]
+
+    assert set(StepEngine(core_budget=8, cwd=str(tmp_path)).run(steps).values()) == {0}
+
+
+def test_step_larger_than_the_budget_runs_alone(tmp_path):
+    script = "test ! -e busy && touch busy && sleep 0.2 && rm busy"
+    steps = [Step("big", sh(script), cores=8), Step("small", sh(script))]
+
+    assert StepEngine(core_budget=2, cwd=str(tmp_path)).run(steps) == {"big": 0, "small": 0}
+
+
+def test_invalid_graphs():
+    engine = StepEngine(core_budget=1)
+    with pytest.raises(ValueError, match="Unknown dependency"):
+        engine.run([Step("a", sh("true"), deps=["x"])])
+    with pytest.raises(ValueError, match="Circular"):
+        engine.run([Step("a", sh("true"), deps=["b"]), Step("b", sh("true"), deps=["a"])])
+    with pytest.raises(ValueError, match="unique"):
+        engine.run([Step("a", sh("true")), Step("a", sh("true"))])
+
+
+def test_run_inside_an_event_loop(tmp_path):
+    async def main():
+        return StepEngine(core_budget=1, cwd=str(tmp_path)).run([Step("a", sh("true"))])
+
+    assert asyncio.run(main()) == {"a": 0}
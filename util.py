@@ -1,29 +1,155 @@
+from functools import lru_cache
+
 import numpy as np
 
-def BZinside(v: float) -> float:
+def BZinside(v):
     """入力値を0から1の値に規格化する.
-    端は折りたたまれる.
+    端は折りたたまれる. 配列を与えると要素ごとに計算する.
 
     Args:
-        v (float): 入力値
+        v (float or np.ndarray): 入力値
 
     Returns:
-        float: 出力値
+        float or np.ndarray: 出力値
     """
     v = np.mod(v, 2)
-    if v > 1:
-        v = 2 - v
-    return v
+    v = np.where(v > 1, 2 - v, v)
+    return float(v) if v.ndim == 0 else v
 
-def rotate_vector(vector: np.ndarray, angle_degrees: float):
-    # 角度をラジアンに変換
+@lru_cache(maxsize=None)
+def rotation_matrix(angle_degrees: float) -> np.ndarray:
+    """2次元の回転行列. 同じ角度では作り直さない.
+
+    Args:
+        angle_degrees (float): 回転角 (度)
+
+    Returns:
+        np.ndarray: 2x2の回転行列 (書き換え不可)
+    """
     angle_radians = np.deg2rad(angle_degrees)
+    m = np.array([[np.cos(angle_radians), -np.sin(angle_radians)],
+                  [np.sin(angle_radians), np.cos(angle_radians)]])
+    m.setflags(write=False)
+    return m
 
-    # 回転行列を作成
-    rotation_matrix = np.array([[np.cos(angle_radians), -np.sin(angle_radians)],
-                                [np.sin(angle_radians), np.cos(angle_radians)]])
+def rotate_vector(vector: np.ndarray, angle_degrees: float):
+    """ベクトルを回転する. 最後の軸が(x, y)の配列なら、まとめて回転する.
+
+    Args:
+        vector (np.ndarray): (2,)または(..., 2)の配列
+        angle_degrees (float): 回転角 (度)
+
+    Returns:
+        np.ndarray: 回転したベクトル
+    """
+    return np.asarray(vector) @ rotation_matrix(float(angle_degrees)).T
 
-    # ベクトルを回転
-    rotated_vector = np.dot(rotation_matrix, vector)
+def read_struct_lattice(struct_path: str):
+    """case.structから格子の種類と格子定数を読む.
 
-    return rotated_vector
+    Args:
+        struct_path (str): case.structのパス
+
+    Returns:
+        tuple: (格子の種類 "P", "F", "B", "CXY", "H", "R", ..., (a, b, c, alpha, beta, gamma)).
+        格子定数が読めないときはNone
+    """
+    with open(struct_path, "r") as f:
+        lines = [f.readline() for _ in range(4)]
+
+    lattice = lines[1][:4].strip()
+    try:
+        params = tuple(float(lines[3][i:i + 10]) for i in range(0, 60, 10))
+    except (IndexError, ValueError):
+        params = None
+
+    return lattice, params
+
+def is_orthogonal(params) -> bool:
+    """格子の角度が全て90度ならTrue. 格子定数がないときもTrue."""
+    return params is None or all(abs(angle - 90) < 1e-4 for angle in params[3:])
+
+def lattice_vectors(params) -> np.ndarray:
+    """格子定数から実空間の単位胞のベクトルを作る. aはx軸、bはxy面内に置く.
+
+    Args:
+        params (tuple): (a, b, c, alpha, beta, gamma)
+
+    Returns:
+        np.ndarray: 3x3の配列. 行がa, b, c (bohr)
+    """
+    a, b, c = params[:3]
+    alpha, beta, gamma = np.deg2rad(params[3:])
+    cx = c * np.cos(beta)
+    cy = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    cz = np.sqrt(c ** 2 - cx ** 2 - cy ** 2)
+    return np.array([[a, 0, 0],
+                     [b * np.cos(gamma), b * np.sin(gamma), 0],
+                     [cx, cy, cz]])
+
+def cartesian_to_kbasis(lattice: str, params) -> np.ndarray:
+    """デカルト座標のk (2π/a単位)を、WIEN2kのklistの座標に変える行列.
+
+    直交する格子 (P, F, B, C) のklistは2π/a, 2π/b, 2π/cを単位にしたデカルト座標で、
+    六方晶 (H) は逆格子ベクトルを単位にした座標とする. H のデカルト座標はlattice_vectorsと同じく
+    aをx軸、bをxy面内に置いたもの (WIEN2kの内部の座標の向きとは違う).
+    R (菱面体晶) と直交しない単斜晶・三斜晶は、klistの座標の取り方を確かめていないのでエラーにする.
+
+    Args:
+        lattice (str): 格子の種類
+        params (tuple): (a, b, c, alpha, beta, gamma). Noneのときは立方晶とみなす
+
+    Returns:
+        np.ndarray: 3x3の行列M. k_wien2k = M @ k_cartesian
+    """
+    if params is None:
+        return np.eye(3)
+
+    a = params[0]
+    if lattice[:1] in ("P", "F", "B", "C") and is_orthogonal(params):
+        return np.diag(np.array(params[:3]) / a)
+    if lattice[:1] != "H":
+        raise ValueError(f"The klist basis of the {lattice} lattice {params[3:]} is not supported. "
+                         "Only orthogonal P, F, B, C and H lattices can be used.")
+
+    # k = Σ n_i b_i (b_i = 2π (A^-1)^T の行) なので n_i = a_i・k / 2π
+    m = lattice_vectors(params) / a
+    # 手で求めたM = (1/2, 1/(2√3), 0), K = (1/3, 1/√3, 0) (2π/a単位) が、
+    # 逆格子ベクトルの座標の(1/2, 0, 0), (1/3, 1/3, 0)になることを確かめる
+    points = np.array([[1 / 2, 1 / (2 * np.sqrt(3)), 0], [1 / 3, 1 / np.sqrt(3), 0]])
+    if not np.allclose(points @ m.T, [[1 / 2, 0, 0], [1 / 3, 1 / 3, 0]]):
+        raise ValueError(f"The M and K points of {lattice} {params} are not mapped to the klist basis.")
+    return m
+
+def plane_to_kbasis(basis, struct_path: str = None) -> np.ndarray:
+    """面内の基底ベクトルをWIEN2kのklistの座標に変える.
+    w2k_mapping.pyで使っていた「45度回転してルート2倍する」は、正方晶のbasis=[[1, 1, 0], [-1, 1, 0]]と同じ.
+
+    Args:
+        basis (array_like): (2, 3)の配列. デカルト座標の基底ベクトル (2π/a単位)
+        struct_path (str): 格子を読むcase.struct. Noneのときは立方晶とみなす
+
+    Returns:
+        np.ndarray: (2, 3)の配列. klistの座標の基底ベクトル
+
+    Raises:
+        ValueError: cartesian_to_kbasisで扱えない格子のとき
+    """
+    lattice, params = ("P", None) if struct_path is None else read_struct_lattice(struct_path)
+    return np.asarray(basis, dtype=float) @ cartesian_to_kbasis(lattice, params).T
+
+def kbasis_to_cartesian(k, struct_path: str = None) -> np.ndarray:
+    """WIEN2kのklistの座標のkをデカルト座標 (2π/a単位) に戻す. plane_to_kbasisの逆.
+
+    Args:
+        k (array_like): (..., 3)の配列. klistの座標のk点
+        struct_path (str): 格子を読むcase.struct. Noneのときは立方晶とみなす
+
+    Returns:
+        np.ndarray: (..., 3)の配列. デカルト座標のk点
+
+    Raises:
+        ValueError: cartesian_to_kbasisで扱えない格子のとき
+    """
+    lattice, params = ("P", None) if struct_path is None else read_struct_lattice(struct_path)
+    return np.asarray(k, dtype=float) @ np.linalg.inv(cartesian_to_kbasis(lattice, params)).T
@@ -1,6 +1,5 @@
-import datetime
-
 import WIEN2k_controller as wc
+from w2k_trace import print_summary
 
 if __name__ == "__main__":
     # イニシャライズ済のsessionを選ぶ。
@@ -9,9 +8,7 @@ if __name__ == "__main__":
     bc.spin_pol = 1  # スピン偏極計算
     bc.parallel = 0
 
-    start = datetime.datetime.now()
+    bc.trace("scf_trace.jsonl")
     # econv, cconv, numofiterationを変数として設定できる。
     bc.scf()
-    end = datetime.datetime.now()
-    delta = end - start
-    print(f"This calculation takes {delta}.")
\ No newline at end of file
+    print_summary(bc.runner.trace_path)
\ No newline at end of file
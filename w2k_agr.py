@@ -0,0 +1,119 @@
+import os
+import re
+
+import numpy as np
+
+BAND_MARK = b"# bandindex:"  # この行から次の"&"の行までが１本のバンド
+
+
+def read_agr_blocks(path):
+    """
+    spaghettiの.bands.agrをまとめて読む。重み付き(-qtl)の@type xysizeも読める。
+    :return: (ヘッダーの行のリスト, ２本目以降のバンドの前に入る行のリスト, バンド番号 (nbands,),
+              (nbands, nk, 列)の配列 (列は [k点の距離, エネルギー[, 重み]]))
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    blocks = _find_blocks(data)
+    if not blocks:
+        raise ValueError(f"No band is found in {path}.")
+
+    header = data[:blocks[0][0]].decode().splitlines(keepends=True)
+    prefix = []
+    if len(blocks) > 1:
+        # １本目の"&"の次の行から２本目の"# bandindex"まで (@target, @typeなど)
+        prefix = data[blocks[0][3]:blocks[1][0]].decode().splitlines(keepends=True)
+
+    numofcols = len(data[blocks[0][1]:data.index(b"\n", blocks[0][1])].split())
+    # 全てのバンドの数字を１回で変換する。k点の数は各バンドの行の数
+    spans = [data[start:end] for _, start, end, _ in blocks]
+    counts = np.array([s.count(b"\n") for s in spans])
+    flat = np.array(b"".join(spans).split(), dtype=float).reshape(-1, numofcols)
+
+    nk = counts.max()
+    values = np.full((len(blocks), nk, numofcols), np.nan)
+    if (counts == nk).all():
+        values[:] = flat.reshape(len(blocks), nk, numofcols)
+    else:
+        # spaghettiが途中で止まったバンドは残りをnanにする
+        for n, (s, c) in enumerate(zip(np.cumsum(counts) - counts, counts)):
+            values[n, :c] = flat[s:s + c]
+
+    index = np.array([int(data[mark + len(BAND_MARK):start].split()[0]) for mark, start, _, _ in blocks])
+
+    return header, prefix, index, values
+
+
+def _find_blocks(data):
+    """
+    :return: バンドごとの[("# bandindex"の位置, 数字の始まり, 数字の終わり, "&"の次の行の始まり), ...]
+    """
+    blocks = []
+    mark = data.find(BAND_MARK)
+    while mark >= 0:
+        start = data.index(b"\n", mark) + 1
+        end = data.find(b"\n&", start - 1)
+        if end < 0:
+            break  # 書き込み中で"&"がないバンドは読まない
+        after = data.find(b"\n", end + 1)
+        after = len(data) if after < 0 else after + 1
+        blocks.append((mark, start, end + 1, after))
+        mark = data.find(BAND_MARK, after)
+
+    return blocks
+
+
+def read_bands_agr(path, weight=False):
+    """
+    .bands.agrをエネルギーの配列にする。
+    :param weight: Trueのときは重み(@type xysizeの３列目)も返す。重みのないファイルではNone
+    :return: (k点の距離 (nk,), エネルギー (nbands, nk)[, 重み (nbands, nk)])
+             エネルギーのn行目はバンド番号 (bandindex) n+1
+    """
+    _, _, index, values = read_agr_blocks(path)
+
+    energies = _by_index(index, values[:, :, 1])
+    if not weight:
+        return values[0, :, 0], energies
+
+    weights = _by_index(index, values[:, :, 2]) if values.shape[2] > 2 else None
+    return values[0, :, 0], energies, weights
+
+
+def _by_index(index, array):
+    if np.array_equal(index, np.arange(1, len(index) + 1)):
+        return array
+
+    out = np.full((index.max(), array.shape[1]), np.nan)
+    out[index - 1] = array
+    return out
+
+
+def bands_agr_path(directory, name, spin=""):
+    """
+    スピンの付いた.bands.agrのパスを返す。
+    WIEN2kの{case}.bands{spin}.agrと、保存した{name}{spin}.bands.agrのどちらでもよい。
+    :param spin: "", "up", "dn"
+    """
+    for path in (f"{directory}/{name}{spin}.bands.agr", f"{directory}/{name}.bands{spin}.agr"):
+        if os.path.exists(path):
+            return path
+
+    raise FileNotFoundError(f"{directory}/{name}{spin}.bands.agr")
+
+
+def write_bands_agr(path, header, prefix, distance, values):
+    """
+    read_agr_blocksで読んだヘッダーと、新しいk点の距離、(nbands, nk, 列)の値から.bands.agrを書く。
+    :param values: k点の距離を除いた列 [エネルギー[, 重み]]
+    """
+    with open(path, "w") as f:
+        f.writelines(re.sub(r"(world xmax\s+)\S+", rf"\g<1>{distance[-1]:.5f}", l) for l in header)
+        for n in range(values.shape[0]):
+            if n > 0:
+                f.writelines(re.sub(r"S\d+", f"S{n}", l) for l in prefix)
+            f.write(f"# bandindex:  {n + 1}\n")
+            for x, v in zip(distance, values[n]):
+                f.write(f"   {x:10.5f}" + "".join(f"   {e:10.5f}" for e in v) + "\n")
+            f.write("&\n")
@@ -0,0 +1,172 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from w2k_fileops import copy, remove_tree
+
+
+class BandCache:
+    """
+    計算した.bands.agrを、入力の内容から作ったキーで保存しておく。
+    同じk点を同じ収束した電荷密度で計算するときは、lapw1とspaghettiを実行せずに保存したものを使う。
+
+    キーに使うもの
+    case.klist_band, case.vsp* (up, dn), case.vns*, case.in1*, case.struct, case.insp (EF),
+    SOCのときcase.inso, LDA+Uのときcase.vorb*
+    spin_pol, SOC, U, 片方のスピンだけ計算するかどうか
+
+    {cache_dir}/{key}/に.bands.agrを置く。
+    合計がmax_bytesを超えたら、最後に使ってから長いものから消す。
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        """
+        :param cache_dir: 保存するフォルダ
+        :param max_bytes: 保存する.bands.agrの合計の上限 (byte)
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._index = None  # {key: (size, 最後に使った時刻)}
+        self._file_hashes = {}  # {path: (size, mtime_ns, hash)} 大きいvspを毎回読まないため
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, case_dir, case, flags):
+        """
+        :param case_dir: case.klist_bandなどがあるフォルダ
+        :param case: case名
+        :param flags: 計算の設定 {"spin_pol": ..., "SOC": ..., "U": ..., "only_spin": ...}
+        :return: キー (sha256の16進数)
+        """
+        paths = [f"{case_dir}/{case}.klist_band", f"{case_dir}/{case}.struct", f"{case_dir}/{case}.insp"]
+        paths += sorted(glob.glob(f"{case_dir}/{case}.vsp*")) + sorted(glob.glob(f"{case_dir}/{case}.in1*"))
+        paths += sorted(glob.glob(f"{case_dir}/{case}.vns*"))
+        if flags.get("SOC"):
+            paths += sorted(glob.glob(f"{case_dir}/{case}.inso"))
+        if flags.get("U"):
+            paths += sorted(glob.glob(f"{case_dir}/{case}.vorb*"))
+
+        h = hashlib.sha256(json.dumps(flags, sort_keys=True).encode())
+        for path in paths:
+            # フォルダの違う同じ内容のファイルが同じキーになるように、パスではなく拡張子を入れる
+            h.update(os.path.basename(path)[len(case):].encode())
+            h.update(self._file_hash(path).encode())
+
+        return h.hexdigest()
+
+    def get(self, key, case_dir, case, outputs):
+        """
+        保存した.bands.agrを{case_dir}/{case}.{output}にコピーする。
+        :param outputs: 拡張子のリスト ["bandsup.agr", "bandsdn.agr"]など
+        :return: すべてそろっていてコピーしたときTrue
+        """
+        entry = self._entry(key)
+        if not all(os.path.isfile(f"{entry}/{o}") for o in outputs):
+            self.misses += 1
+            return False
+
+        try:
+            for o in outputs:
+                # spaghettiは同じファイルに上書きするので、ハードリンクではなくコピーする
+                copy(f"{entry}/{o}", f"{case_dir}/{case}.{o}")
+        except OSError:
+            self.misses += 1
+            return False
+
+        now = time.time()
+        os.utime(entry, (now, now))
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                index[key] = (index[key][0], now)
+        self.hits += 1
+
+        return True
+
+    def put(self, key, case_dir, case, outputs):
+        """
+        計算した{case_dir}/{case}.{output}を保存する。一時フォルダに書いてから名前を変えるので、途中で止まっても壊れない。
+        """
+        entry = self._entry(key)
+        tmp = f"{entry}.tmp{os.getpid()}_{threading.get_ident()}"
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            for o in outputs:
+                copy(f"{case_dir}/{case}.{o}", f"{tmp}/{o}")
+            remove_tree(entry)
+            os.replace(tmp, entry)
+        except OSError as e:
+            remove_tree(tmp)
+            print(f"Band cache: {e}")
+            return
+
+        size = sum(os.path.getsize(f"{entry}/{o}") for o in outputs)
+        with self._lock:
+            index = self._load_index()
+            index[key] = (size, time.time())
+            self._evict(index)
+
+    def size(self):
+        """
+        :return: 保存している.bands.agrの合計 (byte)
+        """
+        with self._lock:
+            return sum(s for s, _ in self._load_index().values())
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock:
+            self._index = {}
+
+    def _entry(self, key):
+        return f"{self.cache_dir}/{key}"
+
+    def _load_index(self):
+        if self._index is None:
+            self._index = {}
+            for key in os.listdir(self.cache_dir):
+                entry = self._entry(key)
+                if ".tmp" in key or not os.path.isdir(entry):
+                    continue
+                size = sum(os.path.getsize(f"{entry}/{f}") for f in os.listdir(entry))
+                self._index[key] = (size, os.stat(entry).st_mtime)
+
+        return self._index
+
+    def _evict(self, index):
+        total = sum(s for s, _ in index.values())
+        for key in sorted(index, key=lambda k: index[k][1]):
+            if total <= self.max_bytes:
+                break
+            total -= index.pop(key)[0]
+            remove_tree(self._entry(key))
+
+    def _file_hash(self, path):
+        if not os.path.exists(path):
+            return "-"
+
+        st = os.stat(path)
+        with self._lock:
+            cached = self._file_hashes.get(path)
+        if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+            return cached[2]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+
+        with self._lock:
+            self._file_hashes[path] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+
+        return h.hexdigest()
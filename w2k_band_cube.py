@@ -0,0 +1,187 @@
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from w2k_agr import read_bands_agr
+from w2k_fileops import move
+from w2k_klist import read_klist_band
+
+
+class BandCube:
+    """
+    マッピングの{save_dir}/Bands/bands{i}{spin}.bands.agrを１つの.npyにまとめ、メモリマップで開く。
+    klistが終わるごとにその行だけ書き足せる。
+
+    {cube_dir}/bands.npy  : (klistの数, nk, nbands, nspin)のfloat32。まだ入れていないところはnan
+    {cube_dir}/kpoints.npy : (klistの数, nk, 3)のk点 (klistの座標)
+    {cube_dir}/distance.npy : (klistの数, nk)のk点の距離 (spaghettiの横軸)
+    {cube_dir}/filled.npy : (klistの数, nspin)のbool。入れたklistとスピン
+    {cube_dir}/meta.json : spins, case, 格子の作り方などの情報
+
+    cube = BandCube(f"{save_dir}/cube")
+    e = cube.band(10, "up")  # (klistの数, nk)
+    """
+
+    def __init__(self, cube_dir, mode="r"):
+        """
+        :param cube_dir: 保存するフォルダ
+        :param mode: "r"は読むだけ、"r+"は書き足す
+        """
+        self.cube_dir = cube_dir
+        self.mode = mode
+        with open(self._path("meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.spins = self.meta["spins"]
+
+        self.bands = np.load(self._path("bands.npy"), mmap_mode=mode)
+        self.kpoints = np.load(self._path("kpoints.npy"), mmap_mode=mode)
+        self.distance = np.load(self._path("distance.npy"), mmap_mode=mode)
+        self.filled = np.load(self._path("filled.npy"), mmap_mode=mode)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, cube_dir, numofklists, nk, nbands, spins, meta=None):
+        """
+        空のキューブを作る。
+        :param spins: ["up", "dn"]か[""]
+        :param meta: meta.jsonに一緒に書く情報 (分母、面内の基底ベクトルなど)
+        """
+        os.makedirs(cube_dir, exist_ok=True)
+        shape = (numofklists, nk, nbands, len(spins))
+        _new_npy(f"{cube_dir}/bands.npy", shape, np.float32)
+        _new_npy(f"{cube_dir}/kpoints.npy", (numofklists, nk, 3), np.float64)
+        _new_npy(f"{cube_dir}/distance.npy", (numofklists, nk), np.float64)
+        _new_npy(f"{cube_dir}/filled.npy", (numofklists, len(spins)), np.bool_, fill=False)
+
+        info = dict(meta or {})
+        info.update({"spins": list(spins), "shape": list(shape), "created": time.strftime("%Y-%m-%d %H:%M:%S")})
+        with open(f"{cube_dir}/meta.json", "w") as f:
+            json.dump(info, f, indent=2)
+
+        return cls(cube_dir, mode="r+")
+
+    @classmethod
+    def from_mapping(cls, save_dir, spins, meta=None, cube_dir=None):
+        """
+        {save_dir}のklistsとBandsからキューブを開く。なければ最初の.bands.agrの大きさで作る。
+        :return: BandCube。まだ.bands.agrがひとつもないときはNone
+        """
+        cube_dir = cube_dir or f"{save_dir}/cube"
+        if os.path.exists(f"{cube_dir}/meta.json"):
+            cube = cls(cube_dir, mode="r+")
+            if cube.spins != list(spins):
+                raise ValueError(f"{cube_dir} was made for spins {cube.spins}, not {list(spins)}. Remove it first.")
+            return cube
+
+        klists = _numofklists(save_dir)
+        for i in range(klists):
+            for s in spins:
+                path = f"{save_dir}/Bands/bands{i}{s}.bands.agr"
+                if os.path.exists(path):
+                    nk = max(len(read_klist_band(f"{save_dir}/klists/klist{j}.klist_band")) for j in range(klists))
+                    nbands = read_bands_agr(path)[1].shape[0]
+                    return cls.create(cube_dir, klists, nk, nbands, spins, meta)
+
+        return None
+
+    def _path(self, name):
+        return f"{self.cube_dir}/{name}"
+
+    def put(self, i, spin, distance, energies, kpoints=None):
+        """
+        i番目のklistのバンドを書く。
+        :param energies: (nbands, nk)のエネルギー。nbandsが足りないときはキューブを大きくする
+        :param kpoints: (nk, 3)のk点
+        """
+        s = self.spins.index(spin)
+        nbands, nk = energies.shape
+        with self._lock:
+            if nbands > self.bands.shape[2]:
+                self._grow(nbands)
+
+            self.bands[i, :, :, s] = np.nan
+            self.bands[i, :nk, :nbands, s] = energies.T
+            self.distance[i, :nk] = distance
+            if kpoints is not None:
+                self.kpoints[i, :len(kpoints)] = kpoints
+            self.bands.flush()
+            self.filled[i, s] = True
+            self.filled.flush()
+
+    def add_klist(self, save_dir, i, refresh=True):
+        """
+        {save_dir}/Bands/bands{i}{spin}.bands.agrを読んで書く。ないスピンは飛ばす。
+        :param refresh: Falseのときは入れたスピンを読み直さない
+        :return: 書いたスピンの数
+        """
+        k = read_klist_band(f"{save_dir}/klists/klist{i}.klist_band")
+        kpoints = k[:, :3] / k[:, 3:4]
+
+        numofspins = 0
+        for s, spin in enumerate(self.spins):
+            path = f"{save_dir}/Bands/bands{i}{spin}.bands.agr"
+            if os.path.exists(path) and (refresh or not self.filled[i, s]):
+                distance, energies = read_bands_agr(path)
+                self.put(i, spin, distance, energies, kpoints)
+                numofspins += 1
+
+        return numofspins
+
+    def ingest(self, save_dir):
+        """
+        まだ入れていないklistの.bands.agrを全て入れる。
+        :return: 入れたklistの数
+        """
+        todo = np.flatnonzero(~self.filled.all(axis=1))
+        numofklists = sum(self.add_klist(save_dir, int(i), refresh=False) > 0 for i in todo)
+        print(f"{numofklists} klists are packed into {self.cube_dir} "
+              f"({int(self.filled.all(axis=1).sum())}/{len(self.filled)} done).")
+
+        return numofklists
+
+    def band(self, band_index, spin=None):
+        """
+        :param band_index: バンド番号 (.bands.agrのbandindex、1から)
+        :param spin: "up", "dn"。Noneのときは最初のスピン
+        :return: (klistの数, nk)のエネルギー (メモリマップのビュー)
+        """
+        s = 0 if spin is None else self.spins.index(spin)
+        return self.bands[:, :, band_index - 1, s]
+
+    def _grow(self, nbands):
+        """
+        バンドの数を増やしたbands.npyを作り直す。klistごとにコピーするので全体をメモリに読まない。
+        """
+        old = self.bands
+        shape = (old.shape[0], old.shape[1], nbands, old.shape[3])
+        tmp = self._path("bands.npy.tmp")
+        new = _new_npy(tmp, shape, np.float32)
+        for i in range(old.shape[0]):
+            new[i, :, :old.shape[2]] = old[i]
+        new.flush()
+        del new, old
+
+        move(tmp, self._path("bands.npy"))
+        self.bands = np.load(self._path("bands.npy"), mmap_mode=self.mode)
+        self.meta["shape"] = list(shape)
+        with open(self._path("meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2)
+
+
+def _new_npy(path, shape, dtype, fill=np.nan):
+    a = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+    # 大きいときにメモリを使わないように、先頭の軸ごとに埋める
+    for i in range(shape[0]):
+        a[i] = fill
+    a.flush()
+    return a
+
+
+def _numofklists(save_dir):
+    n = 0
+    while os.path.exists(f"{save_dir}/klists/klist{n}.klist_band"):
+        n += 1
+    return n
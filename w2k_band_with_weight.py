@@ -1,5 +1,4 @@
 import os
-import subprocess
 
 from WIEN2k_controller import BaseController
 
@@ -57,8 +56,7 @@ class CaluculateWithOrbit(BaseController):
             for s in ["up", "dn"]:
                 run_lapw1s = run_lapw1 + [f"-{s}"]
 
-                print("run " + " ".join(run_lapw1s))
-                subprocess.run(run_lapw1s)
+                self._run(run_lapw1s)
 
                 if self.SOC:
                     run_lapwsos = run_lapwso + [f"-{s}"]
@@ -66,15 +64,12 @@ class CaluculateWithOrbit(BaseController):
             for s in ["up", "dn"]:
                 run_lapw2s = run_lapw2 + [f"-{s}"]
 
-                print("run " + " ".join(run_lapw2s))
-                subprocess.run(run_lapw2s)
+                self._run(run_lapw2s)
 
         else:
-            print("run " + " ".join(run_lapw1))
-            subprocess.run(run_lapw1)
+            self._run(run_lapw1)
 
-            print("run " + " ".join(run_lapw2))
-            subprocess.run(run_lapw2)
+            self._run(run_lapw2)
 
     def _do_lapw_soc(self):
         if not os.path.exists(self._filepath("insp")):  # make .insp file if not exist
@@ -93,14 +88,11 @@ class CaluculateWithOrbit(BaseController):
         for s in ["up", "dn"]:
             run_lapw1s = run_lapw1 + [f"-{s}"]
 
-            print("run " + " ".join(run_lapw1s))
-            subprocess.run(run_lapw1s)
+            self._run(run_lapw1s)
 
-        print("run " + " ".join(run_lapwso))
-        subprocess.run(run_lapwso)
+        self._run(run_lapwso)
 
-        print("run " + " ".join(run_lapw2))
-        subprocess.run(run_lapw2)
+        self._run(run_lapw2)
 
     def _do_spaghetti(self):
         run_spag = ["x_lapw", "spaghetti"]
@@ -118,18 +110,18 @@ class CaluculateWithOrbit(BaseController):
         if self.spin_pol:
             for s in spin_list:
                 run_spags = run_spag + [f"-{s}"]
-                print("run " + " ".join(run_spags))
-                subprocess.run(run_spags)
+                self._run(run_spags)
         else:
-            print("run " + " ".join(run_spag))
-            subprocess.run(run_spag)
+            self._run(run_spag)
 
     def _save_orbit_band(self, outfol, atomname, orbitname):
+        ops = self._file_ops()
         if self.spin_pol: # スピン偏極計算の場合
-            subprocess.run(["mv", self._filepath("bandsup.agr"), f"{outfol}/{atomname}_{orbitname}up.bands.agr"]) # .bandsup.agrのファイルの名前を変えて出力用フォルダに移動する
-            subprocess.run(["mv", self._filepath("bandsdn.agr"), f"{outfol}/{atomname}_{orbitname}dn.bands.agr"]) # .bandsdn.agrについて同様
+            ops.move(self._filepath("bandsup.agr"), f"{outfol}/{atomname}_{orbitname}up.bands.agr") # .bandsup.agrのファイルの名前を変えて出力用フォルダに移動する
+            ops.move(self._filepath("bandsdn.agr"), f"{outfol}/{atomname}_{orbitname}dn.bands.agr") # .bandsdn.agrについて同様
         else: # すぴん偏極ない場合
-            subprocess.run(["mv", self._filepath("bands.agr"), f"{outfol}/{atomname}_{orbitname}.bands.agr"])
+            ops.move(self._filepath("bands.agr"), f"{outfol}/{atomname}_{orbitname}.bands.agr")
+        ops.run()
 
 if __name__ == "__main__":
     # klist_bandファイルは予め作っておく
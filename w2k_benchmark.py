@@ -0,0 +1,253 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from w2k_trace import summarize
+
+FAKE_COMMANDS = ["x_lapw", "run_lapw", "runsp_lapw", "init_lapw", "save_lapw", "restore_lapw", "configure_int_lapw"]
+
+INSP_TEMPLATE = """### Figure configuration
+5.0   3.0                     # paper offset of plot
+10.0  15.0                    # xsize,ysize [cm]
+1.0   4                       # major ticks, minor ticks
+1.0   1                       # character height, font switch
+1.1   2     4                 # line width, line switch, color switch
+### Data configuration
+-15.0 5.0 2                   # energy range, energy switch (1:Ry, 2:eV)
+1                             # Fermi switch,  (0:no-EF line, 1:eF line, 2:EF from file)
+0.xxxx                        # Fermi level (Ry) (only for Fermi switch = 1)
+1   999                       # number of bands for heavier plotting   1,1
+1   2   0.2                   # jatom, jcol, size  of heavier plotting
+"""
+
+INORB_TEMPLATE = """  1  2  0                         nmod, natorb, ipr
+PRATT  1.0                        BROYD/PRATT, mixing
+  1 1 2                          iatom nlorb, lorb
+  2 1 2                          iatom nlorb, lorb
+  1                              nsic 0..AMF, 1..SIC, 2..HFM
+   0.52    0.0                   U J (Ry)
+   0.52    0.0                   U J (Ry)
+"""
+
+INDM_TEMPLATE = """-9.                      Emin cutoff energy
+ 2                       number of atoms for which density matrix is calculated
+ 1  1  2      index of 1st atom, number of L's, L1
+ 2  1  2      ditto for 2nd atom, repeat NATOM times
+ 0 0           r-index, (l,s)index
+"""
+
+
+class OrchestrationBenchmark:
+    """
+    WIEN2kの代わりにw2k_fake_wien2k.pyを使って、コントローラーのPython/シェル側のオーバーヘッドを測る。
+    偽物のx_lapwなどはW2K_FAKE_SLEEPの時間だけ待ってそれらしいファイルを書くので、
+    経過時間から偽物のコマンドの時間を引いたものがオーバーヘッドになる。
+    WIEN2kがインストールされていないLinuxマシンで動く。
+
+    一時フォルダに W2K_CASES (caseフォルダ)、WIENROOT/SRC_templates、偽物のコマンドを置くbinを作る。
+    """
+
+    def __init__(self, work_dir=None):
+        """
+        :param work_dir: ベンチマーク用のフォルダ。Noneのときは一時フォルダを作る
+        """
+        self.work_dir = os.path.abspath(work_dir or tempfile.mkdtemp(prefix="w2k_bench_"))
+
+        self.sleep = 0.05  # 偽物のコマンド１回あたりの時間 (s)
+        self.sleep_per_k = 0.0  # k点１つあたりの時間 (s)
+        self.nbands = 30  # .bands.agrのバンドの数
+
+        self.numofklists = 8  # mappingで計算するklist_bandファイルの数
+        self.numofk = 51  # １つのklist_bandファイルのk点の数
+        self.denominator = 50
+        self.workers_list = [1, 2, 4]  # mappingで試す作業フォルダの数
+        self.parallel = 1
+        self.spin_pol = 1
+
+        self.atom_dict = {"Fe": {"atomnum": 1, "orbitnum": [1, 5, 6], "orbitname": ["tot", "DZ2", "DX2Y2"]}}
+        self.udict = {"Fe": (1, (0, 1, 1)), "Co": (2, (0, 0, 0))}
+
+        self.results = []
+
+    def setup(self):
+        """
+        偽物のコマンド、テンプレート、環境変数を用意する。
+        """
+        bin_dir = f"{self.work_dir}/bin"
+        temp_dir = f"{self.work_dir}/WIEN2k/SRC_templates"
+        os.makedirs(bin_dir, exist_ok=True)
+        os.makedirs(temp_dir, exist_ok=True)
+        os.makedirs(f"{self.work_dir}/cases", exist_ok=True)
+        os.makedirs(f"{self.work_dir}/traces", exist_ok=True)
+
+        fake = os.path.join(os.path.dirname(os.path.abspath(__file__)), "w2k_fake_wien2k.py")
+        for command in FAKE_COMMANDS:
+            path = f"{bin_dir}/{command}"
+            with open(path, "w") as f:
+                f.write(f"#!/bin/sh\nexec \"{sys.executable}\" \"{fake}\" {command} \"$@\"\n")
+            os.chmod(path, 0o755)
+
+        for ext, text in [("insp", INSP_TEMPLATE), ("inorb", INORB_TEMPLATE), ("indm", INDM_TEMPLATE)]:
+            with open(f"{temp_dir}/case.{ext}", "w") as f:
+                f.write(text)
+
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        os.environ["W2K_CASES"] = f"{self.work_dir}/cases"
+        os.environ["WIENROOT"] = f"{self.work_dir}/WIEN2k"
+        os.environ["W2K_FAKE_SLEEP"] = str(self.sleep)
+        os.environ["W2K_FAKE_SLEEP_PER_K"] = str(self.sleep_per_k)
+        os.environ["W2K_FAKE_NBANDS"] = str(self.nbands)
+
+        print(f"Benchmark folder : {self.work_dir}")
+
+    def run_all(self):
+        self.setup()
+        cwd = os.getcwd()
+        try:
+            self.bench_mapping()
+            self.bench_orbit()
+            self.bench_mapping_with_weight()
+            self.bench_with_U()
+            self.bench_optimization()
+        finally:
+            os.chdir(cwd)
+
+        self.report()
+
+    def bench_mapping(self):
+        from w2k_mapping import W2kMapping
+
+        for workers in self.workers_list:
+            case = self._make_case(f"map_w{workers}")
+            wm = W2kMapping(case)
+            self._configure(wm)
+            save_dir = "map"
+            os.makedirs(f"{save_dir}/klists")
+            for i in range(self.numofklists):
+                kpath = [[k / (self.numofk - 1), i / max(self.numofklists - 1, 1), 0.0] for k in range(self.numofk)]
+                wm.make_klist_folder(save_dir, kpath, self.denominator)
+
+            self._measure(f"W2kMapping", wm, workers, self.numofklists * self.numofk,
+                          lambda: wm.calculate_bands_from_klistsdir(save_dir, workers=workers))
+
+    def bench_orbit(self):
+        from w2k_band_with_weight import CaluculateWithOrbit
+
+        case = self._make_case("orbit")
+        cw = CaluculateWithOrbit(case)
+        self._configure(cw)
+        self._make_klist_band(cw)
+        self._measure("CaluculateWithOrbit", cw, 1, self.numofk,
+                      lambda: cw.calculate_band_with_orbit(outfol="orbital", atom_dict=self.atom_dict, do_lapw=True))
+
+    def bench_mapping_with_weight(self):
+        from w2k_maping_with_weight import W2kMappingWithWeight
+
+        case = self._make_case("map_weight")
+        mww = W2kMappingWithWeight(case)
+        self._configure(mww)
+        os.makedirs("orbit_map/klists")
+        for i in range(self.numofklists):
+            kpath = [[k / (self.numofk - 1), i / max(self.numofklists - 1, 1), 0.0] for k in range(self.numofk)]
+            mww.make_klist_band(kpath, self.denominator)
+            os.replace(f"{case}.klist_band", f"orbit_map/klists/klist{i}.klist_band")
+
+        self._measure("W2kMappingWithWeight", mww, 1, self.numofklists * self.numofk,
+                      lambda: mww.make_map(data_folder="orbit_map", atom_dict=self.atom_dict))
+
+    def bench_with_U(self):
+        from w2k_with_U import CalculationWithU
+
+        case = self._make_case("with_u")
+        wu = CalculationWithU(case)
+        self._configure(wu)
+        self._make_klist_band(wu)
+        numofruns = len(wu._make_u_lists(self.udict)[0]) * len(wu._make_u_lists(self.udict)[1])
+        self._measure("CalculationWithU", wu, 1, numofruns * self.numofk,
+                      lambda: wu.calculate_scf_with_U(self.udict))
+
+    def bench_optimization(self):
+        from w2k_optimization import W2kOptimization
+
+        case = self._make_case("optimization")
+        wo = W2kOptimization(case)
+        self._configure(wo)
+        wo.kmesh = (100, 300, 100)
+        numofk = sum(max(int(round(k ** (1 / 3) / 2)) ** 3, 1) for k in wo._make_one_domain(wo.kmesh))
+        self._measure("W2kOptimization", wo, 1, numofk, wo.optimize)
+
+    def _configure(self, controller):
+        controller.parallel = self.parallel
+        controller.spin_pol = self.spin_pol
+
+    def _make_case(self, case):
+        """
+        SCF済みのcaseフォルダを作る。
+        """
+        case_path = f"{self.work_dir}/cases/{case}"
+        os.makedirs(case_path)
+        with open(f"{case_path}/{case}.struct", "w") as f:
+            f.write(f"{case}\nP   LATTICE,NONEQUIV.ATOMS:  2\n")
+        with open(f"{case_path}/{case}.scf", "w") as f:
+            f.write(":FER  : F E R M I - ENERGY(TETRAH.M.)=   0.50000\n")
+
+        return case
+
+    def _make_klist_band(self, controller):
+        kpath = [[k / (self.numofk - 1), 0.0, 0.0] for k in range(self.numofk)]
+        controller.make_klist_band(kpath, self.denominator)
+
+    def _measure(self, name, controller, workers, numofk, func):
+        """
+        funcを実行して、経過時間とトレースからオーバーヘッドを求める。
+        WIEN2kのコマンドの時間はworkersで並列に進むとみなす。
+        """
+        trace_path = f"{self.work_dir}/traces/{name}_w{workers}.jsonl"
+        controller.trace(trace_path)
+
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                func()
+            except SystemExit:
+                pass
+        wall = time.time() - start
+
+        summary = summarize(trace_path) if os.path.exists(trace_path) else {}
+        wien2k = sum(s["wall"] for c, s in summary.items() if c != "file")
+        files = summary.get("file", {"wall": 0.0})["wall"]
+        overhead = wall - wien2k / workers
+
+        self.results.append({"name": name, "workers": workers, "wall": wall, "wien2k": wien2k, "file": files,
+                             "overhead": overhead, "numofk": numofk,
+                             "runs": sum(s["count"] for s in summary.values())})
+        print(f"{name} (workers={workers}) : {wall:.2f} s")
+
+    def report(self):
+        """
+        ワークフローごとの時間、k点あたりのオーバーヘッド、作業フォルダ数に対するスケーリングを表示する。
+        """
+        base = {}
+        for r in self.results:
+            if r["workers"] == 1:
+                base[r["name"]] = r["wall"]
+
+        print(f"{'workflow':<22}{'workers':>8}{'runs':>7}{'k-points':>10}{'wall [s]':>10}{'wien2k [s]':>12}"
+              f"{'file [s]':>10}{'overhead [s]':>14}{'ms/k':>9}{'speedup':>9}")
+        for r in self.results:
+            speedup = base[r["name"]] / r["wall"] if r["name"] in base else float("nan")
+            print(f"{r['name']:<22}{r['workers']:>8}{r['runs']:>7}{r['numofk']:>10}{r['wall']:>10.2f}"
+                  f"{r['wien2k']:>12.2f}{r['file']:>10.3f}{r['overhead']:>14.3f}"
+                  f"{r['overhead'] / r['numofk'] * 1000:>9.2f}{speedup:>9.2f}")
+
+
+if __name__ == "__main__":
+    bench = OrchestrationBenchmark()
+    bench.sleep = 0.05
+    bench.numofklists = 8
+    bench.numofk = 51
+    bench.workers_list = [1, 2, 4]
+    bench.run_all()
@@ -0,0 +1,176 @@
+import numpy as np
+
+
+class BoxUnion:
+    """
+    (size, size, size)のボリュームのうち、点の周りの立方体 (中心±margin) を合わせた領域。
+    ボリュームを作らずに、立方体の端だけを持つ。numofkが数万でもメモリは点の数に比例する分しか使わない。
+
+    領域はkzとkyが同じ範囲では同じkxの区間になるので、
+    (kz0, kz1, ky0, ky1, kxの区間)のブロックに分けて取り出す。
+
+    vol = BoxUnion(1001, centers, margin=50)
+    for kz, ky, xs in vol.rows():
+        ...
+    """
+
+    def __init__(self, size, centers, margin):
+        """
+        :param size: ボリュームの１辺の点の数 (numofk + 1)
+        :param centers: (n, 3)のint配列 [[kx, ky, kz], ...]
+        :param margin: 立方体の半分の幅
+        """
+        centers = np.asarray(centers, dtype=np.int64).reshape(-1, 3)
+        self.size = int(size)
+        self.margin = int(margin)
+        self.centers = centers
+        # 端は_marge_boundと同じように0とsize-1で切る
+        self.lo = np.clip(centers - self.margin, 0, self.size - 1)
+        self.hi = np.clip(centers + self.margin, 0, self.size - 1)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def blocks(self):
+        """
+        :return: (kz0, kz1, ky0, ky1, kxの区間 (k, 2) [[x0, x1], ...]) を返すジェネレータ。
+                 kz0 <= kz < kz1, ky0 <= ky < ky1の全ての(kz, ky)で、x0 <= kx <= x1が領域に入る
+        """
+        for z0, z1, ys in self._z_blocks():
+            for y0, y1, intervals in ys:
+                yield z0, z1, y0, y1, intervals
+
+    def _z_blocks(self):
+        """
+        :return: (kz0, kz1, [(ky0, ky1, kxの区間), ...]) を返すジェネレータ
+        """
+        for z0, z1, active in _sweep(self.lo[:, 2], self.hi[:, 2], np.arange(len(self))):
+            ys = [(y0, y1, merge_intervals(self.lo[boxes, 0], self.hi[boxes, 0]))
+                  for y0, y1, boxes in _sweep(self.lo[active, 1], self.hi[active, 1], active)]
+            yield z0, z1, ys
+
+    def rows(self):
+        """
+        :return: (kz, ky, kxの配列)を、kz, kyの小さい順に返すジェネレータ
+        """
+        for z0, z1, ys in self._z_blocks():
+            ys = [(y0, y1, interval_points(intervals)) for y0, y1, intervals in ys]
+            for kz in range(z0, z1):
+                for y0, y1, xs in ys:
+                    for ky in range(y0, y1):
+                        yield kz, ky, xs
+
+    def points(self, chunk=1 << 20, skip_diagonal=True):
+        """
+        領域の点を、kz, ky, kxの小さい順 (kxが一番内側) にchunk点くらいずつ返す。
+        :param skip_diagonal: Trueのときkx = ky = kzの点を除く
+        :return: (n, 3)のint配列 [[kx, ky, kz], ...]を返すジェネレータ
+        """
+        parts, numofpoints = [], 0
+        for z0, z1, ys in self._z_blocks():
+            ys = [(y0, y1, interval_points(intervals)) for y0, y1, intervals in ys]
+            for kz in range(z0, z1):
+                for y0, y1, xs in ys:
+                    step = max(1, chunk // len(xs))  # 大きいブロックはkyで分ける
+                    for y in range(y0, y1, step):
+                        numofy = min(step, y1 - y)
+                        p = np.empty((numofy * len(xs), 3), dtype=np.int64)
+                        p[:, 0] = np.tile(xs, numofy)
+                        p[:, 1] = np.repeat(np.arange(y, y + numofy), len(xs))
+                        p[:, 2] = kz
+                        if skip_diagonal:
+                            p = p[~((p[:, 0] == p[:, 1]) & (p[:, 1] == p[:, 2]))]
+                        parts.append(p)
+                        numofpoints += len(p)
+                        if numofpoints >= chunk:
+                            yield np.concatenate(parts)
+                            parts, numofpoints = [], 0
+
+        if parts:
+            yield np.concatenate(parts)
+
+    def count(self):
+        """
+        :return: 領域の点の数
+        """
+        return sum((z1 - z0) * (y1 - y0) * int((iv[:, 1] - iv[:, 0] + 1).sum()) for z0, z1, y0, y1, iv in self.blocks())
+
+    def to_dense(self):
+        """
+        小さいボリュームで確かめるときに使う。
+        :return: (size, size, size)のuint8配列 [kx, ky, kz]
+        """
+        vol = np.zeros((self.size,) * 3, dtype=np.uint8)
+        for lo, hi in zip(self.lo, self.hi):
+            vol[lo[0]:hi[0] + 1, lo[1]:hi[1] + 1, lo[2]:hi[2] + 1] = 1
+        return vol
+
+    def save(self, path):
+        np.savez(path, size=self.size, margin=self.margin, centers=self.centers)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(int(f["size"]), f["centers"], int(f["margin"]))
+
+
+def _sweep(lo, hi, ids):
+    """
+    区間[lo, hi]の端で座標を区切り、その範囲で重なっている区間のidを返す。
+    :return: (c0, c1, idの配列) c0 <= c < c1で重なっているもの。何もない範囲は返さない
+    """
+    if len(ids) == 0:
+        return
+    starts = np.argsort(lo, kind="stable")
+    ends = np.argsort(hi, kind="stable")
+    edges = np.unique(np.concatenate([lo, hi + 1]))
+
+    active = set()
+    si = ei = 0
+    for c0, c1 in zip(edges[:-1], edges[1:]):
+        while si < len(lo) and lo[starts[si]] <= c0:
+            active.add(starts[si])
+            si += 1
+        while ei < len(hi) and hi[ends[ei]] < c0:
+            active.discard(ends[ei])
+            ei += 1
+        if active:
+            yield int(c0), int(c1), ids[np.sort(np.fromiter(active, dtype=np.int64))]
+
+
+def merge_intervals(lo, hi):
+    """
+    重なっているか隣り合う区間[lo, hi]をまとめる。
+    :return: (k, 2)の配列 [[x0, x1], ...] (小さい順)
+    """
+    order = np.argsort(lo, kind="stable")
+    lo, hi = lo[order], hi[order]
+    reach = np.maximum.accumulate(hi)
+    first = np.flatnonzero(np.concatenate([[True], lo[1:] > reach[:-1] + 1]))
+
+    return np.stack([lo[first], np.maximum.reduceat(hi, first)], axis=1)
+
+
+def interval_points(intervals):
+    """
+    :return: 区間に入る全ての整数を並べた配列
+    """
+    lengths = intervals[:, 1] - intervals[:, 0] + 1
+    offsets = np.repeat(intervals[:, 0] - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(lengths.sum()) + offsets
+
+
+def volume_points(vol, chunk=1 << 20, skip_diagonal=True):
+    """
+    BoxUnion.pointsと同じ順に、ボリュームデータ [kx, ky, kz] の0でない点をkzの薄い板ごとに取り出す。
+    :return: (n, 3)のint配列 [[kx, ky, kz], ...]を返すジェネレータ
+    """
+    numofz = max(1, chunk // max(1, vol.shape[0] * vol.shape[1]))
+    for z0 in range(0, vol.shape[2], numofz):
+        # (kz, ky, kx)に並べ替えてからnonzeroすると、kxが一番内側の順になる
+        kz, ky, kx = np.nonzero(vol[:, :, z0:z0 + numofz].transpose(2, 1, 0))
+        p = np.stack([kx, ky, kz + z0], axis=1).astype(np.int64)
+        if skip_diagonal:
+            p = p[~((p[:, 0] == p[:, 1]) & (p[:, 1] == p[:, 2]))]
+        if len(p):
+            yield p
@@ -0,0 +1,193 @@
+import numpy as np
+
+# マーチングスクエアの表
+# セルの角 v0=(i, j), v1=(i, j+1), v2=(i+1, j+1), v3=(i+1, j)。値がエネルギーより大きい角のビットを立てる
+# 辺 e0=v0-v1, e1=v1-v2, e2=v3-v2, e3=v0-v3。各ケースの線分 (辺, 辺) を最大２本。-1はなし
+SEGMENTS = np.full((16, 2, 2), -1, dtype=np.int64)
+for _case, _segs in {1: [(3, 0)], 2: [(0, 1)], 3: [(3, 1)], 4: [(1, 2)], 5: [(3, 0), (1, 2)], 6: [(0, 2)],
+                     7: [(2, 3)], 8: [(2, 3)], 9: [(0, 2)], 10: [(0, 1), (2, 3)], 11: [(1, 2)], 12: [(3, 1)],
+                     13: [(0, 1)], 14: [(3, 0)]}.items():
+    SEGMENTS[_case, :len(_segs)] = _segs
+# 鞍点 (5, 10) でセルの中心の値がエネルギーより大きいとき
+SADDLE_HIGH = {5: [(0, 1), (2, 3)], 10: [(3, 0), (1, 2)]}
+
+
+def marching_squares(field, levels):
+    """
+    ２次元の格子の値から、複数のエネルギーの等高線の線分をまとめて求める。nanが入ったセルは飛ばす。
+    :param field: (ny, nx)の配列
+    :param levels: エネルギーのリスト
+    :return: (線分 (m, 2, 2) [[[行, 列], [行, 列]], ...], エネルギーの番号 (m,), 線分の端がのる辺の番号 (m, 2))
+    """
+    field = np.asarray(field, dtype=float)
+    levels = np.asarray(levels, dtype=float).reshape(-1)
+    ny, nx = field.shape
+
+    v = np.stack([field[:-1, :-1], field[:-1, 1:], field[1:, 1:], field[1:, :-1]])  # (4, ny-1, nx-1)
+    valid = ~np.isnan(v).any(axis=0)
+    above = v[:, None] > levels[None, :, None, None]  # (4, nl, ny-1, nx-1)
+    case = (above * np.array([1, 2, 4, 8])[:, None, None, None]).sum(axis=0)
+    case[:, ~valid] = 0
+
+    lv, ci, cj = np.nonzero((case > 0) & (case < 15))
+    case = case[lv, ci, cj]
+    level = levels[lv]
+    c = v[:, ci, cj]  # (4, n)
+
+    # ４本の辺の上の点と辺の番号
+    def frac(a, b):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.clip((level - a) / (b - a), 0.0, 1.0)
+
+    points = np.stack([
+        np.stack([ci, cj + frac(c[0], c[1])], axis=-1),
+        np.stack([ci + frac(c[1], c[2]), cj + 1], axis=-1),
+        np.stack([ci + 1, cj + frac(c[3], c[2])], axis=-1),
+        np.stack([ci + frac(c[0], c[3]), cj], axis=-1),
+    ])  # (4, n, 2)
+    vertical = ny * nx
+    edges = np.stack([ci * nx + cj, vertical + ci * nx + cj + 1, (ci + 1) * nx + cj, vertical + ci * nx + cj])
+
+    table = SEGMENTS[case]  # (n, 2, 2)
+    saddle = np.isin(case, list(SADDLE_HIGH)) & (c.mean(axis=0) > level)
+    for k, segs in SADDLE_HIGH.items():
+        table[saddle & (case == k)] = segs
+
+    seg_cell, seg_n = np.nonzero(table[:, :, 0] >= 0)
+    ends = table[seg_cell, seg_n]  # (m, 2)
+    segments = points[ends, seg_cell[:, None]]  # (m, 2, 2)
+    seg_edges = edges[ends, seg_cell[:, None]]
+
+    return segments, lv[seg_cell], seg_edges
+
+
+def chain_segments(seg_edges):
+    """
+    同じ辺で接する線分をつないで折れ線にする。
+    :param seg_edges: (m, 2)の線分の両端の辺の番号
+    :return: [(線分の番号のリスト, 向きのリスト (Falseは逆向き), 閉じているか), ...]
+    """
+    seg_edges = np.asarray(seg_edges).tolist()
+    touching = {}
+    for s, (a, b) in enumerate(seg_edges):
+        touching.setdefault(a, []).append(s)
+        touching.setdefault(b, []).append(s)
+
+    used = [False] * len(seg_edges)
+    lines = []
+
+    def walk(edge, order, forward):
+        # edgeから先へ、次の線分をたどる
+        while True:
+            nxt = [t for t in touching[edge] if not used[t]]
+            if not nxt:
+                return edge
+            t = nxt[0]
+            used[t] = True
+            a, b = seg_edges[t]
+            order.append(t)
+            forward.append(a == edge)
+            edge = b if a == edge else a
+
+    for s in range(len(seg_edges)):
+        if used[s]:
+            continue
+        used[s] = True
+        a, b = seg_edges[s]
+        tail_order, tail_forward = [s], [True]
+        end = walk(b, tail_order, tail_forward)
+        head_order, head_forward = [], []
+        start = walk(a, head_order, head_forward)
+        # 頭の側は逆にたどったので、向きを反対にしてつなぐ
+        order = head_order[::-1] + tail_order
+        forward = [not f for f in head_forward[::-1]] + tail_forward
+        lines.append((order, forward, start == end and len(order) > 2))
+
+    return lines
+
+
+def extract_contours(cube, energies, bands=None, spins=None):
+    """
+    BandCubeから、エネルギーとバンドとスピンごとの等エネルギー線をまとめて求める。
+    格子は (行, 列) = (klistの番号, klistの中のk点の番号)。
+    meta.jsonにwave_basisとdenominatorがあれば、点をデカルト座標 (2π/a単位) にもする。
+    格子点(0, 0)のk点はmeta.jsonのorigin (デカルト座標、ないときは原点)。
+
+    :param cube: BandCube
+    :param energies: エネルギーのリスト (.bands.agrと同じ単位)
+    :param bands: バンド番号 (1から) のリスト。Noneのときは全て
+    :param spins: ["up"]など。Noneのときは全て
+    :return: {"points": (P, 2) 格子の座標 [行, 列], "k": (P, 3) デカルト座標 (基底がないときはなし),
+              "offsets": (L+1,) 折れ線ごとの点の始まり, "band": (L,), "spin": (L,), "energy": (L,), "closed": (L,),
+              "spins": スピンの名前のリスト}
+    """
+    energies = np.asarray(energies, dtype=float).reshape(-1)
+    bands = range(1, cube.bands.shape[2] + 1) if bands is None else bands
+    spins = cube.spins if spins is None else spins
+
+    points, offsets, band_of, spin_of, energy_of, closed = [], [0], [], [], [], []
+    for spin in spins:
+        s = cube.spins.index(spin)
+        for band in bands:
+            field = np.asarray(cube.band(band, spin), dtype=float)
+            if np.isnan(field).all():
+                continue
+            segments, lv, seg_edges = marching_squares(field, energies)
+
+            for n in np.unique(lv):
+                idx = np.flatnonzero(lv == n)
+                for order, forward, is_closed in chain_segments(seg_edges[idx]):
+                    seg = segments[idx[order]]
+                    seg = np.where(np.array(forward)[:, None, None], seg, seg[:, ::-1])
+                    line = np.concatenate([seg[:, 0], seg[-1:, 1]])
+                    points.append(line)
+                    offsets.append(offsets[-1] + len(line))
+                    band_of.append(band)
+                    spin_of.append(s)
+                    energy_of.append(energies[n])
+                    closed.append(is_closed)
+
+    contours = {
+        "points": np.concatenate(points).astype(np.float32) if points else np.zeros((0, 2), dtype=np.float32),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "band": np.array(band_of, dtype=np.int32),
+        "spin": np.array(spin_of, dtype=np.int8),
+        "energy": np.array(energy_of, dtype=np.float32),
+        "closed": np.array(closed, dtype=bool),
+        "spins": np.array(cube.spins),
+    }
+
+    meta = cube.meta
+    if "wave_basis" in meta and "denominator" in meta:
+        # 行が波b、列が波a
+        basis = np.asarray(meta["wave_basis"], dtype=float)
+        origin = np.asarray(meta.get("origin", [0.0, 0.0, 0.0]), dtype=float)
+        contours["k"] = (origin + (contours["points"][:, 1:2] * basis[0]
+                                   + contours["points"][:, 0:1] * basis[1]) / meta["denominator"]).astype(np.float32)
+
+    return contours
+
+
+def write_contours(path, contours):
+    """
+    extract_contoursの結果を.npzに書く。
+    """
+    np.savez_compressed(path, **contours)
+
+
+def read_contours(path):
+    """
+    :return: write_contoursで書いた辞書
+    """
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+
+def polylines(contours):
+    """
+    :return: [(band, spin, energy, (n, 2)の点), ...]
+    """
+    o = contours["offsets"]
+    spins = contours["spins"]
+    return [(int(contours["band"][n]), str(spins[contours["spin"][n]]), float(contours["energy"][n]),
+             contours["points"][o[n]:o[n + 1]]) for n in range(len(o) - 1)]
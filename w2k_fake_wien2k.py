@@ -0,0 +1,209 @@
+"""
+WIEN2kのコマンドの代わりに動く偽物のプログラム。w2k_benchmark.pyから使う。
+WIEN2kがインストールされていないマシンで、Python側のオーバーヘッドを測るためのもの。
+
+python3 w2k_fake_wien2k.py (command) (options...)
+command : x_lapw, run_lapw, runsp_lapw, init_lapw, save_lapw, restore_lapw, configure_int_lapw
+
+環境変数
+W2K_FAKE_SLEEP : １回の呼び出しで待つ時間 (s)
+W2K_FAKE_SLEEP_PER_K : k点１つあたりに待つ時間 (s)
+W2K_FAKE_NBANDS : .bands.agrに書くバンドの数
+W2K_FAKE_ITERATIONS : case.scfに書くSCFサイクルの数
+"""
+import math
+import os
+import shutil
+import sys
+import time
+
+SLEEP = float(os.environ.get("W2K_FAKE_SLEEP", "0.05"))
+SLEEP_PER_K = float(os.environ.get("W2K_FAKE_SLEEP_PER_K", "0.0"))
+NBANDS = int(os.environ.get("W2K_FAKE_NBANDS", "30"))
+ITERATIONS = int(os.environ.get("W2K_FAKE_ITERATIONS", "10"))
+EF = 0.5
+
+
+def read_klist_band(path):
+    """
+    .klist_bandから[(kx, ky, kz), ...]を読む（分母で割った値）
+    """
+    kpoints = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("END"):
+                break
+            kx, ky, kz, d = (int(line[i:i + 5]) for i in (10, 15, 20, 25))
+            kpoints.append((kx / d, ky / d, kz / d))
+
+    return kpoints
+
+
+def read_klist(path):
+    n = 0
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith("END"):
+                    break
+                n += 1
+
+    return n
+
+
+def spin_of(args):
+    spin = ""
+    for a in args:
+        if a in ["-up", "-dn"]:
+            spin = a[1:]
+    return spin
+
+
+def energy(n, k):
+    """
+    それらしいバンド分散 (eV, EF基準)
+    """
+    kx, ky, kz = k
+    return (-10.0 + 0.7 * n
+            + 0.8 * math.cos(2 * math.pi * kx + 0.3 * n)
+            + 0.5 * math.cos(2 * math.pi * ky - 0.2 * n)
+            + 0.3 * math.cos(2 * math.pi * kz))
+
+
+def write_bands_agr(case, spin, weighted):
+    kpoints = read_klist_band(f"{case}.klist_band")
+
+    dist = [0.0]
+    for k0, k1 in zip(kpoints[:-1], kpoints[1:]):
+        dist.append(dist[-1] + math.sqrt(sum((a - b) ** 2 for a, b in zip(k0, k1))))
+
+    lines = [f"# {case}.bands{spin}.agr made by w2k_fake_wien2k",
+             "@with g0",
+             "@    world xmin 0",
+             f"@    world xmax {dist[-1]:.5f}",
+             "@    yaxis  label \"Energy (eV)\""]
+    for n in range(1, NBANDS + 1):
+        lines.append(f"@target G0.S{n - 1}")
+        lines.append("@type xysize" if weighted else "@type xy")
+        lines.append(f"# bandindex:  {n}")
+        for x, k in zip(dist, kpoints):
+            if weighted:
+                w = 0.5 + 0.5 * math.sin(n + 7 * x)
+                lines.append(f"   {x:10.5f}   {energy(n, k):10.5f}   {w:8.5f}")
+            else:
+                lines.append(f"   {x:10.5f}   {energy(n, k):10.5f}")
+        lines.append("&")
+
+    with open(f"{case}.bands{spin}.agr", "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_qtl(case, spin):
+    kpoints = read_klist_band(f"{case}.klist_band")
+    lines = [f" {case}",
+             f" LATTICE CONST.=   7.7100   7.7100   7.7100   FERMI ENERGY=   {EF:.5f}",
+             "     1 NUMBER OF ATOMS IN UNITCELL  NUMBER OF ATOMS IN UNITCELL",
+             " JATOM  1 MULT= 1  ISPLIT= 2 tot,0,1,2,3,"]
+    for n in range(1, NBANDS + 1):
+        lines.append(f" BAND:{n:4}")
+        for k in kpoints:
+            e = energy(n, k) / 13.6058 + EF
+            lines.append(f"{e:11.6f}   1  0.50000  0.10000  0.20000  0.15000  0.05000")
+
+    with open(f"{case}.qtl{spin}", "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def write_scf(case, spin_pol):
+    blocks = []
+    etot = -38000.123456
+    dis = 0.1
+    for i in range(1, ITERATIONS + 1):
+        etot += 0.01 / i ** 2
+        dis /= 2.5
+        block = [f":ITE{i:03}:  {i}. ITERATION",
+                 f":FER  : F E R M I - ENERGY(TETRAH.M.)=   {EF:.5f}",
+                 f":DIS  :  CHARGE DISTANCE       ( {dis:.7f} for atom    1 spin 1)      {dis:.7f}",
+                 f":ENE  : ********** TOTAL ENERGY IN Ry =       {etot:.8f}"]
+        if spin_pol:
+            block.append(f":MMT001: MAGNETIC MOMENT IN CELL     =    {2.2 + 0.1 / i:.5f}")
+        blocks.append("\n".join(block))
+
+    with open(f"{case}.scf", "w") as f:
+        f.write("\n\n".join(blocks) + "\n")
+    with open(f"{case}.scfm", "w") as f:
+        f.write(blocks[-1] + "\n")
+
+
+def x_lapw(case, args):
+    prog = args[0]
+    spin = spin_of(args)
+
+    if prog in ["lapw1", "lapw2", "spaghetti", "lapwso"] and "-band" in args or prog == "spaghetti":
+        numofk = len(read_klist_band(f"{case}.klist_band"))
+    else:
+        numofk = read_klist(f"{case}.klist")
+    time.sleep(SLEEP + SLEEP_PER_K * numofk)
+
+    if prog == "lapw1":
+        with open(f"{case}.output1{spin}", "w") as f:
+            f.write(f"fake lapw1 {numofk} k-points\n")
+    elif prog == "lapw2" and "-qtl" in args:
+        if "-band" in args:
+            write_qtl(case, spin)
+        else:
+            with open(f"{case}.qtl{spin}", "w") as f:
+                f.write("fake qtl\n")
+    elif prog == "spaghetti":
+        if "-so" in args and spin == "":
+            spin = "up"
+        write_bands_agr(case, spin, weighted=os.path.exists(f"{case}.qtl{spin}"))
+    elif prog == "tetra":
+        with open(f"{case}.dos1eV{spin}", "w") as f:
+            for i in range(200):
+                e = -10 + i * 0.1
+                f.write(f"{e:10.5f} {max(0.0, math.sin(e)):10.5f}\n")
+
+
+def main():
+    command = sys.argv[1]
+    args = sys.argv[2:]
+    case = os.path.basename(os.getcwd())
+
+    if command == "x_lapw":
+        x_lapw(case, args)
+    elif command in ["run_lapw", "runsp_lapw"]:
+        time.sleep(SLEEP * ITERATIONS + SLEEP_PER_K * read_klist(f"{case}.klist") * ITERATIONS)
+        write_scf(case, command == "runsp_lapw")
+    elif command == "init_lapw":
+        time.sleep(SLEEP)
+        numk = int(args[args.index("-numk") + 1]) if "-numk" in args else 1000
+        n = max(int(round(numk ** (1 / 3) / 2)) ** 3, 1)  # 既約なk点の数のつもり
+        with open(f"{case}.klist", "w") as f:
+            for i in range(n):
+                f.write(f"{i + 1:10}{0:10}{0:10}{i:10}{n:10}  1.0\n")
+            f.write("END\n")
+        for ext in ["in1", "in2", "vsp", "clmsum"]:
+            with open(f"{case}.{ext}", "w") as f:
+                f.write(f"fake {ext}\n")
+    elif command == "save_lapw":
+        time.sleep(SLEEP)
+        save_dir = args[args.index("-d") + 1] if "-d" in args else "saved"
+        os.makedirs(save_dir, exist_ok=True)
+        for ext in ["scf", "clmsum", "struct", "in1", "in2", "vsp"]:
+            if os.path.exists(f"{case}.{ext}"):
+                shutil.copyfile(f"{case}.{ext}", f"{save_dir}/{case}.{ext}")
+    elif command == "restore_lapw":
+        save_dir = args[args.index("-d") + 1] if "-d" in args else "saved"
+        for f in os.listdir(save_dir):
+            shutil.copyfile(f"{save_dir}/{f}", f)
+    elif command == "configure_int_lapw":
+        with open(f"{case}.int", "w") as f:
+            f.write(" ".join(args) + "\n")
+    else:
+        print(f"w2k_fake_wien2k: unknown command {command}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import os
+import threading
+
+_ef_cache = {}  # {scfファイルの絶対パス: (size, mtime_ns, EF)}
+_ef_lock = threading.Lock()
+
+
+def get_ef(scf_path, block_size=65536):
+    """
+    .scfファイルの最後の:FERの行からフェルミエネルギー(Ry)を取り出す。
+    ファイルの後ろからブロックごとに読むので、長いSCFの後でも最後のサイクルだけを読む。
+    結果はファイルのサイズと更新時刻が変わるまでキャッシュする。
+
+    :param scf_path: .scfファイルのパス
+    :param block_size: １回に読むバイト数
+    :return: EF (Ry)。:FERがなければ以前と同じく0.0 (case.inspにNoneを書かないように)
+    """
+    path = os.path.abspath(scf_path)
+    st = os.stat(path)
+    key = (st.st_size, st.st_mtime_ns)
+
+    with _ef_lock:
+        cached = _ef_cache.get(path)
+    if cached is not None and cached[:2] == key:
+        return cached[2]
+
+    ef = _scan_ef(path, st.st_size, block_size)
+    if ef is None:
+        print(f"No :FER line in {scf_path}. EF = 0.0 is used.")
+        ef = 0.0
+
+    with _ef_lock:
+        _ef_cache[path] = key + (ef,)
+
+    return ef
+
+
+def _scan_ef(path, size, block_size):
+    with open(path, "rb") as f:
+        end = size
+        head = b""  # 前のブロックから続く、まだ行頭が見つかっていない部分
+        while end > 0:
+            start = max(end - block_size, 0)
+            f.seek(start)
+            lines = (f.read(end - start) + head).split(b"\n")
+            end = start
+
+            if start > 0:
+                head = lines.pop(0)
+            for line in reversed(lines):
+                if line.startswith(b":FER"):
+                    return float(line.split(b"=")[-1].split()[0])
+
+    return None
+
+
+class InspFile:
+    """
+    テンプレートからcase.inspを作る。
+    EFと重み付きプロットの原子・軌道が前に書いたときと同じで、ファイルも変わっていなければ書き直さない。
+    """
+
+    def __init__(self, template_path, insp_path):
+        """
+        :param template_path: EFの場所が0.xxxxになっているテンプレートのパス
+        :param insp_path: 書き出すcase.inspのパス
+        """
+        self.template_path = template_path
+        self.insp_path = insp_path
+
+        self._template = None
+        self._state = None  # 前に書いたときの(EF, weight, テンプレートの更新時刻, 書いたファイルの更新時刻)
+
+    def update(self, ef, weight=None):
+        """
+        必要なときだけcase.inspを書き直す。
+        :param ef: フェルミエネルギー (Ry)
+        :param weight: (jatom, jcol)。Noneのときはテンプレートのまま
+        :return: 書き直したときTrue
+        """
+        temp_mtime = os.stat(self.template_path).st_mtime_ns
+        if self._state is not None and self._state[:3] == (ef, weight, temp_mtime) \
+                and os.path.exists(self.insp_path) and os.stat(self.insp_path).st_mtime_ns == self._state[3]:
+            return False
+
+        if self._template is None or self._state is None or self._state[2] != temp_mtime:
+            with open(self.template_path, "r") as f:
+                self._template = f.read()
+
+        with open(self.insp_path, "w") as f:
+            f.write(self.render(ef, weight))
+
+        self._state = (ef, weight, temp_mtime, os.stat(self.insp_path).st_mtime_ns)
+        return True
+
+    def render(self, ef, weight=None):
+        """
+        :return: case.inspの中身
+        """
+        lines = self._template.replace("0.xxxx", str(ef)).splitlines(keepends=True)
+
+        if weight is not None:
+            for l in range(len(lines)):
+                if "jatom, jcol, size" in lines[l]:
+                    out = lines[l].split()
+                    out[0] = str(weight[0])
+                    out[1] = str(weight[1])
+                    lines[l] = " ".join(out) + ("\n" if lines[l].endswith("\n") else "")
+
+        return "".join(lines)
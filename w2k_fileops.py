@@ -0,0 +1,177 @@
+import errno
+import glob
+import os
+import shutil
+
+
+class FileOpsError(Exception):
+    """
+    FileOpsでstrict=Trueのとき、失敗した操作があると送出される。
+    """
+
+
+def makedirs(path):
+    """
+    mkdir -p と同じ。
+    """
+    os.makedirs(path, exist_ok=True)
+
+
+def move(src, dst):
+    """
+    mv と同じ。同じファイルシステム内ではos.replaceで名前を変えるだけ。
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def copy(src, dst, link=False):
+    """
+    cp と同じ。dstがフォルダのときはその中に同じ名前でコピーする。
+    :param link: Trueのときハードリンクを作る（書き換えない出力ファイルのコピー用）。作れないときはコピーする
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+
+    if link:
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+
+
+def remove_tree(path):
+    """
+    rm -rf と同じ。
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def remove(pattern):
+    """
+    rm -f (pattern) と同じ。globのパターンを展開する。
+    :return: 削除したファイルの数
+    """
+    n = 0
+    for path in glob.glob(pattern):
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+            n += 1
+
+    return n
+
+
+class FileOps:
+    """
+    ファイル操作をまとめて実行し、失敗したものを報告する。
+    cp, mv, rmをサブプロセスで呼ばずにPythonの中で行う。
+
+    ops = FileOps(runner)
+    ops.move("case.bandsup.agr", "Bands/bands0up.bands.agr")
+    ops.copy("case.klist_band", "klists/klist0.klist_band")
+    ops.remove("*.broyd*")
+    ops.run()
+
+    cp/mv/rm/mkdirを毎回プロセスとして起動すると、１回あたり数msかかる。
+    またシェルを通さないので、"*.broyd*"のようなパターンはglobで展開する。
+    """
+
+    def __init__(self, runner=None, strict=False):
+        """
+        :param runner: w2k_trace.CommandRunner。あればまとめた操作の時間を"file"として記録する
+        :param strict: Trueのとき失敗した操作があればFileOpsErrorを送出する
+        """
+        self.runner = runner
+        self.strict = strict
+        self.ops = []
+        self.errors = []
+
+    def move(self, src, dst):
+        self.ops.append(("mv", move, (src, dst)))
+        return self
+
+    def copy(self, src, dst, link=False):
+        self.ops.append(("cp", copy, (src, dst, link)))
+        return self
+
+    def copy_glob(self, pattern, dst_dir, link=False):
+        """
+        cp (pattern) (dst_dir) と同じ。パターンは実行するときに展開する。
+        """
+        self.ops.append(("cp", self._copy_glob, (pattern, dst_dir, link)))
+        return self
+
+    def move_glob(self, pattern, dst_dir):
+        """
+        mv (pattern) (dst_dir) と同じ。パターンは実行するときに展開する。
+        """
+        self.ops.append(("mv", self._move_glob, (pattern, dst_dir)))
+        return self
+
+    def remove(self, pattern):
+        self.ops.append(("rm", remove, (pattern,)))
+        return self
+
+    def remove_tree(self, path):
+        self.ops.append(("rm", remove_tree, (path,)))
+        return self
+
+    def makedirs(self, path):
+        self.ops.append(("mkdir", makedirs, (path,)))
+        return self
+
+    def run(self):
+        """
+        ためた操作を順に実行する。失敗しても残りの操作は続ける。
+        :return: 失敗した操作のリスト [(操作, 引数, エラー), ...]
+        """
+        ops, self.ops = self.ops, []
+        errors = []
+
+        if self.runner is not None and ops:
+            with self.runner.timed("fileops", category="file"):
+                self._run_ops(ops, errors)
+        else:
+            self._run_ops(ops, errors)
+
+        for name, args, e in errors:
+            print(f"{name} {' '.join(str(a) for a in args if not isinstance(a, bool))}: {e}")
+
+        self.errors += errors
+        if errors and self.strict:
+            raise FileOpsError(f"{len(errors)} file operations failed.")
+
+        return errors
+
+    def _run_ops(self, ops, errors):
+        for name, func, args in ops:
+            try:
+                func(*args)
+            except OSError as e:
+                errors.append((name, args, e.strerror or e))
+
+    def _copy_glob(self, pattern, dst_dir, link):
+        paths = [p for p in glob.glob(pattern) if os.path.isfile(p)]
+        if not paths:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", pattern)
+        for p in paths:
+            copy(p, dst_dir, link=link)
+
+    def _move_glob(self, pattern, dst_dir):
+        paths = glob.glob(pattern)
+        if not paths:
+            raise FileNotFoundError(errno.ENOENT, "No such file or directory", pattern)
+        for p in paths:
+            move(p, os.path.join(dst_dir, os.path.basename(p)))
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def file_checksum(path):
+    """
+    :return: ファイルのsha256 (16進数)
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+class Journal:
+    """
+    klistごとの計算が終わったことをsave_dirのjournal.jsonlに記録し、止まった計算を途中から再開する。
+    １つのklistが終わるごとに、klistと出力ファイルのチェックサムを１行追記してfsyncする。
+    途中で止まって最後の行が壊れていても、その行は読み飛ばす。
+
+    journal = Journal(save_dir)
+    for name, klist in klists:
+        outputs = [...]
+        if journal.is_done(name, klist, outputs):
+            continue
+        ...
+        journal.record(name, klist, outputs)
+    """
+
+    file_name = "journal.jsonl"
+
+    def __init__(self, save_dir, total=None):
+        """
+        :param save_dir: 記録するフォルダ
+        :param total: 計算するklistの数。進み具合の表示に使う
+        """
+        self.save_dir = save_dir
+        self.path = f"{save_dir}/{self.file_name}"
+        self.total = total
+
+        self._newline = False  # 最後の行が途中で切れているときは、次の記録の前に改行を入れる
+        self.entries = self._load()  # {name: {"klist": ..., "outputs": {path: checksum}, "time": ...}}
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._numofdone = 0  # このセッションで計算した数
+        self._done = len(self.entries)  # 終わったklistの数
+
+    def _load(self):
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+
+        with open(self.path, "r") as f:
+            for line in f:
+                self._newline = not line.endswith("\n")
+                try:
+                    e = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 書き込み中に止まった行
+                entries[e["name"]] = e
+
+        return entries
+
+    def is_done(self, name, klist_path, outputs):
+        """
+        同じklistで計算した記録があり、出力ファイルが記録したときのままならTrue
+        :param name: klistの名前 (bands0など)
+        :param klist_path: 計算に使うklist_bandファイル
+        :param outputs: 出力ファイルのパスのリスト
+        """
+        e = self.entries.get(name)
+        if e is None or e["klist"] != file_checksum(klist_path):
+            return False
+
+        for path in outputs:
+            rel = self._rel(path)
+            if rel not in e["outputs"] or not os.path.exists(path) or file_checksum(path) != e["outputs"][rel]:
+                return False
+
+        return True
+
+    def pending(self, klists, outputs_of):
+        """
+        まだ終わっていないklistを返す。
+        :param klists: [(name, klist_path), ...]
+        :param outputs_of: nameから出力ファイルのリストを返す関数
+        :return: [(name, klist_path), ...]
+        """
+        todo = [(name, klist) for name, klist in klists if not self.is_done(name, klist, outputs_of(name))]
+
+        numofdone = len(klists) - len(todo)
+        self._done = numofdone
+        if numofdone:
+            print(f"{numofdone}/{len(klists)} klists are already done in {self.path}.")
+            if todo:
+                print(f"Resume from {todo[0][0]}.")
+
+        return todo
+
+    def record(self, name, klist_path, outputs):
+        """
+        klistの計算が終わったことを記録する。出力ファイルがそろっていなければ記録しない。
+        :return: 記録したときTrue
+        """
+        missing = [path for path in outputs if not os.path.exists(path)]
+        if missing:
+            print(f"{name} is not recorded in the journal. Missing : {', '.join(missing)}")
+            return False
+
+        e = {"name": name,
+             "klist": file_checksum(klist_path),
+             "outputs": {self._rel(path): file_checksum(path) for path in outputs},
+             "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(("\n" if self._newline else "") + json.dumps(e) + "\n")
+                self._newline = False
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[name] = e
+            self._numofdone += 1
+            self._done += 1
+
+        self.report()
+        return True
+
+    def report(self):
+        """
+        終わった数、残りの数、残り時間の目安を表示する。
+        """
+        done = self._done
+        text = f"Progress : {done}"
+        if self.total:
+            text += f"/{self.total} ({done / self.total * 100:.1f}%)"
+            if self._numofdone and self.total > done:
+                rest = (time.time() - self._start) / self._numofdone * (self.total - done)
+                text += f", about {rest / 60:.1f} min left"
+        print(text)
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.save_dir)
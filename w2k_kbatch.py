@@ -0,0 +1,220 @@
+import glob
+import os
+
+import numpy as np
+
+from w2k_agr import read_bands_agr
+from w2k_journal import Journal
+from w2k_klist import to_klist_ints, write_klist_files
+
+MAX_BATCH = 900  # １つの.klist_bandに入れるk点の数の上限。<1000
+
+
+def batch_size(numofk, parallel=1, max_batch=MAX_BATCH):
+    """
+    １つの.klist_bandに入れるk点の数を決める。
+    lapw1の起動の回数が少なくなるようにmax_batchまで詰め、.machinesの各ジョブのk点の数がそろうようにparallelの倍数にする。
+    最後のファイルだけ小さくならないように、同じファイルの数でなるべく均等に分ける。
+    :param numofk: 全てのk点の数
+    :param parallel: k点並列のジョブの数 (BaseController.parallel)
+    :return: １ファイルのk点の数
+    """
+    parallel = max(int(parallel), 1)
+    cap = max(parallel, max_batch // parallel * parallel)
+    numofbatches = max(1, -(-numofk // cap))
+    even = -(-numofk // numofbatches)
+
+    return min(cap, -(-even // parallel) * parallel)
+
+
+def calculate_band(controller, only_spin=""):
+    """
+    spin_polとSOCの設定に合わせて、BaseControllerのバンド計算の関数を呼ぶ。
+    :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+    """
+    if controller.spin_pol:
+        if controller.SOC:
+            controller.calculate_band_with_soc()
+        else:
+            controller.calculate_band_with_spin(only_spin=only_spin)
+    elif controller.SOC:
+        controller.calculate_band_with_soc()
+    else:
+        controller.calculate_band_normal()
+
+
+class KPointBatches:
+    """
+    IDを付けた任意のk点を.klist_bandにまとめて計算し、IDごとのエネルギーを返す。
+    結果はファイル名ではなくIDで引くので、ファイルの大きさは計算の速さだけで決められる。
+
+    {work_dir}/klists/klist{i}.klist_band : まとめたk点
+    {work_dir}/ids.npz : ファイルに書いた順のIDと、ファイルごとの始まり
+    {work_dir}/Bands/klist{i}{spin}.bands.agr : 計算した.bands.agr
+    {work_dir}/journal.jsonl : 終わったファイル。同じk点でもう一度実行すると飛ばす
+
+    batches = KPointBatches(controller, "NL_main/batches", only_spin="dn")
+    result = batches.calculate(ids, kpoints, denominator=d)
+    e = result.band(25, ids[:10])  # (10,)
+    """
+
+    def __init__(self, controller, work_dir, only_spin=""):
+        """
+        :param controller: BaseControllerを継承したインスタンス。spin_pol, SOC, parallelの設定を使う
+        :param work_dir: klist_bandと結果を保存するフォルダ (caseフォルダから)
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        """
+        self.controller = controller
+        self.work_dir = work_dir
+        self.only_spin = only_spin
+        self.size = None  # １ファイルのk点の数。Noneのときはbatch_sizeで決める
+
+    def calculate(self, ids, kpoints, denominator=None):
+        """
+        pack, run, unpackを順に行う。
+        :return: KBatchResult
+        """
+        self.pack(ids, kpoints, denominator)
+        self.run()
+        return self.unpack()
+
+    def pack(self, ids, kpoints, denominator=None):
+        """
+        k点を.klist_bandファイルに分けて書き、IDの順番を保存する。前に書いたklist_bandは消す。
+        :param ids: (n,)の重複しないint
+        :param kpoints: (n, 4)のint配列、またはdenominatorを与えたときは(n, 3)のk点(<1)
+        :return: ファイルの数
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if denominator is not None:
+            kpoints = to_klist_ints(kpoints, denominator)
+        kpoints = np.asarray(kpoints, dtype=np.int64).reshape(-1, 4)
+        if len(ids) != len(kpoints):
+            raise ValueError(f"{len(ids)} IDs are given for {len(kpoints)} k-points.")
+        if len(np.unique(ids)) != len(ids):
+            raise ValueError("IDs must be unique.")
+
+        klists_dir = f"{self.work_dir}/klists"
+        os.makedirs(klists_dir, exist_ok=True)
+        for old in glob.glob(f"{klists_dir}/klist*.klist_band"):
+            os.remove(old)
+
+        size = self.size or batch_size(len(ids), self.controller.parallel)
+        numofbatches = write_klist_files(f"{klists_dir}/klist{{}}.klist_band", kpoints, size) if len(ids) else 0
+        offsets = np.minimum(np.arange(numofbatches + 1) * size, len(ids))
+        np.savez(f"{self.work_dir}/ids.npz", ids=ids, offsets=offsets)
+        print(f"{len(ids)} k-points are packed into {numofbatches} klist_band files of {size} k-points.")
+
+        return numofbatches
+
+    def run(self):
+        """
+        まだ終わっていない.klist_bandを計算する。caseフォルダにstop.rtfを入れると止まる。
+        :return: 計算したファイルの数
+        """
+        c = self.controller
+        numofbatches = len(self._load_ids()[1]) - 1
+        klists = [(f"klist{i}", f"{self.work_dir}/klists/klist{i}.klist_band") for i in range(numofbatches)]
+        journal = Journal(self.work_dir, total=numofbatches)
+        todo = journal.pending(klists, self._outputs)
+        if not todo:
+            return 0
+
+        c.set_parallel(klist_path=todo[0][1])
+        for name, klist in todo:
+            c.force_stop()
+            c._file_ops().copy(klist, f"{c.case}.klist_band").run()
+            calculate_band(c, self.only_spin)
+
+            ops = c._file_ops().makedirs(f"{self.work_dir}/Bands")
+            for output, path in zip(c._band_outputs(self.only_spin), self._outputs(name)):
+                ops.move(f"{c.case}.{output}", path)
+            ops.run()
+            journal.record(name, klist, self._outputs(name))
+
+        return len(todo)
+
+    def unpack(self):
+        """
+        計算した.bands.agrを読み、k点のIDごとのエネルギーにする。まだ計算していないファイルのk点はnan。
+        :return: KBatchResult
+        """
+        ids, offsets = self._load_ids()
+
+        energies = {}
+        for spin in self.spins():
+            parts = []
+            for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+                path = self._band_path(f"klist{i}", spin)
+                if os.path.exists(path):
+                    parts.append(read_bands_agr(path)[1].T)  # (nk, nbands)
+                else:
+                    parts.append(np.full((end - start, 0), np.nan))
+            nbands = max([p.shape[1] for p in parts], default=0)
+            e = np.full((len(ids), nbands), np.nan)
+            for p, start in zip(parts, offsets[:-1]):
+                e[start:start + len(p), :p.shape[1]] = p
+            energies[spin] = e
+
+        return KBatchResult(ids, energies)
+
+    def spins(self):
+        """
+        :return: 結果のスピンの名前のリスト ("", "up", "dn")
+        """
+        return [o[len("bands"):-len(".agr")] for o in self.controller._band_outputs(self.only_spin)]
+
+    def _load_ids(self):
+        with np.load(f"{self.work_dir}/ids.npz") as f:
+            return f["ids"], f["offsets"]
+
+    def _band_path(self, name, spin):
+        return f"{self.work_dir}/Bands/{name}{spin}.bands.agr"
+
+    def _outputs(self, name):
+        return [self._band_path(name, spin) for spin in self.spins()]
+
+
+class KBatchResult:
+    """
+    KPointBatches.unpackの結果。k点のIDでエネルギーを引く。
+    """
+
+    def __init__(self, ids, energies):
+        """
+        :param ids: (n,)のk点のID
+        :param energies: {spin: (n, nbands)のエネルギー}。列mはバンド番号 (bandindex) m+1
+        """
+        order = np.argsort(ids, kind="stable")
+        self.ids = np.asarray(ids)[order]
+        self.spins = list(energies)
+        self._energies = {s: e[order] for s, e in energies.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, ids):
+        """
+        :return: IDの並びでの位置。ないIDがあるときはKeyError
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.ids, ids), max(len(self.ids) - 1, 0))
+        if len(self.ids) == 0 or not np.array_equal(self.ids[i], ids):
+            raise KeyError("Some IDs are not in the result.")
+        return i
+
+    def energies(self, ids=None, spin=None):
+        """
+        :param ids: k点のID。NoneのときはIDの小さい順に全て
+        :param spin: Noneのときは最初のスピン
+        :return: (len(ids), nbands)のエネルギー
+        """
+        e = self._energies[self.spins[0] if spin is None else spin]
+        return e if ids is None else e[self.index(ids)]
+
+    def band(self, band_index, ids=None, spin=None):
+        """
+        :param band_index: バンド番号 (.bands.agrのbandindex、1から)
+        :return: (len(ids),)のエネルギー
+        """
+        return self.energies(ids, spin)[:, band_index - 1]
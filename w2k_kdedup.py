@@ -0,0 +1,170 @@
+import glob
+import math
+import os
+
+import numpy as np
+
+import util
+from w2k_agr import read_agr_blocks, write_bands_agr
+from w2k_klist import read_klist_band, write_klist_band
+
+# 逆格子の単位(2π/a, 2π/b, 2π/c)で、同じ点とみなす逆格子ベクトル(h, k, l)のうち、2より小さいもの
+# 実格子の底心・面心・体心の並進で決まる、逆格子ベクトルの条件を満たすものを全て入れる
+_COSETS = [(h, k, l) for h in (0, 1) for k in (0, 1) for l in (0, 1)]
+CENTERING_TRANSLATIONS = {
+    "P": _COSETS,
+    "F": [(h, k, l) for h, k, l in _COSETS if h == k == l],  # h, k, lが全て偶数か全て奇数
+    "B": [(h, k, l) for h, k, l in _COSETS if (h + k + l) % 2 == 0],
+    "CXY": [(h, k, l) for h, k, l in _COSETS if (h + k) % 2 == 0],  # lは何でもよい
+    "CXZ": [(h, k, l) for h, k, l in _COSETS if (h + l) % 2 == 0],
+    "CYZ": [(h, k, l) for h, k, l in _COSETS if (k + l) % 2 == 0],
+}
+
+
+def read_struct_symmetry(struct_path):
+    """
+    case.structから格子の種類、格子定数、対称操作の回転行列を読む。
+    :return: (格子の種類 "P", "F", "B", "CXY", "H", ..., (a, b, c, alpha, beta, gamma), [3x3のint配列, ...])
+    """
+    with open(struct_path, "r") as f:
+        lines = f.read().splitlines()
+
+    lattice, params = util.read_struct_lattice(struct_path)
+
+    rotations = []
+    for n, line in enumerate(lines):
+        if "NUMBER OF SYMMETRY OPERATIONS" in line:
+            numofops = int(line.split()[0])
+            for i in range(numofops):
+                rows = lines[n + 1 + 4 * i:n + 4 + 4 * i]
+                rotations.append(np.array([[int(r[j:j + 2]) for j in (0, 2, 4)] for r in rows], dtype=np.int64))
+            break
+
+    return lattice, params, rotations
+
+
+class KPointDedup:
+    """
+    マッピングで作ったklist_bandファイル全体から同じk点を除き、lapw1で計算するk点を減らす。
+    symmetry=Trueのときは、case.structの点群と時間反転、逆格子ベクトルの分だけずれた点も同じ点とみなす。
+    代表点だけを計算し、その結果から元のklist_bandファイルごとの.bands.agrを作り直す。
+
+    対称性を使えるのは、直交する格子 (P, F, B, C) の普通のバンドだけ。
+    軌道の重み付きのバンドは、等価な点で重みが入れ替わるので対称性を使ってはいけない。
+    """
+
+    def __init__(self, klist_paths, struct_path=None, symmetry=False, time_reversal=True):
+        """
+        :param klist_paths: 元のklist_bandファイルのパスのリスト (この順に並べる)
+        :param struct_path: case.struct。symmetry=Trueのときと、k点の距離の計算に使う
+        :param symmetry: 対称操作で等価な点も同じ点とみなす
+        :param time_reversal: kと-kを同じ点とみなす。SOCを入れた磁性体ではFalseにする
+        """
+        self.klist_paths = list(klist_paths)
+        self.klists = [read_klist_band(p) for p in self.klist_paths]
+        self.struct_path = struct_path
+        self.lattice, self.params, rotations = ("P", None, [])
+        if struct_path is not None and os.path.exists(struct_path):
+            self.lattice, self.params, rotations = read_struct_symmetry(struct_path)
+
+        if symmetry and (self.lattice not in CENTERING_TRANSLATIONS or not util.is_orthogonal(self.params)):
+            print(f"Symmetry reduction is not supported for the {self.lattice} lattice. Only duplicates are removed.")
+            symmetry = False
+        self.symmetry = symmetry
+
+        allk = np.concatenate(self.klists) if self.klists else np.zeros((0, 4), dtype=np.int64)
+        self.offsets = np.cumsum([0] + [len(k) for k in self.klists])
+
+        # 全ての点を共通の分母Lの整数にする
+        self.L = math.lcm(*[int(d) for d in np.unique(allk[:, 3])]) if len(allk) else 1
+        self.K = allk[:, :3] * (self.L // allk[:, 3])[:, None]
+
+        keys = self._keys(rotations, time_reversal) if symmetry else self.K
+        _, self.rep_index, self.inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        self.inverse = self.inverse.reshape(-1)
+
+        # 代表点は元の点の中から選ぶので、分母も.klist_bandの書式もそのまま使える
+        order = np.argsort(self.rep_index)
+        self.rep_index = self.rep_index[order]
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.inverse = rank[self.inverse]
+        self.unique = allk[self.rep_index]
+
+    def _keys(self, rotations, time_reversal):
+        """
+        等価な点のなかで辞書順で最小のものを、その点のキーにする。
+        """
+        M = 2 * self.L
+        ops = [np.round(np.linalg.inv(r).T).astype(np.int64) for r in rotations] or [np.eye(3, dtype=np.int64)]
+        if time_reversal:
+            ops = ops + [-g for g in ops]
+        translations = np.array(CENTERING_TRANSLATIONS[self.lattice], dtype=np.int64) * self.L
+
+        best = None
+        for g in ops:
+            Kg = self.K @ g.T
+            for t in translations:
+                c = np.mod(Kg + t, M)
+                code = (c[:, 0] * M + c[:, 1]) * M + c[:, 2]
+                best = code if best is None else np.minimum(best, code)
+
+        return best[:, None]
+
+    def report(self):
+        n, u = len(self.inverse), len(self.unique)
+        print(f"{n} k-points -> {u} k-points to calculate ({(1 - u / max(n, 1)) * 100:.1f}% less)"
+              + (" using symmetry." if self.symmetry else "."))
+
+    def write_unique_klists(self, klists_dir, chunk=None):
+        """
+        代表点をchunk個ずつklist{j}.klist_bandに書く。
+        :param chunk: １ファイルのk点の数。Noneのときは元のファイルの最大の点の数
+        :return: 書いたファイルのパスのリスト
+        """
+        if chunk is None:
+            chunk = max([len(k) for k in self.klists] + [1])
+        self.chunk = chunk
+
+        os.makedirs(klists_dir, exist_ok=True)
+        for old in glob.glob(f"{klists_dir}/klist*.klist_band"):
+            os.remove(old)
+
+        paths = []
+        for j in range(0, len(self.unique), chunk):
+            path = f"{klists_dir}/klist{j // chunk}.klist_band"
+            write_klist_band(path, self.unique[j:j + chunk])
+            paths.append(path)
+
+        return paths
+
+    def expand_bands(self, unique_bands_dir, bands_dir, suffixes, chunk=None):
+        """
+        代表点のbands{j}{suffix}.bands.agrから、元のklist_bandファイルごとのbands{i}{suffix}.bands.agrを作る。
+        :param unique_bands_dir: 代表点の.bands.agrがあるフォルダ
+        :param bands_dir: 書き出すフォルダ
+        :param suffixes: ["up", "dn"]や[""]
+        """
+        chunk = chunk or self.chunk
+        os.makedirs(bands_dir, exist_ok=True)
+        numofchunks = (len(self.unique) + chunk - 1) // chunk
+
+        for s in suffixes:
+            parts = [read_agr_blocks(f"{unique_bands_dir}/bands{j}{s}.bands.agr") for j in range(numofchunks)]
+            header, prefix = parts[0][:2]
+            nbands = min(p[3].shape[0] for p in parts)
+            values = np.concatenate([p[3][:nbands, :, 1:] for p in parts], axis=1)  # (nbands, 代表点の数, 列)
+
+            for i in range(len(self.klists)):
+                idx = self.inverse[self.offsets[i]:self.offsets[i + 1]]
+                write_bands_agr(f"{bands_dir}/bands{i}{s}.bands.agr", header, prefix,
+                                 self._distance(self.klists[i]), values[:, idx])
+
+    def _distance(self, kpoints):
+        """
+        spaghettiと同じように、k点の間の距離を足していった横軸 (bohr^-1)
+        """
+        abc = np.array(self.params[:3]) if self.params is not None else np.ones(3)
+        k = kpoints[:, :3] / kpoints[:, 3:4] * (2 * np.pi / abc)
+        d = np.sqrt(((k[1:] - k[:-1]) ** 2).sum(axis=1))
+        return np.concatenate([[0.0], np.cumsum(d)])
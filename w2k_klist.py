@@ -0,0 +1,188 @@
+import numpy as np
+
+import util
+
+FIELD_WIDTH = 5  # .klist_bandのkx, ky, kz, 分母の桁数 (10X, 4I5)
+MIN_VALUE = -(10 ** (FIELD_WIDTH - 1) - 1)
+MAX_VALUE = 10 ** FIELD_WIDTH - 1
+CHUNK = 1 << 18  # １回に書き出す行数
+
+
+def plane_grid(na, nb, denominator, basis, origin=(0.0, 0.0, 1.0)):
+    """
+    面内の格子点(a, b) (0 <= a < na, 0 <= b < nb)をk点にし、0から1の範囲に折りたたむ。
+    k = origin + (a * basis[0] + b * basis[1]) / denominator
+
+    :param na: １つのklist_bandファイルのk点の数
+    :param nb: klist_bandファイルの数
+    :param denominator: 格子点を割る値
+    :param basis: (2, 3)の配列。klistの座標の基底ベクトル (util.plane_to_kbasisで作る)
+    :param origin: 格子点(0, 0)のk点
+    :return: (nb, na, 3)の配列 [[[kx, ky, kz], ...], ...]
+    """
+    ab = np.stack(np.meshgrid(np.arange(nb), np.arange(na), indexing="ij")[::-1], axis=-1)
+    k = np.asarray(origin, dtype=float) + ab @ np.asarray(basis, dtype=float) / denominator
+
+    return util.BZinside(k)
+
+
+def to_klist_ints(kpath, denominator):
+    """
+    k点(<1)を.klist_bandに書く整数にする。
+    :param kpath: (n, 3)の配列かリスト
+    :return: (n, 4)のint配列 [[kx, ky, kz, 分母], ...]
+    """
+    k = np.rint(np.asarray(kpath, dtype=float).reshape(-1, 3) * denominator).astype(np.int64)
+    return np.concatenate([k, np.full((len(k), 1), int(denominator), dtype=np.int64)], axis=1)
+
+
+class KlistBandWriter:
+    """
+    配列から.klist_bandファイルをchunk行ずつ書き出す。
+
+    with KlistBandWriter("case.klist_band") as w:
+        w.write(kpoints)  # (n, 4)のint配列
+    """
+
+    def __init__(self, path, chunk=CHUNK):
+        self.path = path
+        self.chunk = chunk
+        self.numofk = 0
+        self._f = open(path, "wb")
+
+    def write(self, kpoints):
+        """
+        :param kpoints: (n, 4)のint配列 [[kx, ky, kz, 分母], ...]
+        """
+        kpoints = np.asarray(kpoints, dtype=np.int64).reshape(-1, 4)
+        check_width(kpoints)
+
+        for start in range(0, len(kpoints), self.chunk):
+            lines = format_lines(kpoints[start:start + self.chunk])
+            if self.numofk == 0:
+                # １行目だけエネルギーの範囲を書く
+                first = lines[0].tobytes()[:-1] + b"-8.00 8.00\n"
+                self._f.write(first)
+                self._f.write(lines[1:].tobytes())
+            else:
+                self._f.write(lines.tobytes())
+            self.numofk += len(lines)
+
+    def close(self):
+        if self._f is not None:
+            self._f.write(b"END\n")
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def check_width(kpoints):
+    """
+    .klist_bandの５桁に入らない値があればValueErrorを送出する。
+    """
+    if len(kpoints) == 0:
+        return
+    lo, hi = kpoints.min(), kpoints.max()
+    if lo < MIN_VALUE or hi > MAX_VALUE:
+        raise ValueError(f"k-point value {lo if lo < MIN_VALUE else hi} does not fit in {FIELD_WIDTH} characters "
+                         f"({MIN_VALUE} to {MAX_VALUE}). Use a smaller denominator.")
+
+
+def format_lines(kpoints):
+    """
+    (n, 4)のint配列を、'          kx   ky   kz    d  2.0\\n'の行にする。
+    :return: (n, 36)のuint8配列
+    """
+    n = len(kpoints)
+    lines = np.full((n, 36), ord(" "), dtype=np.uint8)
+    for j in range(4):
+        lines[:, 10 + 5 * j:15 + 5 * j] = _format_ints(kpoints[:, j], FIELD_WIDTH)
+    lines[:, 30:35] = np.frombuffer(b"  2.0", dtype=np.uint8)
+    lines[:, 35] = ord("\n")
+
+    return lines
+
+
+def _format_ints(values, width):
+    """
+    整数を右詰めのwidth文字にする ("{:5}".formatと同じ)。
+    """
+    a = np.abs(values)[:, None]
+    power = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = (a // power) % 10
+    # 上の桁の0は空白にする (１の位は残す)
+    blank = (a < power) & (power > 1)
+    out = np.where(blank, ord(" "), ord("0") + digits).astype(np.uint8)
+
+    neg = np.flatnonzero(values < 0)
+    numofdigits = width - blank[neg].sum(axis=1)
+    out[neg, width - 1 - numofdigits] = ord("-")
+
+    return out
+
+
+def write_klist_band(path, kpoints, denominator=None):
+    """
+    .klist_bandファイルを書く。
+    :param kpoints: (n, 4)のint配列、またはdenominatorを与えたときは(n, 3)のk点(<1)
+    """
+    if denominator is not None:
+        kpoints = to_klist_ints(kpoints, denominator)
+
+    with KlistBandWriter(path) as w:
+        w.write(kpoints)
+
+
+def write_klist_files(path_format, kpoints, numofk, start=0):
+    """
+    k点をnumofk点ずつ別の.klist_bandファイルに書く。
+    :param path_format: "NL_main/klists/klist{}.klist_band"のような書式
+    :param kpoints: (n, 4)のint配列
+    :param numofk: １ファイルのk点の数
+    :param start: 最初のファイルの番号
+    :return: 書いたファイルの数
+    """
+    kpoints = np.asarray(kpoints, dtype=np.int64).reshape(-1, 4)
+    check_width(kpoints)
+
+    i = start
+    for s in range(0, len(kpoints), numofk):
+        write_klist_band(path_format.format(i), kpoints[s:s + numofk])
+        i += 1
+
+    return i - start
+
+
+def read_klist_band(path):
+    """
+    .klist_bandのk点を読む。
+    :return: (n, 4)のint配列 [[kx, ky, kz, 分母], ...]
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    first, _, rest = data.partition(b"\n")
+    end = rest.find(b"END")
+    rest = rest[:end] if end >= 0 else rest
+    if first.startswith(b"END"):
+        return np.zeros((0, 4), dtype=np.int64)
+
+    if len(rest) % 36 == 0 and rest[35:36] in (b"\n", b""):
+        # KlistBandWriterで書いた２行目以降は全て36文字
+        lines = np.frombuffer(rest, dtype=np.uint8).reshape(-1, 36)[:, 10:30]
+        raw = np.concatenate([np.frombuffer(first[10:30].ljust(20), dtype=np.uint8)[None], lines])
+    else:
+        fields = [line[10:30].ljust(20) for line in [first] + rest.split(b"\n") if line.strip()]
+        raw = np.frombuffer(b"".join(fields), dtype=np.uint8)
+
+    raw = raw.reshape(-1, 4, FIELD_WIDTH)
+    is_digit = (raw >= ord("0")) & (raw <= ord("9"))
+    digits = np.where(is_digit, raw.astype(np.int64) - ord("0"), 0)
+    values = (digits * 10 ** np.arange(FIELD_WIDTH - 1, -1, -1)).sum(axis=2)
+
+    return np.where((raw == ord("-")).any(axis=2), -values, values)
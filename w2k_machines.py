@@ -0,0 +1,200 @@
+import json
+import math
+import os
+import time
+
+TUNING_FILE = "parallel_tuning.json"  # caseフォルダに保存する並列数の調整結果
+
+
+def count_kpoints(klist_path):
+    """
+    .klistまたは.klist_bandファイルのk点の数を数える。
+    :param klist_path: ファイルのパス
+    :return: k点の数。ファイルがないときはNone
+    """
+    if not os.path.exists(klist_path):
+        return None
+
+    n = 0
+    with open(klist_path, "r") as f:
+        for line in f:
+            if line.startswith("END"):
+                break
+            if line.strip():
+                n += 1
+
+    return n
+
+
+def load_tuned_parallel(case_path, task):
+    """
+    調整済みの並列数を読み込む。
+    :param case_path: caseフォルダ
+    :param task: "scf", "band", "dos"
+    :return: {"parallel": int, "omp": int, ...}。調整していないときはNone
+    """
+    path = f"{case_path}/{TUNING_FILE}"
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as f:
+        tuned = json.load(f)
+
+    return tuned.get(task)
+
+
+def save_tuned_parallel(case_path, task, parallel, omp, timings):
+    """
+    調整した並列数をcaseフォルダのparallel_tuning.jsonに保存する。
+    :param timings: {"parallel x omp": 計測時間(s)}
+    """
+    path = f"{case_path}/{TUNING_FILE}"
+    tuned = {}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            tuned = json.load(f)
+
+    tuned[task] = {"parallel": parallel, "omp": omp, "timings": timings,
+                   "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    with open(path, "w") as f:
+        json.dump(tuned, f, indent=2)
+
+
+class MachinesBuilder:
+    """
+    .machinesファイルを作る。
+    k点の数と使えるコア数から、各ジョブのk点数がなるべく均等になるようにk並列の行数を決める。
+    OpenMPのスレッド数を組み合わせたハイブリッドな並列化もできる。
+
+    hosts = {"localhost": 8, "node2": 16} のようにホスト名とコア数を指定する。
+    host_weights = {"node2": 2} のようにホストの速さの重みを指定すると、そのホストのk並列行の重みになる。
+    """
+
+    def __init__(self, hosts=None):
+        """
+        :param hosts: {ホスト名: コア数}。Noneのときはlocalhostの全コア
+        """
+        if hosts is None:
+            hosts = {"localhost": os.cpu_count() or 1}
+        self.hosts = dict(hosts)
+        self.host_weights = {}
+
+        self.granularity = 1  # k点を (重みの合計 * granularity) 個に分割する
+        self.extrafine = 1  # 割り切れないk点を各ジョブに１つずつ配る
+        self.min_kpoints_per_job = 1  # １ジョブあたりの最小のk点数
+        self.omp_efficiency = 0.8  # OpenMPの並列化効率。スレッド数tで速さがt**omp_efficiency倍になるとする
+
+        self.lapw0_mpi = 0  # lapw0をMPIで走らせるコア数 (0のとき書かない)
+        self.dstart_mpi = 0  # dstartをMPIで走らせるコア数 (0のとき書かない)
+
+    def k_parallel(self, numofk=None):
+        """
+        OpenMPを使わないk並列の.machinesの中身を作る。
+        :param numofk: k点の数。Noneのときはコア数だけジョブを作る
+        :return: .machinesの文字列
+        """
+        return self._text(self._layout(numofk, omp=1))
+
+    def hybrid(self, numofk=None, omp=0):
+        """
+        k並列とOpenMPを組み合わせた.machinesの中身を作る。
+        :param numofk: k点の数
+        :param omp: スレッド数。0のとき、見積もった計算時間が最小になるように自動で決める
+        :return: .machinesの文字列
+        """
+        return self._text(self._layout(numofk, omp=omp))
+
+    def write(self, path, text):
+        with open(path, "w") as f:
+            f.write(text)
+        print(f".machines is written to {path}")
+
+    def _layout(self, numofk, omp):
+        """
+        ホストごとのジョブ数と、全ホスト共通のスレッド数を決める（.machinesのomp_globalは１つしか書けない）。
+        k点はコア数と重みに比例してホストに配る。
+        最も多くのk点を持つジョブの計算時間を ceil(k点数 / ジョブ数) / threads**omp_efficiency と見積もり、
+        全ホストで最大の見積もりが最小になるスレッド数を選ぶ。
+        :return: ([(ホスト名, ジョブ数), ...], スレッド数)
+        """
+        min_cores = min(max(int(c), 1) for c in self.hosts.values())
+        if omp > 0:
+            candidates = [min(int(omp), min_cores)]
+        else:
+            candidates = range(1, min_cores + 1)
+
+        total = sum(self._power(h) for h in self.hosts)
+
+        best = None
+        for threads in candidates:
+            jobs_list = []
+            cost = 0
+            for host, cores in self.hosts.items():
+                if numofk is None:
+                    host_k = None
+                else:
+                    host_k = max(int(round(numofk * self._power(host) / total)), 1)
+                jobs, host_cost = self._split(host_k, max(int(cores), 1), threads)
+                jobs_list.append((host, jobs))
+                cost = max(cost, host_cost)
+
+            # 同じ見積もりならジョブ数とスレッド数の少ない方を選ぶ（余ったジョブはオーバーヘッドにしかならない）
+            key = (round(cost, 9), sum(j for _, j in jobs_list), threads)
+            if best is None or key < best[0]:
+                best = (key, jobs_list, threads)
+
+        return best[1], best[2]
+
+    def _split(self, numofk, cores, threads):
+        """
+        １ホストのジョブ数と計算時間の見積もりを返す。
+        """
+        jobs = max(cores // threads, 1)
+        if numofk is None:
+            return jobs, 1 / (jobs * threads ** self.omp_efficiency)
+
+        jobs = min(jobs, max(numofk // self.min_kpoints_per_job, 1))
+        # 最大のジョブのk点数を変えずにジョブ数を減らす
+        chunk = math.ceil(numofk / jobs)
+        jobs = math.ceil(numofk / chunk)
+
+        return jobs, chunk / threads ** self.omp_efficiency
+
+    def _power(self, host):
+        return self.hosts[host] * self.host_weights.get(host, 1)
+
+    def _text(self, layout):
+        lines = ["# .machines made by MachinesBuilder"]
+
+        if self.lapw0_mpi:
+            lines.append(f"lapw0:{self._mpi_hosts(self.lapw0_mpi)}")
+        if self.dstart_mpi:
+            lines.append(f"dstart:{self._mpi_hosts(self.dstart_mpi)}")
+
+        jobs_list, threads = layout
+        for host, jobs in jobs_list:
+            weight = self.host_weights.get(host, 1)
+            for _ in range(jobs):
+                lines.append(f"{weight}:{host}")
+
+        lines.append(f"granularity:{self.granularity}")
+        lines.append(f"extrafine:{self.extrafine}")
+        lines.append(f"omp_global:{threads}")
+
+        return "\n".join(lines) + "\n"
+
+    def _mpi_hosts(self, numofcores):
+        """
+        lapw0/dstartのMPI行 "host:n host2:m" を作る。先頭のホストから順にコアを割り当てる。
+        """
+        out = []
+        rest = numofcores
+        for host, cores in self.hosts.items():
+            if rest <= 0:
+                break
+            n = min(cores, rest)
+            out.append(f"{host}:{n}")
+            rest -= n
+
+        return " ".join(out)
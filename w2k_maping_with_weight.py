@@ -1,9 +1,9 @@
 # import datetime
 import os
-import subprocess
 
 # from WIEN2k_controller import BaseController
 from w2k_band_with_weight import CaluculateWithOrbit
+from w2k_journal import Journal
 
 
 class W2kMappingWithWeight(CaluculateWithOrbit):
@@ -30,15 +30,19 @@ class W2kMappingWithWeight(CaluculateWithOrbit):
         klist_folder = f"{data_folder}/klists"
         klists = os.listdir(klist_folder)  # get klist file names as list
         klists.sort(reverse=False)
-        for klist in klists:
-            if "klist_band" in klist:
-                # copy klist_band file from klist_folder
-                subprocess.run(["cp", f"{klist_folder}/{klist}", f"{self.case}.klist_band"])
-                base_name = klist.split(".")[0]
 
-                # print(klist, base_name)
-                out_folder = f"{data_folder}/Bands/{base_name}"
-                self.calculate_band_with_orbit(outfol=out_folder, atom_dict=atom_dict, do_lapw=True)
+        # 終わったklistは{data_folder}/journal.jsonlに記録し、やり直したときは飛ばす
+        journal = Journal(data_folder, total=len([k for k in klists if "klist_band" in k]))
+        todo = journal.pending([(k.split(".")[0], f"{klist_folder}/{k}") for k in klists if "klist_band" in k],
+                               lambda base_name: self._orbit_band_paths(data_folder, base_name, atom_dict))
+        for base_name, klist_path in todo:
+            # copy klist_band file from klist_folder
+            self._file_ops().copy(klist_path, f"{self.case}.klist_band").run()
+
+            # print(klist, base_name)
+            out_folder = f"{data_folder}/Bands/{base_name}"
+            self.calculate_band_with_orbit(outfol=out_folder, atom_dict=atom_dict, do_lapw=True)
+            journal.record(base_name, klist_path, self._orbit_band_paths(data_folder, base_name, atom_dict))
 
             if os.path.exists("stop.rtf"):
                 print("Force stop!!")
@@ -46,8 +50,18 @@ class W2kMappingWithWeight(CaluculateWithOrbit):
 
         self._organize_folders(data_folder, klists)
 
+    def _orbit_band_paths(self, data_folder, base_name, atom_dict):
+        """
+        calculate_band_with_orbitで{data_folder}/Bands/{base_name}に保存される.bands.agrのパスのリスト
+        """
+        spins = ["up", "dn"] if self.spin_pol else [""]
+        return [f"{data_folder}/Bands/{base_name}/{atomname}_{orbitname}{spin}.bands.agr"
+                for atomname, d in atom_dict.items() for orbitname in d["orbitname"] for spin in spins]
+
     def _organize_folders(self, data_folder: str, klists):
         # print(klists)
+        # 出力ファイルは書き換えないので、コピーの代わりにハードリンクを作る
+        ops = self._file_ops()
         for klist in klists[1:]:
             if "klist_band" in klist:
                 base_name = klist.split(".")[0]
@@ -62,13 +76,14 @@ class W2kMappingWithWeight(CaluculateWithOrbit):
                             spin = "up"
                         else:
                             spin = "dn"
-                        subprocess.run(["cp", f"{data_folder}/Bands/{base_name}/{bands}",
-                                        f"{data_folder}/{orb}/{base_name}{spin}.bands.agr"])
+                        ops.copy(f"{data_folder}/Bands/{base_name}/{bands}",
+                                 f"{data_folder}/{orb}/{base_name}{spin}.bands.agr", link=True)
                     else:
                         orb = bands.split(".")[0]
                         self._make_orb_folder(data_folder, orb)
-                        subprocess.run(["cp", f"{data_folder}/Bands/{base_name}/{bands}",
-                                        f"{data_folder}/{orb}/{base_name}.bands.agr"])
+                        ops.copy(f"{data_folder}/Bands/{base_name}/{bands}",
+                                 f"{data_folder}/{orb}/{base_name}.bands.agr", link=True)
+        ops.run()
 
     def _make_orb_folder(self, data_folder, orb):
         orb_fol = f"{data_folder}/{orb}"
@@ -1,13 +1,16 @@
-import datetime
 import os
-import subprocess
 import glob
+import threading
 import util
-import numpy as np
-from pprint import pprint
 
 from WIEN2k_controller import BaseController
-import send_email as se
+from w2k_band_cube import BandCube
+from w2k_contour import extract_contours, write_contours
+from w2k_journal import Journal
+from w2k_kdedup import KPointDedup
+from w2k_klist import plane_grid
+from w2k_trace import print_summary
+from w2k_worker_pool import WorkerPool
 
 class W2kMapping(BaseController):
     """
@@ -18,12 +21,16 @@ class W2kMapping(BaseController):
         super().__init__(case)
         os.chdir(self.case_path)
 
+        self.cube_meta = {}  # BandCubeのmeta.jsonに書く情報 (分母、面内の基底ベクトルなど)
+        self._cube = None
+        self._cube_lock = threading.RLock()  # WorkerPoolのスレッドからも_pack_klistで入れる
+
     def make_klist_folder(self, save_dir: str, kpath: list, denominator: int):
         self.make_klist_band(kpath, denominator)
 
         numofklists = len(glob.glob(f"{save_dir}/klists/*.klist_band"))
 
-        subprocess.run(["cp", f"{self.case}.klist_band", f"{save_dir}/klists/klist{numofklists}.klist_band"])
+        self._file_ops().copy(f"{self.case}.klist_band", f"{save_dir}/klists/klist{numofklists}.klist_band").run()
 
     def make_folder(self, save_dir):
         if not os.path.exists(f"{save_dir}/klists"):
@@ -46,8 +53,8 @@ class W2kMapping(BaseController):
 
     def calculate_bands_template(self, save_dir, save_name, kpath, denominator):
         self.force_stop()
-        self.set_parallel()
         self.make_klist_band(kpath, denominator=denominator)
+        self.set_parallel()
 
         if self.spin_pol:
             self.calculate_band_with_spin()
@@ -56,14 +63,43 @@ class W2kMapping(BaseController):
 
         self._save_results_for_map(save_dir, save_name)
 
-    def calculate_bands_from_klistsdir(self, save_dir: str, only_spin=""):
+    def calculate_bands_from_klistsdir(self, save_dir: str, only_spin="", workers=1, cube=False):
+        """
+        {save_dir}/klists内のklist{i}.klist_bandを順に計算し、{save_dir}/Bands/bands{i}*.bands.agrに保存する。
 
-        self.set_parallel()
+        :param save_dir:
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        :param workers: 1より大きいとき、caseフォルダを複製した作業フォルダをworkers個作って並列に計算する。
+                        各作業フォルダはparallelの数で並列計算する。
+        :param cube: Trueのとき、klistが終わるごとに{save_dir}/cubeのBandCubeに書き足す
+        :return:
+        """
         numofklists = len(glob.glob(f"{save_dir}/klists/*.klist_band"))
-        for i in range(numofklists):
-            klist = f"{save_dir}/klists/klist{i}.klist_band"
+
+        # 終わったklistは{save_dir}/journal.jsonlに記録し、やり直したときは飛ばす
+        journal = Journal(save_dir, total=numofklists)
+        klists = [(f"bands{i}", f"{save_dir}/klists/klist{i}.klist_band") for i in range(numofklists)]
+        klists = journal.pending(klists, lambda name: self._bandsagr_paths(save_dir, name, only_spin))
+        if cube:
+            self.pack_bands(save_dir)  # 前に計算した分
+        if not klists:
+            return
+
+        def on_done(name, klist):
+            if journal.record(name, klist, self._bandsagr_paths(save_dir, name, only_spin)) and cube:
+                self._pack_klist(save_dir, name)
+
+        if workers > 1:
             self.force_stop()
-            print(f"Calculation starts for number {i}")
+            pool = WorkerPool(self, workers)
+            pool.calculate_klists(save_dir, klists, only_spin=only_spin, on_done=on_done)
+            pool.remove_workers(save_dir)
+            return
+
+        self.set_parallel(klist_path=klists[0][1])
+        for save_name, klist in klists:
+            self.force_stop()
+            print(f"Calculation starts for {save_name}")
             self._cp_klist_band(klist)
             if self.spin_pol:
                 if self.SOC:
@@ -75,7 +111,83 @@ class W2kMapping(BaseController):
             else:
                 self.calculate_band_normal()
 
-            self._save_only_bandsagr(f"{save_dir}", f"bands{i}", only_spin=only_spin)
+            self._save_only_bandsagr(f"{save_dir}", save_name, only_spin=only_spin)
+            on_done(save_name, klist)
+
+    def calculate_bands_dedup(self, save_dir: str, only_spin="", workers=1, symmetry=False, chunk=None, cube=False):
+        """
+        {save_dir}/klists内の全てのklist_bandファイルから同じk点（symmetry=Trueのときは等価なk点も）を除いて計算し、
+        結果を元のklist_bandファイルごとの{save_dir}/Bands/bands{i}*.bands.agrに並べ直す。
+        代表点は{save_dir}/unique/klistsに書き、calculate_bands_from_klistsdirで計算する。
+
+        :param save_dir:
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        :param workers: calculate_bands_from_klistsdirと同じ
+        :param symmetry: case.structの対称操作で等価なk点も除く。SOCを入れた磁性体では時間反転を使わない
+        :param chunk: 代表点の１ファイルのk点の数。Noneのときは元のファイルと同じ
+        :param cube: Trueのとき、並べ直した.bands.agrを{save_dir}/cubeのBandCubeにまとめる
+        :return: KPointDedup
+        """
+        numofklists = len(glob.glob(f"{save_dir}/klists/*.klist_band"))
+        dedup = KPointDedup([f"{save_dir}/klists/klist{i}.klist_band" for i in range(numofklists)],
+                            struct_path=self._filepath("struct"), symmetry=symmetry,
+                            time_reversal=not (self.SOC and self.spin_pol))
+        dedup.report()
+
+        unique_dir = f"{save_dir}/unique"
+        dedup.write_unique_klists(f"{unique_dir}/klists", chunk=chunk)
+        self.calculate_bands_from_klistsdir(unique_dir, only_spin=only_spin, workers=workers)
+
+        suffixes = [o[len("bands"):-len(".agr")] for o in self._band_outputs(only_spin)]
+        dedup.expand_bands(f"{unique_dir}/Bands", f"{save_dir}/Bands", suffixes)
+        print(f"Bands are expanded to {save_dir}/Bands.")
+        if cube:
+            self.pack_bands(save_dir, refresh=True)
+
+        return dedup
+
+    def pack_bands(self, save_dir: str, refresh=False):
+        """
+        {save_dir}/Bandsの.bands.agrを{save_dir}/cubeのBandCubeにまとめる。入れたklistは飛ばす。
+        self.cube_metaの内容をmeta.jsonに書く。
+        :param refresh: Trueのときは全て読み直す
+        :return: BandCube。まだ.bands.agrがないときはNone
+        """
+        with self._cube_lock:
+            cube_dir = f"{save_dir}/cube"
+            if self._cube is None or self._cube.cube_dir != cube_dir or not os.path.exists(f"{cube_dir}/meta.json"):
+                meta = {"case": self.case, "spin_pol": self.spin_pol, "SOC": self.SOC, **self.cube_meta}
+                self._cube = BandCube.from_mapping(save_dir, self._cube_spins(), meta=meta)
+            if self._cube is None:
+                return None
+
+            if refresh:
+                self._cube.filled[:] = False
+            self._cube.ingest(save_dir)
+
+        return self._cube
+
+    def _pack_klist(self, save_dir, save_name):
+        # BandCube._growで配列を作り直している間に他のスレッドが書かないように、全体をロックする
+        with self._cube_lock:
+            cube = self._cube
+            if cube is None or cube.cube_dir != f"{save_dir}/cube":
+                self.pack_bands(save_dir)
+            else:
+                cube.add_klist(save_dir, int(save_name[len("bands"):]))
+
+    def _cube_spins(self):
+        """
+        キューブのスピンの軸。片方のスピンだけ計算するときも両方の場所を作る。
+        """
+        return [o[len("bands"):-len(".agr")] for o in self._band_outputs("")]
+
+    def _bandsagr_paths(self, save_dir, save_name, only_spin=""):
+        """
+        _save_only_bandsagrで保存される.bands.agrのパスのリスト
+        """
+        return [f"{save_dir}/Bands/{save_name}{o[len('bands'):-len('.agr')]}.bands.agr"
+                for o in self._band_outputs(only_spin)]
 
     def _cp_klist_band(self, klist: str):
         """klists_dir内のklistをコピーする。
@@ -83,7 +195,7 @@ class W2kMapping(BaseController):
         :param klists_dir:
         :return:
         """
-        subprocess.run(["cp", f"{klist}", f"{self.case}.klist_band"])
+        self._file_ops().copy(klist, f"{self.case}.klist_band").run()
 
     def _save_results_for_map(self, save_dir, save_name):
         """
@@ -91,31 +203,36 @@ class W2kMapping(BaseController):
         """
         if not os.path.exists(f"{save_dir}/klists"):
             os.makedirs(f"{save_dir}/klists", exist_ok=True)
-        subprocess.run(["mv", f"{self.case}.klist_band", f"{save_dir}/klists/{save_name}.klist_band"])
+        ops = self._file_ops()
+        ops.move(f"{self.case}.klist_band", f"{save_dir}/klists/{save_name}.klist_band")
     
         if not os.path.exists(f"{save_dir}/Bands"):
             os.makedirs(f"{save_dir}/Bands")
     
         if self.spin_pol:
             for spin in ["up", "dn"]:
-                subprocess.run(["mv", f"{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr"])
+                ops.move(f"{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr")
         else:
-            subprocess.run(["mv", f"{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr"])
+            ops.move(f"{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr")
+        ops.run()
 
-    def _save_only_bandsagr(self, save_dir, save_name, only_spin=""):
-        if not os.path.exists(f"{save_dir}/Bands"):
-            os.makedirs(f"{save_dir}/Bands")
+    def _save_only_bandsagr(self, save_dir, save_name, only_spin="", work_dir="."):
+        """
+        .bands.agrを{save_dir}/Bandsに移動する。
+        :param work_dir: .bands.agrがあるフォルダ。WorkerPoolの作業フォルダから集めるときに使う
+        """
+        ops = self._file_ops().makedirs(f"{save_dir}/Bands")
 
         if self.spin_pol:
             if only_spin == "":
                 for spin in ["up", "dn"]:
-                    subprocess.run(
-                        ["mv", f"{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr"])
+                    ops.move(f"{work_dir}/{self.case}.bands{spin}.agr", f"{save_dir}/Bands/{save_name}{spin}.bands.agr")
             else:
-                subprocess.run(
-                    ["mv", f"{self.case}.bands{only_spin}.agr", f"{save_dir}/Bands/{save_name}{only_spin}.bands.agr"])
+                ops.move(f"{work_dir}/{self.case}.bands{only_spin}.agr",
+                         f"{save_dir}/Bands/{save_name}{only_spin}.bands.agr")
         else:
-            subprocess.run(["mv", f"{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr"])
+            ops.move(f"{work_dir}/{self.case}.bands.agr", f"{save_dir}/Bands/{save_name}.bands.agr")
+        ops.run()
 
 
 if __name__ == "__main__":
@@ -133,28 +250,31 @@ if __name__ == "__main__":
     xug_size = 301  # ひとつのklist_bandファイルで計算するk点の数。
     mapping_direction_size = 301  # 作られるklist_bandファイルの数。
     k3_size = 0
+    wave_basis = [[1, 1, 0], [-1, 1, 0]]  # 波a, 波bの方向 (デカルト座標、2π/a単位)
+    origin = (0.0, 0.0, 1.0)  # 格子点(0, 0)のk点 (klistの座標)
 
     is_klist = wm.make_folder(save_dir)
     if not is_klist:
-        for mapping_direction in range(mapping_direction_size): # 波b
-            kpath = [] # klist_bandに入れる波数点を納品するリストを初期化
-            for xug in range(xug_size): # 波a
-                kab = np.array([xug, mapping_direction]) # 波ベクトルを定義
-                kxy = util.rotate_vector(kab, 45) * np.sqrt(2) # 波基底→k基底変換のため、ベクトルを45度回転してルート2倍する
-                print(f"rotate {kab} -> {kxy}")
-                kpath.append([util.BZinside(kxy[0] / denominator), util.BZinside(kxy[1] / denominator), 1.0]) # 波数てんを納品
-            pprint(kpath)
+        # 波基底(a, b)の格子点をまとめてk基底に変換し、0から1に折りたたむ
+        basis = util.plane_to_kbasis(wave_basis, f"{case}.struct")
+        grid = plane_grid(xug_size, mapping_direction_size, denominator, basis, origin=origin)  # (波b, 波a, 3)
+        for kpath in grid:
             wm.make_klist_folder(save_dir, kpath, denominator) # kpathからklist_bandファイルへ変換
-            print(f"klist_band files are made in {case}/{save_dir}/klists.")
+        print(f"klist_band files are made in {case}/{save_dir}/klists.")
 
     is_good = input("Are the klist_band files on target? (y/n) : ")
 
-    start = datetime.datetime.now()
     if is_good == "y":
-        wm.calculate_bands_from_klistsdir(save_dir, only_spin="")
-        end = datetime.datetime.now()
-        delta = end - start
-        print(f"This calculation takes {delta}.")
+        wm.trace(f"{save_dir}/trace.jsonl")
+        wm.use_band_cache()  # やり直したときに計算済みのklistを飛ばす
+        # 同じk点をまとめて計算する。重み付きでない普通のバンドならsymmetry=Trueで等価なk点もまとめられる
+        # 結果は{save_dir}/cubeにまとめる (BandCube(f"{save_dir}/cube")で開く)
+        wm.cube_meta = {"denominator": denominator, "wave_basis": wave_basis,
+                        "origin": util.kbasis_to_cartesian(origin, f"{case}.struct").tolist()}
+        wm.calculate_bands_dedup(save_dir, only_spin="", workers=1, symmetry=True, cube=True)
+        # フェルミ面 (E = 0 eV) の線を{save_dir}/contours.npzに書く
+        write_contours(f"{save_dir}/contours.npz", extract_contours(BandCube(f"{save_dir}/cube"), energies=[0.0]))
+        print_summary(wm.runner.trace_path)
     else:
         exit()
     #subprocess.run(["rm", "-r", f"{save_dir}"])
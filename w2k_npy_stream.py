@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+
+CHUNK = 1 << 20  # 一度に読み書きする行の数
+
+
+class NpyAppender:
+    """
+    行の数が前もって分からない(n, width)の配列を、全体をメモリに持たずに少しずつ.npyに書く。
+    書いている間は{path}.partに生のデータを足していき、closeでメモリマップした.npyに移す。
+
+    with NpyAppender("degen_klist_all.npy", np.int32, 3) as w:
+        for slab in slabs:
+            w.append(slab)
+    """
+
+    def __init__(self, path, dtype, width):
+        """
+        :param path: 書く.npyのパス
+        :param dtype: 配列の型 (np.int32など)
+        :param width: １行の要素の数
+        """
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.width = int(width)
+        self.numofrows = 0
+        self._part = f"{path}.part"
+        self._f = open(self._part, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+            os.remove(self._part)
+
+    def append(self, rows):
+        """
+        :param rows: (m, width)の配列。dtypeに変換して書く
+        """
+        rows = np.ascontiguousarray(np.asarray(rows).reshape(-1, self.width), dtype=self.dtype)
+        self._f.write(rows.tobytes())
+        self.numofrows += len(rows)
+
+    def close(self):
+        """
+        書いた行を.npyにする。
+        :return: 行の数
+        """
+        self._f.close()
+        out = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype, shape=(self.numofrows, self.width))
+        if self.numofrows:
+            part = np.memmap(self._part, dtype=self.dtype, mode="r", shape=(self.numofrows, self.width))
+            for start in range(0, self.numofrows, CHUNK):
+                out[start:start + CHUNK] = part[start:start + CHUNK]
+            del part
+        out.flush()
+        del out
+        os.remove(self._part)
+
+        return self.numofrows
+
+
+def iter_rows(array, chunk=CHUNK):
+    """
+    配列を先頭の軸でchunk行ずつ返す。.npyのパスを与えたときはメモリマップで開く。
+    :param array: 配列 (np.memmapなど) か.npyのパス
+    :return: (start, 配列)を返すジェネレータ。配列はメモリに読んだコピー
+    """
+    a = np.load(array, mmap_mode="r") if isinstance(array, str) else array
+    for start in range(0, len(a), chunk):
+        yield start, np.array(a[start:start + chunk])
@@ -1,10 +1,9 @@
 import datetime
 import glob
 import os
-import subprocess
 
-import send_email as se
 from WIEN2k_controller import BaseController
+from w2k_scf_monitor import read_scf
 
 class W2kOptimization(BaseController):
     """
@@ -71,10 +70,7 @@ class W2kOptimization(BaseController):
         if self.spin_pol:
             com_list.insert(2, "-sp")
 
-        print("run " + " ".join(com_list))
-        # with open("init_test.txt", mode="w") as f:
-        #     f.write("")
-        subprocess.run(com_list)
+        self._run(com_list)
 
     def _scf(self):
         if self.spin_pol:
@@ -99,26 +95,21 @@ class W2kOptimization(BaseController):
         if self.ni:
             com_list.append("-NI")
 
-        print("run " + " ".join(com_list))
-        # with open("scf_test.txt", mode="w") as f:
-        #     f.write("")
-        subprocess.run(com_list)
+        self._run(com_list)
 
     def _get_etot(self):
-        if os.path.exists("*.scf"):
-            with open(self.case + ".scf", "r") as f:
-                line_list = f.readlines()
-        else:
-            with open(self.case + ".scfm", "r") as f:
-                line_list = f.readlines()
+        """
+        最後のSCFサイクルの全エネルギーを返す。
+        SCF中にScfMonitorが読んだ値がなければcase.scfmを読む。
+        """
+        etot = self.scf_monitor.last("ENE") if self.scf_monitor is not None else None
+        if etot is None and os.path.exists(self.case + ".scfm"):
+            ene = [it["ENE"] for it in read_scf(self.case + ".scfm") if "ENE" in it]
+            if ene:
+                etot = ene[-1]
 
-        for l in line_list:
-            l = l.split(" ")
-            if l[0] == ":ENE":
-                etot = float(l[len(l) - 1])
-                break
-            else:
-                etot =  "NaN"
+        if etot is None:
+            etot = "NaN"
 
         return etot
 
@@ -135,6 +126,10 @@ class W2kOptimization(BaseController):
         text += "==========Results==========\n"
         text += f"Total Energy -> {self._get_etot()} Ry\n"
         text += f"Run time -> {scf_time}\n"
+        if self.scf_monitor is not None:
+            text += f"SCF iterations -> {len(self.scf_monitor.series('DIS'))}\n"
+            if self.scf_monitor.stopped is not None:
+                text += f"SCF stopped -> {self.scf_monitor.stopped}\n"
         text += "End"
 
         with open(file_name, mode="w") as f:
@@ -158,23 +153,15 @@ class W2kOptimization(BaseController):
                 run_lapw1s = run_lapw1 + [spin]
                 run_lapw2s = run_lapw2 + [spin]
                 run_tetras = run_tetra + [spin]
-                print('run ' + ' '.join(run_lapw1s))
-                subprocess.run(run_lapw1s)
-                print('run ' + ' '.join(run_lapw2s))
-                subprocess.run(run_lapw2s)
-                print('run ' + ' '.join(['configure_int_lapw', '-b'] + int_list))
-                subprocess.run(['configure_int_lapw', '-b'] + int_list)
-                print('run ' + ' '.join(run_tetras))
-                subprocess.run(run_tetras)
+                self._run(run_lapw1s)
+                self._run(run_lapw2s)
+                self._run(['configure_int_lapw', '-b'] + int_list)
+                self._run(run_tetras)
         else:
-            print('run ' + ' '.join(run_lapw1))
-            subprocess.run(run_lapw1)
-            print('run ' + ' '.join(run_lapw2))
-            subprocess.run(run_lapw2)
-            print('run ' + ' '.join(['configure_int_lapw', '-b'] + int_list))
-            subprocess.run(['configure_int_lapw', '-b'] + int_list)
-            print('run ' + ' '.join(run_tetra))
-            subprocess.run(["x_lapw", "tetra"])
+            self._run(run_lapw1)
+            self._run(run_lapw2)
+            self._run(['configure_int_lapw', '-b'] + int_list)
+            self._run(run_tetra)
 
     def _save_all(self, rkmax, lmax, gmax, kmesh):
         """
@@ -185,8 +172,10 @@ class W2kOptimization(BaseController):
         save_dir = f"rk{int(rkmax)}l{int(lmax)}g{int(gmax)}km{int(kmesh)}"
         os.makedirs(save_dir)
 
+        ops = self._file_ops()
         for _f in files_list:
-            subprocess.run(["mv", _f, f"{save_dir}/{_f}"])
+            ops.move(_f, f"{save_dir}/{_f}")
+        ops.run()
 
         print(f"Saved in {save_dir}")
 
@@ -197,8 +186,10 @@ class W2kOptimization(BaseController):
         struct_file_paths = [f"rk{int(rkmax)}l{int(lmax)}g{int(gmax)}km{int(kmesh)}/{self.case}.struct",
                              f"rk{int(rkmax)}l{int(lmax)}g{int(gmax)}km{int(kmesh)}/{self.case}.struct_ii"]
 
+        ops = self._file_ops()
         for f in struct_file_paths:
-            subprocess.run(["cp", f"{f}", ""])
+            ops.copy(f, self.case_path)
+        ops.run()
 
     def optimize(self):
         self._make_domains()
@@ -211,7 +202,7 @@ class W2kOptimization(BaseController):
                             print("Force stop!!!!")
                             exit()
 
-                        subprocess.run(["rm", "-f", "*.broyd*"])
+                        self._file_ops().remove("*.broyd*").run()
                         self.initialization(_rkmax, _lmax, _gmax, _kmesh)  # イニシャライズ
                         scf_start = datetime.datetime.now()
                         self.scf(econv=self.ec, cconv=self.cc, numofiteration=self.i)  # SCF
@@ -242,6 +233,7 @@ if __name__ == "__main__":
         wo.optimize()
 
     run()
+    # import send_email as se
     # mail = se.EmailFromMac()
     # mail.info_panel()
     # mail.send(run())
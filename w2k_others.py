@@ -1,9 +1,9 @@
 import datetime
 import os
-import subprocess
+import time
 
 from WIEN2k_controller import BaseController
-import send_email as se
+from w2k_machines import save_tuned_parallel
 
 class OtherOperations(BaseController):
 
@@ -18,7 +18,7 @@ class OtherOperations(BaseController):
 
         self.initialization()
 
-        subprocess.run(["rm", "-f", "*.broyd*"])
+        self._file_ops().remove("*.broyd*").run()
         scf_start = datetime.datetime.now()
         self.scf(cconv=0)
         scf_stop = datetime.datetime.now()
@@ -27,8 +27,118 @@ class OtherOperations(BaseController):
         self.save_lapw(dir_name)
         self._save_parallel_result(run_time)
 
-    def _save_parallel_result(self, run_time):
-        text = f"{self.parallel} => {run_time}\n"
+    def tune_parallel(self, task="scf", candidates=None, iterations=2, patience=1, tolerance=0.05):
+        """
+        並列数とOpenMPのスレッド数を短い計算で測り、最も速い設定をcaseフォルダに保存する。
+        保存した値はBaseController.use_tuned_parallel(task)で使われる（"scf"はBaseControllerの初期値になる）。
+        parallelとompを変えていなければ、scf, calculate_band_*, calculate_dosの前にそれぞれのtaskの値に切り替わる。
+        (parallel, omp)はparallel個のk並列のジョブがそれぞれompスレッドを使う設定。
+        時間が最良値より長くなる候補がpatience回続いたら、それ以上の候補は測らない。
+
+        scf : SCFをiterations回だけ回す。初めにsave_lapwし、候補ごとと最後にrestore_lapwして収束した状態に戻す。
+        band : case.klist_bandでlapw1 -bandを１回走らせる。
+        dos : case.klistでlapw1を１回走らせる。
+
+        :param task: "scf", "band", "dos"
+        :param candidates: [(parallel, omp), ...]。Noneのときはparallel×ompがコア数以下の全ての組み合わせ
+        :param iterations: scfで回すSCFサイクルの数
+        :param patience: 時間が増えたら何回で打ち切るか
+        :param tolerance: 最良値よりこの割合以上長いときに「増えた」とみなす
+        :return: (parallel, omp)
+        """
+        if candidates is None:
+            # 並列数×スレッド数がコア数以下の組み合わせを、使うコア数の少ない順に測る
+            cores = os.cpu_count() or 1
+            candidates = sorted(((p, omp) for p in range(1, cores + 1) for omp in range(1, cores // p + 1)),
+                                key=lambda c: (c[0] * c[1], -c[0]))
+        klist_path = self._filepath("klist_band" if task == "band" else "klist")
+
+        if task == "scf":
+            self._run(["save_lapw", "-d", "tuning_backup"])
+
+        timings = {}
+        best = None
+        worse = 0
+        omp_env = os.environ.get("OMP_NUM_THREADS")
+        untouched = self._untouched_parallel
+        before = (self.parallel, self.omp)
+        # 測っている間は、scf()などで調整済みの値に切り替えない
+        self._untouched_parallel = None
+        try:
+            for parallel, omp in candidates:
+                self.force_stop()
+                if task == "scf":
+                    # 各候補を同じ収束した状態から始める
+                    self._run(["restore_lapw", "-f", "-d", "tuning_backup"])
+                self.parallel = parallel
+                self.omp = omp
+                self.set_parallel(klist_path=klist_path)
+                # parallel = 1のときは.machinesを使わないので、スレッド数は環境変数で渡す
+                os.environ["OMP_NUM_THREADS"] = str(omp)
+
+                if task == "scf":
+                    run_time = self._measure_scf(iterations)
+                else:
+                    run_time = self._measure_lapw1(task)
+
+                timings[f"{parallel}x{omp}"] = round(run_time, 3)
+                self._save_parallel_result(datetime.timedelta(seconds=run_time), task=task)
+                print(f"{task}: parallel={parallel}, omp={omp} => {run_time:.2f} s")
+
+                if best is None or run_time < best[0]:
+                    best = (run_time, parallel, omp)
+                    worse = 0
+                elif run_time > best[0] * (1 + tolerance):
+                    worse += 1
+                    if worse >= patience:
+                        print("Timings are rising. Stop tuning.")
+                        break
+        finally:
+            # 途中で止まったとき (force_stopなど) もcaseフォルダと環境変数を元に戻す
+            if task == "scf":
+                self._run(["restore_lapw", "-f", "-d", "tuning_backup"])
+            if omp_env is None:
+                os.environ.pop("OMP_NUM_THREADS", None)
+            else:
+                os.environ["OMP_NUM_THREADS"] = omp_env
+            self._untouched_parallel = untouched
+            self.parallel, self.omp = before
+
+        if best is None:
+            print(f"No candidate was measured for {task}. The tuned setting is not changed.")
+            return before
+
+        _, parallel, omp = best
+        save_tuned_parallel(self.case_path, task, parallel, omp, timings)
+        self.use_tuned_parallel(task)
+        print(f"Best setting for {task}: parallel={parallel}, omp={omp}")
+
+        return parallel, omp
+
+    def _measure_scf(self, iterations):
+        # 収束条件を厳しくして、必ずiterations回まわす
+        start = time.time()
+        self.scf(econv=1e-10, cconv=0, numofiteration=iterations)
+        return (time.time() - start) / iterations
+
+    def _measure_lapw1(self, task):
+        run_lapw1 = ["x_lapw", "lapw1"]
+        if task == "band":
+            run_lapw1.append("-band")
+        if self.parallel > 1:
+            run_lapw1.append("-p")
+        if self.spin_pol:
+            run_lapw1.append("-up")
+
+        start = time.time()
+        self._run(run_lapw1, numofk=self._numofk(run_lapw1))
+        return time.time() - start
+
+    def _save_parallel_result(self, run_time, task=""):
+        if task:
+            text = f"{task} {self.parallel}x{self.omp} => {run_time}\n"
+        else:
+            text = f"{self.parallel} => {run_time}\n"
         with open("Parallel_results.txt", "a") as f:
             f.write(text)
 
@@ -43,6 +153,13 @@ if __name__ == "__main__":
 
 
     run()
+
+    # 並列数を自動で調整する場合
+    # oo = OtherOperations("ohwada_Au")
+    # oo.tune_parallel(task="scf", iterations=2)
+    # oo.tune_parallel(task="band")
+
+    # import send_email as se
     # mail = se.EmailFromMac()
     # mail.info_panel()
     # mail.send(run())
\ No newline at end of file
@@ -0,0 +1,168 @@
+import os
+
+KEYS = {":ENE": "ENE", ":DIS": "DIS", ":FER": "FER", ":MMT": "MMT"}
+
+
+class ScfMonitor:
+    """
+    SCFの実行中にcase.scfの増えた部分だけを読み、サイクルごとの:ENE, :DIS, :FER, :MMTを集める。
+    :DISが増え続けるか、減らずに振動しているときは、計算を止めるべきと判断する。
+
+    mon = ScfMonitor("case.scf")
+    runner.run(["run_lapw", ...], watcher=mon.watch)
+    mon.series("DIS")
+
+    値はそのサイクルの行の最後の数字。
+    ENE : 全エネルギー (Ry)
+    DIS : 電荷の距離
+    FER : フェルミエネルギー (Ry)
+    MMT : セルの磁気モーメント (μB)
+    """
+
+    def __init__(self, scf_path, abort=True, from_start=False):
+        """
+        :param scf_path: case.scfのパス
+        :param abort: Trueのとき、発散か振動を見つけたらwatchがTrueを返して計算を止める
+        :param from_start: Falseのときは今のファイルの最後から読む（前のSCFの結果を読まない）
+        """
+        self.scf_path = scf_path
+        self.abort = abort
+
+        self.min_iterations = 6  # これより少ないサイクルでは判断しない
+        self.diverge_window = 4  # :DISがこの回数続けて増えたら発散
+        self.diverge_ratio = 10.0  # :DISがそれまでの最小値のこの倍数を超えたら発散
+        self.oscillation_window = 8  # このサイクル数の間、増減を繰り返して最小値が更新されなければ振動
+
+        self.iterations = []  # [{"iteration": n, "ENE": ..., "DIS": ..., "FER": ..., "MMT": ...}, ...]
+        self.stopped = None  # 止めるべきと判断した理由
+
+        self._finished = 0
+        self._offset = 0
+        self._inode = None
+        self._rest = ""
+        if not from_start and os.path.exists(scf_path):
+            st = os.stat(scf_path)
+            self._offset, self._inode = st.st_size, st.st_ino
+
+    def poll(self):
+        """
+        case.scfに追記された行を読む。
+        ファイルが作り直されたとき（小さくなったか、別のファイルになったとき）は最初から読む。
+        :return: 新しく終わった（:DISが書かれた）サイクルの数
+        """
+        if not os.path.exists(self.scf_path):
+            return 0
+
+        st = os.stat(self.scf_path)
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._offset, self._inode, self._rest = 0, st.st_ino, ""
+            self.iterations, self._finished = [], 0
+        if st.st_size == self._offset:
+            return 0
+
+        with open(self.scf_path, "r", errors="replace") as f:
+            f.seek(self._offset)
+            text = f.read()
+            self._offset = f.tell()
+
+        lines = (self._rest + text).split("\n")
+        self._rest = lines.pop()
+
+        for line in lines:
+            self._parse_line(line)
+
+        # ミキサーが:DISを書いたらそのサイクルは終わり
+        finished = len(self.series("DIS"))
+        new, self._finished = finished - self._finished, finished
+        return new
+
+    def _parse_line(self, line):
+        if line.startswith(":ITE"):
+            self.iterations.append({"iteration": len(self.iterations) + 1})
+            return
+
+        key = KEYS.get(line[:4])
+        if key is None:
+            return
+
+        value = None
+        for token in reversed(line.replace("=", " ").split()):
+            try:
+                value = float(token)
+                break
+            except ValueError:
+                pass
+        if value is None:
+            return
+
+        if not self.iterations:
+            self.iterations.append({"iteration": 1})
+        self.iterations[-1].setdefault(key, value)
+
+    def series(self, key):
+        """
+        :param key: "ENE", "DIS", "FER" or "MMT"
+        :return: サイクルごとの値のリスト
+        """
+        return [it[key] for it in self.iterations if key in it]
+
+    def last(self, key):
+        """
+        :return: 最後のサイクルの値。なければNone
+        """
+        s = self.series(key)
+        return s[-1] if s else None
+
+    def check(self):
+        """
+        :DISの変化から、SCFが発散しているか振動しているかを判断する。
+        :return: 止めるべき理由。問題がなければNone
+        """
+        dis = self.series("DIS")
+        if len(dis) < self.min_iterations:
+            return None
+
+        last = dis[-self.diverge_window - 1:]
+        if all(b > a for a, b in zip(last[:-1], last[1:])):
+            return f":DIS increased {self.diverge_window} times in a row ({last[0]:.5g} -> {last[-1]:.5g})"
+
+        if dis[-1] > self.diverge_ratio * min(dis[:-1]):
+            return f":DIS is {dis[-1] / min(dis[:-1]):.1f} times larger than the minimum"
+
+        w = self.oscillation_window
+        if len(dis) > w:
+            window = dis[-w - 1:]
+            diff = [b - a for a, b in zip(window[:-1], window[1:])]
+            alternating = all(a * b < 0 for a, b in zip(diff[:-1], diff[1:]))
+            if alternating and min(window[1:]) >= min(dis[:-w]):
+                return f":DIS oscillates for {w} iterations without improving (min {min(dis[:-w]):.5g})"
+
+        return None
+
+    def watch(self):
+        """
+        CommandRunner.runのwatcherとして使う。
+        :return: 計算を止めるときTrue
+        """
+        if self.poll() > 0:
+            it = [it for it in self.iterations if "DIS" in it][-1]
+            print(f"SCF {it['iteration']:3} : " + "  ".join(f"{k} {it[k]:.6g}" for k in KEYS.values() if k in it))
+
+            if self.stopped is None:
+                self.stopped = self.check()
+                if self.stopped is not None:
+                    print(f"SCF is not converging : {self.stopped}")
+
+        return self.abort and self.stopped is not None
+
+
+def read_scf(scf_path):
+    """
+    case.scf (or case.scfm)をすべて読む。
+    :return: サイクルごとの値のリスト [{"iteration": n, "ENE": ..., ...}, ...]
+    """
+    mon = ScfMonitor(scf_path, abort=False, from_start=True)
+    mon.poll()
+    mon._parse_line(mon._rest)
+
+    return mon.iterations
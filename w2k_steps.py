@@ -0,0 +1,141 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from w2k_trace import CommandRunner
+
+
+class Step:
+    """
+    WIEN2kのコマンド１つ分の計算ステップ。
+    depsに書かれたステップが全て終わってから実行される。
+    """
+
+    def __init__(self, name, command, deps=(), cores=1, locks=(), numofk=None):
+        """
+        :param name: ステップ名。依存関係の指定に使う
+        :param command: 実行するコマンドのリスト ["x_lapw", "lapw1", ...]
+        :param deps: 先に終わっている必要があるステップ名のリスト
+        :param cores: このステップが使うコア数
+        :param locks: 同時に使えないリソース名のリスト (例: .machinesを使う-p付きのコマンド)
+        :param numofk: 計算するk点の数。トレースに記録する
+        """
+        self.name = name
+        self.command = list(command)
+        self.deps = list(deps)
+        self.cores = max(int(cores), 1)
+        self.locks = set(locks)
+        self.numofk = numofk
+
+    def __repr__(self):
+        return f"Step({self.name!r}, {' '.join(self.command)!r}, deps={self.deps})"
+
+
+class StepEngine:
+    """
+    Stepの依存グラフを実行する。
+    依存関係のないステップはcore_budgetの範囲で同時に実行する。
+    core_budgetを超えるステップは、他に実行中のステップがないときだけ単独で実行する。
+    各コマンドはCommandRunnerで実行され、時間とリソースが記録される。
+    """
+
+    def __init__(self, core_budget=None, cwd=None, runner=None):
+        """
+        :param core_budget: 同時に使ってよいコア数。Noneのときはマシンのコア数
+        :param cwd: コマンドを実行するフォルダ。Noneのときはカレントディレクトリ
+        :param runner: CommandRunner。Noneのときは記録しないCommandRunner
+        """
+        if core_budget is None:
+            core_budget = os.cpu_count() or 1
+        self.core_budget = max(int(core_budget), 1)
+        self.cwd = cwd
+        self.runner = runner or CommandRunner()
+
+    def run(self, steps):
+        """
+        ステップを実行する。
+        失敗したステップに依存するステップは実行しない。
+
+        :param steps: Stepのリスト。同じ条件なら先に並んでいるものから実行する
+        :return: {ステップ名: 終了コード}。実行されなかったステップはNone
+        """
+        self._check_graph(steps)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._run_graph(steps))
+
+        # Jupyterなど、すでにイベントループが動いているときはasyncio.runを使えないので別のスレッドで実行する
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self._run_graph(steps)).result()
+
+    def _check_graph(self, steps):
+        names = [s.name for s in steps]
+        if len(names) != len(set(names)):
+            raise ValueError(f"Step names must be unique: {names}")
+
+        for s in steps:
+            for dep in s.deps:
+                if dep not in names:
+                    raise ValueError(f"Unknown dependency {dep!r} of step {s.name!r}")
+
+        # 循環依存を確認する
+        done = set()
+        remaining = list(steps)
+        while remaining:
+            ready = [s for s in remaining if set(s.deps) <= done]
+            if not ready:
+                raise ValueError(f"Circular dependency in steps: {[s.name for s in remaining]}")
+            for s in ready:
+                done.add(s.name)
+                remaining.remove(s)
+
+    async def _run_graph(self, steps):
+        pending = list(steps)
+        running = {}  # task -> step
+        results = {}
+        free_cores = self.core_budget
+        held_locks = set()
+
+        while pending or running:
+            skipped = False
+            for step in list(pending):
+                failed = [d for d in step.deps if d in results and results[d] != 0]
+                if failed:
+                    print(f"Skip {step.name} because {', '.join(failed)} failed.")
+                    results[step.name] = None
+                    pending.remove(step)
+                    skipped = True
+                    continue
+
+                if not all(d in results for d in step.deps):
+                    continue
+                if step.locks & held_locks:
+                    continue
+                if step.cores > free_cores and running:
+                    continue
+
+                pending.remove(step)
+                free_cores -= step.cores
+                held_locks |= step.locks
+                task = asyncio.ensure_future(self._run_step(step))
+                running[task] = step
+
+            if not running:
+                if skipped:
+                    continue
+                break
+
+            finished, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                step = running.pop(task)
+                free_cores += step.cores
+                held_locks -= step.locks
+                results[step.name] = task.result()
+
+        return results
+
+    async def _run_step(self, step):
+        print(">>RUN " + " ".join(step.command))
+        # 子プロセスごとのリソースをos.wait4で取るため、待ち受けはスレッドで行う
+        return await asyncio.to_thread(self.runner.run, step.command, cwd=self.cwd, numofk=step.numofk)
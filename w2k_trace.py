@@ -0,0 +1,203 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class CommandRunner:
+    """
+    サブプロセスを実行し、計算時間とリソースの使用量を記録する。
+    trace_pathを設定すると、１コマンドごとに１行のJSONをファイルに追記する。
+
+    記録する値
+    name : コマンド名 (lapw1, spaghetti, run_lapwなど)
+    category : 集計用の分類 (lapw1, lapw2, spaghetti, scf, init, file, ...)
+    wall : 経過時間 (s)
+    utime, stime : 子プロセスのユーザー/システムCPU時間 (s)
+    maxrss_kb : 子プロセスの最大常駐メモリ (kB)
+    returncode : 終了コード
+    numofk : k点の数 (わかるとき)
+    """
+
+    def __init__(self, trace_path=None):
+        """
+        :param trace_path: 記録するJSONLファイルのパス。Noneのときは記録しない
+        """
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+
+    def run(self, command, cwd=None, numofk=None, watcher=None, interval=2.0):
+        """
+        コマンドを実行して終了を待つ。
+        os.wait4で子プロセスごとのCPU時間と最大メモリを取る。
+
+        :param command: コマンドのリスト
+        :param cwd: 実行するフォルダ
+        :param numofk: k点の数
+        :param watcher: 実行中にinterval秒ごとに呼ぶ関数。Trueを返すとプロセスグループごと止める
+        :param interval: watcherを呼ぶ間隔 (s)
+        :return: 終了コード
+        """
+        start = time.time()
+        if watcher is None:
+            proc = subprocess.Popen(command, cwd=cwd)
+            _, status, usage = os.wait4(proc.pid, 0)
+        else:
+            # run_lapwは子プロセスを起動するので、まとめて止められるように新しいセッションで実行する
+            proc = subprocess.Popen(command, cwd=cwd, start_new_session=True)
+            status, usage = self._wait_watching(proc, watcher, interval)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.time() - start
+
+        self.record(command, wall, usage.ru_utime, usage.ru_stime, self._maxrss_kb(usage.ru_maxrss),
+                    proc.returncode, numofk=numofk, cwd=cwd)
+
+        return proc.returncode
+
+    def _wait_watching(self, proc, watcher, interval):
+        # wait4は別のスレッドで待ち、終わるまでinterval秒ごとにwatcherを呼ぶ
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(os.wait4(proc.pid, 0)), daemon=True)
+        waiter.start()
+
+        stopped = False
+        while not stopped:
+            waiter.join(interval)
+            if not waiter.is_alive():
+                break
+            if watcher():
+                print(f"Stop {' '.join(proc.args)}")
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+                stopped = True
+
+        waiter.join()
+        if not stopped:
+            watcher()  # 終わる直前に書かれた分を読む
+
+        _, status, usage = result[0]
+        return status, usage
+
+    @contextmanager
+    def timed(self, name, category="file", numofk=None):
+        """
+        Pythonの中で行う処理の時間を記録する。
+        with runner.timed("mv bands.agr"):
+            ...
+        """
+        start = time.time()
+        cpu_start = time.process_time()
+        returncode = 0
+        try:
+            yield
+        except Exception:
+            returncode = 1
+            raise
+        finally:
+            self.record([name], time.time() - start, time.process_time() - cpu_start, 0, 0, returncode,
+                        numofk=numofk, category=category)
+
+    def record(self, command, wall, utime, stime, maxrss_kb, returncode, numofk=None, cwd=None, category=None):
+        if self.trace_path is None:
+            return
+
+        entry = {"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                 "name": self._name(command),
+                 "category": category or self._category(command),
+                 "command": " ".join(command),
+                 "cwd": cwd or os.getcwd(),
+                 "wall": round(wall, 4),
+                 "utime": round(utime, 4),
+                 "stime": round(stime, 4),
+                 "maxrss_kb": maxrss_kb,
+                 "returncode": returncode,
+                 "numofk": numofk}
+
+        with self._lock:
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _name(self, command):
+        if command[0] == "x_lapw" and len(command) > 1:
+            return command[1]
+        return os.path.basename(command[0])
+
+    def _category(self, command):
+        name = self._name(command)
+        if name in ["run_lapw", "runsp_lapw"]:
+            return "scf"
+        if name == "init_lapw":
+            return "init"
+        if name in ["cp", "mv", "rm", "mkdir", "save_lapw"]:
+            return "file"
+        return name
+
+    def _maxrss_kb(self, maxrss):
+        # macOSではbyte、Linuxではkbyte
+        if sys.platform == "darwin":
+            return maxrss // 1024
+        return maxrss
+
+
+def load_trace(trace_path):
+    """
+    JSONLのトレースを読み込む。
+    :return: 記録のリスト
+    """
+    entries = []
+    with open(trace_path, "r") as f:
+        for line in f:
+            if line.strip():
+                entries.append(json.loads(line))
+
+    return entries
+
+
+def summarize(trace_path, key="category"):
+    """
+    トレースをkeyごとに集計する。
+    :param trace_path: JSONLファイルのパス
+    :param key: "category" or "name"
+    :return: {key: {"count", "wall", "cpu", "maxrss_kb", "numofk", "failed"}}  wallの大きい順
+    """
+    summary = {}
+    for e in load_trace(trace_path):
+        s = summary.setdefault(e[key], {"count": 0, "wall": 0.0, "cpu": 0.0, "maxrss_kb": 0, "numofk": 0,
+                                        "failed": 0})
+        s["count"] += 1
+        s["wall"] += e["wall"]
+        s["cpu"] += e["utime"] + e["stime"]
+        s["maxrss_kb"] = max(s["maxrss_kb"], e["maxrss_kb"])
+        s["numofk"] += e["numofk"] or 0
+        if e["returncode"] != 0:
+            s["failed"] += 1
+
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["wall"]))
+
+
+def print_summary(trace_path, key="category"):
+    """
+    どこに時間がかかっているかを表で表示する。
+    """
+    summary = summarize(trace_path, key=key)
+    total = sum(s["wall"] for s in summary.values()) or 1
+
+    print(f"{key:<14}{'count':>8}{'wall [h]':>11}{'share':>8}{'cpu [h]':>10}{'s/run':>9}{'s/k':>9}"
+          f"{'maxRSS [MB]':>13}{'failed':>8}")
+    for name, s in summary.items():
+        per_k = f"{s['wall'] / s['numofk']:.3f}" if s["numofk"] else "-"
+        print(f"{name:<14}{s['count']:>8}{s['wall'] / 3600:>11.3f}{s['wall'] / total * 100:>7.1f}%"
+              f"{s['cpu'] / 3600:>10.3f}{s['wall'] / s['count']:>9.2f}{per_k:>9}"
+              f"{s['maxrss_kb'] / 1024:>13.1f}{s['failed']:>8}")
+    print(f"Total {total / 3600:.3f} h")
+
+
+if __name__ == "__main__":
+    # python w2k_trace.py (path to trace.jsonl) [category or name]
+    print_summary(sys.argv[1], *sys.argv[2:3])
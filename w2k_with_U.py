@@ -1,8 +1,6 @@
 import os
-import subprocess
 
 from WIEN2k_controller import BaseController
-import send_email as se
 
 class CalculationWithU(BaseController):
     """
@@ -32,19 +30,22 @@ class CalculationWithU(BaseController):
 
         for _u1 in domain_list[0]:
             for _u2 in domain_list[1]:
-                subprocess.run(["rm", "-f", "*.broyd*"])
+                self._file_ops().remove("*.broyd*").run()
                 self._modify_inorb([_u1, _u2])
                 self._modify_indm()
                 self._remove_lapw()
                 print(f"Start SCF with {_atom1} = {_u1} and {_atom2} = {_u2}")
-                self.scf()
-                self._make_insp()
+                mon = self.scf()
                 name = f"{_atom1}_{_u1}_{_atom2}_{_u2}"
                 self._save_lapw(name)
-                self._cp_results(name)
-                print("Start band calculation.")
-                self._calculate_band()
-                self._save_band(name)
+                if mon.stopped is None:
+                    self._make_insp()
+                    self._cp_results(name)
+                    print("Start band calculation.")
+                    self._calculate_band()
+                    self._save_band(name)
+                else:
+                    print(f"Skip band calculation for {name}.")
                 # print("Start DOS calculation.")
                 # self.DOS_calculation()
                 # self._save_dos(name)
@@ -113,7 +114,7 @@ class CalculationWithU(BaseController):
             f.write(text)
 
     def _remove_lapw(self):
-        subprocess.run(["rm", "-f", "*.broyd*"])
+        self._file_ops().remove("*.broyd*").run()
 
     def _ev2ry(self, ev):
         return ev / 13.6058
@@ -127,30 +128,32 @@ class CalculationWithU(BaseController):
                 run_lapw1 += [spin]
                 run_spag += [spin]
 
-                subprocess.run(run_lapw1)
-                subprocess.run(run_spag)
+                self._run(run_lapw1)
+                self._run(run_spag)
         else:
-            subprocess.run(run_lapw1)
-            subprocess.run(run_spag)
+            self._run(run_lapw1)
+            self._run(run_spag)
 
     def _save_band(self, name):
         dir = "Bands"
         if not os.path.exists(dir):
             os.makedirs(dir)
 
+        ops = self._file_ops()
         if self.spin_pol:
             for spin in ["up", "dn"]:
-                subprocess.run(["cp", f"{self.case}.bands{spin}.agr", f"{dir}/{name}{spin}.bands.agr"])
+                ops.copy(f"{self.case}.bands{spin}.agr", f"{dir}/{name}{spin}.bands.agr")
         else:
-            subprocess.run(["cp", f"{self.case}.bands.agr", f"{dir}/{name}.bands.agr"])
+            ops.copy(f"{self.case}.bands.agr", f"{dir}/{name}.bands.agr")
+        ops.run()
 
     def _save_lapw(self, name):
         com_list = ["save_lapw", "-d", name]
-        subprocess.run(com_list)
+        self._run(com_list)
         print(f"Save lapw in {name}")
 
     def _cp_results(self, name):
-        subprocess.run(["cp", f"{name}/*", "."])
+        self._file_ops().copy_glob(f"{name}/*", ".").run()
 
     def DOS_calculation(self):
         """
@@ -170,34 +173,28 @@ class CalculationWithU(BaseController):
                 run_lapw1s = run_lapw1 + [spin]
                 run_lapw2s = run_lapw2 + [spin]
                 run_tetras = run_tetra + [spin]
-                print('run ' + ' '.join(run_lapw1s))
-                subprocess.run(run_lapw1s)
-                print('run ' + ' '.join(run_lapw2s))
-                subprocess.run(run_lapw2s)
-                print('run ' + ' '.join(['configure_int_lapw', '-b'] + int_list))
-                subprocess.run(['configure_int_lapw', '-b'] + int_list)
-                print('run ' + ' '.join(run_tetras))
-                subprocess.run(run_tetras)
+                self._run(run_lapw1s)
+                self._run(run_lapw2s)
+                self._run(['configure_int_lapw', '-b'] + int_list)
+                self._run(run_tetras)
         else:
-            print('run ' + ' '.join(run_lapw1))
-            subprocess.run(run_lapw1)
-            print('run ' + ' '.join(run_lapw2))
-            subprocess.run(run_lapw2)
-            print('run ' + ' '.join(['configure_int_lapw', '-b'] + int_list))
-            subprocess.run(['configure_int_lapw', '-b'] + int_list)
-            print('run ' + ' '.join(run_tetra))
-            subprocess.run(["x_lapw", "tetra"])
+            self._run(run_lapw1)
+            self._run(run_lapw2)
+            self._run(['configure_int_lapw', '-b'] + int_list)
+            self._run(run_tetra)
 
     def _save_dos(self, name: str):
         dir = "DOSs"
         if not os.path.exists(dir):
             os.makedirs(dir)
 
+        ops = self._file_ops()
         if self.spin_pol:
             for spin in ["up", "dn"]:
-                subprocess.run(["cp", f"{self.case}.dos1ev{spin}", f"{dir}/{name}{spin}.dos1ev"])
+                ops.copy(f"{self.case}.dos1ev{spin}", f"{dir}/{name}{spin}.dos1ev")
         else:
-            subprocess.run(["cp", f"{self.case}.dos1ev", f"{dir}/{name}.dos1ev"])
+            ops.copy(f"{self.case}.dos1ev", f"{dir}/{name}.dos1ev")
+        ops.run()
 
 
 
@@ -215,6 +212,7 @@ if __name__ == "__main__":
         withu.calculate_scf_with_U(udict)
 
     run()
+    # import send_email as se
     # mail = se.EmailFromMac()
     # mail.info_panel()
     # mail.send(run())
\ No newline at end of file
@@ -0,0 +1,142 @@
+import fnmatch
+import os
+import queue
+import threading
+
+from w2k_fileops import copy, makedirs
+from w2k_machines import count_kpoints
+
+
+class WorkerPool:
+    """
+    収束したcaseフォルダを複製した作業フォルダを複数作り、klist_bandファイルを動的に割り振ってバンド計算を並列に行う。
+    WIEN2kは.klist_bandや.bands.agrを固定のファイル名で書き出すため、作業フォルダごとに計算を分ける。
+    WIEN2kはフォルダ名をcase名として使うので、作業フォルダは{save_dir}/workers/worker{n}/{case}に作る。
+    caseフォルダにstop.rtfを入れると、新しいklistの割り振りをやめる。
+    """
+
+    # 作業フォルダにコピーしないファイル。lapw1で作り直されるか、作業フォルダごとに書き出すもの。
+    skip_patterns = ["*.vector*", "*.klist_band", "*.bands*.agr", ".machine*", ".processes", "*.broyd*", "stop.rtf"]
+
+    def __init__(self, controller, numofworkers):
+        """
+        :param controller: BaseControllerを継承したインスタンス。spin_pol, SOC, U, parallelの設定を使う
+        :param numofworkers: 作業フォルダの数
+        """
+        self.controller = controller
+        self.numofworkers = max(int(numofworkers), 1)
+        self.worker_dirs = []
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def make_workers(self, save_dir, klist_path=None):
+        """
+        caseフォルダのファイル（サブフォルダは除く）を作業フォルダにコピーし、作業フォルダごとに.machinesを作る。
+        .inspはここでcaseフォルダに作っておき、各作業フォルダに配る。
+
+        :param save_dir: 作業フォルダを作るフォルダ
+        :param klist_path: .machinesを作るときにk点を数えるklist_bandファイル
+        :return: 作業フォルダのリスト
+        """
+        c = self.controller
+        c._use_task_parallel("band")  # 下で作業フォルダごとに.machinesを作る
+        c._make_insp()
+
+        files = [f for f in os.listdir(c.case_path)
+                 if os.path.isfile(f"{c.case_path}/{f}") and not self._skip(f)]
+
+        self.worker_dirs = []
+        for n in range(self.numofworkers):
+            worker_dir = os.path.abspath(f"{c.case_path}/{save_dir}/workers/worker{n}/{c.case}")
+            # WIEN2kはファイルをその場で書き換えるので、ハードリンクではなくコピーする
+            makedirs(worker_dir)
+            for f in files:
+                copy(f"{c.case_path}/{f}", f"{worker_dir}/{f}")
+            c.set_parallel(f"{worker_dir}/.machines", klist_path=klist_path)
+            self.worker_dirs.append(worker_dir)
+
+        print(f"{self.numofworkers} workers are made in {c.case}/{save_dir}/workers.")
+        return self.worker_dirs
+
+    def remove_workers(self, save_dir):
+        """
+        作業フォルダを削除する。
+        """
+        c = self.controller
+        c._file_ops().remove_tree(f"{c.case_path}/{save_dir}/workers").run()
+        self.worker_dirs = []
+
+    def calculate_klists(self, save_dir, klists, only_spin="", on_done=None):
+        """
+        klist_bandファイルを空いた作業フォルダから順に割り振って計算し、
+        結果の.bands.agrを{save_dir}/Bands/{save_name}{spin}.bands.agrに集める。
+
+        :param save_dir: 結果を保存するフォルダ
+        :param klists: [(save_name, klist_bandファイルのパス), ...]
+        :param only_spin: "up" or "dn"のとき片方のスピンだけ計算する
+        :param on_done: 計算に成功したklistごとにon_done(save_name, klist_bandファイルのパス)を呼ぶ
+        :return: 計算に失敗したsave_nameのリスト
+        """
+        if not self.worker_dirs:
+            self.make_workers(save_dir, klist_path=klists[0][1] if klists else None)
+
+        tasks = queue.Queue()
+        for task in klists:
+            tasks.put(task)
+
+        self._stop.clear()
+        failed = []
+        threads = [threading.Thread(target=self._work, args=(n, tasks, save_dir, only_spin, failed, on_done))
+                   for n in range(len(self.worker_dirs))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if self._stop.is_set():
+            print("Force stop!!!!")
+        if failed:
+            print(f"Calculation failed for {', '.join(failed)}.")
+
+        return failed
+
+    def _work(self, n, tasks, save_dir, only_spin, failed, on_done):
+        c = self.controller
+        worker_dir = self.worker_dirs[n]
+        core_budget = max(c.core_budget // len(self.worker_dirs), 1)
+        numofk = None  # 作業フォルダの.machinesを作ったときのk点の数
+
+        while not self._stop.is_set():
+            try:
+                save_name, klist = tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            if os.path.exists(f"{c.case_path}/stop.rtf"):
+                self._stop.set()
+                return
+
+            print(f"Calculation starts for {save_name} in worker{n}")
+            try:
+                copy(klist, f"{worker_dir}/{c.case}.klist_band")
+                # .machinesのk点の分け方を、この作業フォルダのklist_bandに合わせる
+                if c.parallel > 1 and numofk != count_kpoints(klist):
+                    numofk = count_kpoints(klist)
+                    c.set_parallel(f"{worker_dir}/.machines", klist_path=klist)
+                steps = c._band_steps(only_spin=only_spin, work_dir=worker_dir)
+                results = c._run_band_steps(steps, only_spin=only_spin, work_dir=worker_dir, core_budget=core_budget)
+                c._save_only_bandsagr(save_dir, save_name, only_spin=only_spin, work_dir=worker_dir)
+                ok = all(r == 0 for r in results.values())
+                if ok and on_done is not None:
+                    on_done(save_name, klist)
+            except Exception as e:
+                print(f"worker{n}: {e}")
+                ok = False
+
+            if not ok:
+                with self._lock:
+                    failed.append(save_name)
+
+    def _skip(self, filename):
+        return any(fnmatch.fnmatch(filename, p) for p in self.skip_patterns)